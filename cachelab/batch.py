@@ -0,0 +1,168 @@
+# Replays whole arrays of addresses against a cache geometry without creating
+# a CacheAccessResult per access. Requires numpy.
+#
+# This module only reads num_ways, num_sets, offset_bits and index_bits from the
+# parameters it is given, so it can be used with an unsaved CacheParameters.
+
+import collections
+import multiprocessing
+import os
+
+import numpy
+
+BatchResult = collections.namedtuple('BatchResult', [
+    'hit',          # bool array, True for cache hits
+    'tag',          # uint64 arrays of address parts
+    'index',
+    'offset',
+    'evicted',      # uint64 array of the evicted block address (0 if nothing was evicted)
+    'has_evicted',  # bool array, True if the access evicted a block
+])
+
+def split_addresses(parameters, addresses):
+    """Split an array of addresses into (tag, index, offset) arrays, like CacheParameters.split_address."""
+    addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+    offset_bits = numpy.uint64(parameters.offset_bits)
+    index_bits = numpy.uint64(parameters.index_bits)
+    offset = addresses & numpy.uint64((1 << parameters.offset_bits) - 1)
+    index = (addresses >> offset_bits) & numpy.uint64((1 << parameters.index_bits) - 1)
+    tag = addresses >> (offset_bits + index_bits)
+    return (tag, index, offset)
+
+def unsplit_addresses(parameters, tag, index, offset):
+    """Inverse of split_addresses."""
+    offset_bits = numpy.uint64(parameters.offset_bits)
+    index_bits = numpy.uint64(parameters.index_bits)
+    return (tag << (offset_bits + index_bits)) | (index << offset_bits) | offset
+
+class BatchSimulator():
+    """
+    LRU cache simulator which processes arrays of addresses at a time.
+
+    Results match applying each address as a CacheAccess to a CacheState
+    with the same parameters. Each set is an OrderedDict of its valid tags
+    from least to most recently used; the state persists between calls
+    to simulate(), so a long trace can be processed in chunks.
+    """
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self._num_ways = parameters.num_ways
+        self._sets = {}
+
+    def simulate(self, addresses):
+        (tag, index, offset) = split_addresses(self.parameters, addresses)
+        count = len(tag)
+        hit = numpy.zeros(count, dtype=bool)
+        evicted_tag = numpy.zeros(count, dtype=numpy.uint64)
+        has_evicted = numpy.zeros(count, dtype=bool)
+        hit_positions = []
+        evicted_positions = []
+        evicted_tags = []
+        num_ways = self._num_ways
+        sets = self._sets
+        for position, (cur_index, cur_tag) in enumerate(zip(index.tolist(), tag.tolist())):
+            recency = sets.get(cur_index)
+            if recency == None:
+                recency = collections.OrderedDict()
+                sets[cur_index] = recency
+            if cur_tag in recency:
+                recency.move_to_end(cur_tag)
+                hit_positions.append(position)
+            else:
+                if len(recency) == num_ways:
+                    evicted_positions.append(position)
+                    evicted_tags.append(recency.popitem(last=False)[0])
+                recency[cur_tag] = None
+        hit[hit_positions] = True
+        has_evicted[evicted_positions] = True
+        evicted_tag[evicted_positions] = evicted_tags
+        evicted = numpy.where(
+            has_evicted,
+            unsplit_addresses(self.parameters, evicted_tag, index, numpy.uint64(0)),
+            numpy.uint64(0),
+        )
+        return BatchResult(hit=hit, tag=tag, index=index, offset=offset, evicted=evicted, has_evicted=has_evicted)
+
+def simulate_batch(parameters, addresses):
+    """Simulate a whole array of addresses against an initially empty cache."""
+    return BatchSimulator(parameters).simulate(addresses)
+
+# the parts of CacheParameters needed by BatchSimulator, for sending to worker processes
+_ShardGeometry = collections.namedtuple('_ShardGeometry', ['num_ways', 'offset_bits', 'index_bits'])
+
+def _shard_worker(connection, geometry):
+    simulator = BatchSimulator(_ShardGeometry(*geometry))
+    while True:
+        addresses = connection.recv()
+        if addresses is None:
+            break
+        result = simulator.simulate(addresses)
+        connection.send((result.hit, result.evicted, result.has_evicted))
+    connection.close()
+
+class ParallelSimulator():
+    """
+    Drop-in replacement for BatchSimulator which splits each batch of
+    addresses by set index across worker processes.
+
+    Sets never interact, so each worker runs a BatchSimulator over the
+    accesses to its sets (index % processes) in trace order, and the
+    per-access results are scattered back into trace order; the output is
+    identical to a serial run. Workers keep their state between calls to
+    simulate() until close() is called.
+    """
+    def __init__(self, parameters, processes=None):
+        self.parameters = parameters
+        if processes == None:
+            processes = os.cpu_count() or 1
+        # a set is never split across workers, so more workers than sets would idle
+        self.processes = max(1, min(processes, parameters.num_sets))
+        geometry = (parameters.num_ways, parameters.offset_bits, parameters.index_bits)
+        self._connections = []
+        self._workers = []
+        for _ in range(self.processes):
+            parent_connection, child_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_shard_worker, args=(child_connection, geometry), daemon=True)
+            worker.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._workers.append(worker)
+
+    def simulate(self, addresses):
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        (tag, index, offset) = split_addresses(self.parameters, addresses)
+        shard = index % numpy.uint64(self.processes)
+        positions = [numpy.flatnonzero(shard == i) for i in range(self.processes)]
+        # send every shard before collecting any results so the workers run concurrently
+        for connection, shard_positions in zip(self._connections, positions):
+            connection.send(addresses[shard_positions])
+        count = len(addresses)
+        hit = numpy.zeros(count, dtype=bool)
+        evicted = numpy.zeros(count, dtype=numpy.uint64)
+        has_evicted = numpy.zeros(count, dtype=bool)
+        for connection, shard_positions in zip(self._connections, positions):
+            (shard_hit, shard_evicted, shard_has_evicted) = connection.recv()
+            hit[shard_positions] = shard_hit
+            evicted[shard_positions] = shard_evicted
+            has_evicted[shard_positions] = shard_has_evicted
+        return BatchResult(hit=hit, tag=tag, index=index, offset=offset, evicted=evicted, has_evicted=has_evicted)
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+        for worker in self._workers:
+            worker.join()
+        self._connections = []
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def simulate_parallel(parameters, addresses, processes=None):
+    """Like simulate_batch, but shards the sets across processes."""
+    with ParallelSimulator(parameters, processes) as simulator:
+        return simulator.simulate(addresses)
@@ -0,0 +1,192 @@
+# Compact, versioned encodings for the accesses, results and cache states that
+# CachePattern stores in text columns.
+#
+# An encoded value is 'b<version>:' followed by the base64 encoding of
+# little-endian binary data. Anything else is the older JSON format, which
+# callers still need to accept (see the pack_patterns command to convert old
+# rows). Each binary value starts with an 8-byte header, and its arrays are
+# laid out so they can be read with memoryview.cast() without copying.
+
+import array
+import base64
+import struct
+import sys
+
+VERSION = 1
+PREFIX = 'b{}:'.format(VERSION)
+
+# access kinds from CachePattern.generate_random; code 0 is no kind
+KIND_CODES = [
+    None,
+    'random_miss',
+    'miss_prefer_empty',
+    'miss_prefer_used',
+    'conflict_miss',
+    'setup_conflict',
+    'setup_conflict_aggressive',
+    'hit',
+    'hit_lru',
+]
+_CODE_FOR_KIND = {kind: code for code, kind in enumerate(KIND_CODES)}
+_WRITE_FLAG = 0x80
+
+_ACCESSES_HEADER = struct.Struct('<II')  # count, unused
+_RESULTS_HEADER = struct.Struct('<II')   # count, optimal misses + 1 (0 if not stored)
+_STATE_HEADER = struct.Struct('<BcHI')   # sparse, tag typecode, num_ways, num_rows
+
+_RESULT_HIT = 1
+_RESULT_EVICTED = 2
+
+_VALID = 1
+_DIRTY = 2
+
+def is_packed(raw):
+    return raw.startswith('b')
+
+def _decode(raw):
+    (version, _, data) = raw.partition(':')
+    if version != PREFIX[:-1]:
+        raise ValueError('unsupported encoding version {!r}'.format(version))
+    return memoryview(base64.b64decode(data))
+
+def _encode(data):
+    return PREFIX + base64.b64encode(bytes(data)).decode('ascii')
+
+def _append_array(out, typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    out += values.tobytes()
+    # keep later arrays 8-byte aligned
+    out += bytes(-len(out) % 8)
+
+def _read_array(data, offset, typecode, count):
+    """Return (values, offset after them); values is a view into data where possible."""
+    size = array.array(typecode).itemsize * count
+    chunk = data[offset:offset + size]
+    if sys.byteorder == 'little':
+        values = chunk.cast(typecode)
+    else:
+        values = array.array(typecode, chunk.tobytes())
+        values.byteswap()
+    return (values, offset + size + (-(offset + size) % 8))
+
+def pack_accesses(accesses):
+    """
+    Encode a list of (address, size, kind, type) tuples, or return None if
+    they cannot be represented (so the caller should use JSON).
+    """
+    addresses = []
+    sizes = []
+    codes = []
+    for address, size, kind, access_type in accesses:
+        code = _CODE_FOR_KIND.get(kind)
+        if code == None or not (0 <= address < 1 << 64) or not (0 <= size < 1 << 16):
+            return None
+        if access_type == 'W':
+            code |= _WRITE_FLAG
+        addresses.append(address)
+        sizes.append(size)
+        codes.append(code)
+    out = bytearray(_ACCESSES_HEADER.pack(len(addresses), 0))
+    _append_array(out, 'Q', addresses)
+    _append_array(out, 'H', sizes)
+    _append_array(out, 'B', codes)
+    return _encode(out)
+
+def unpack_addresses(raw):
+    """Return the addresses of packed accesses as a sequence of ints, without decoding the rest."""
+    data = _decode(raw)
+    (count, _) = _ACCESSES_HEADER.unpack_from(data)
+    return _read_array(data, _ACCESSES_HEADER.size, 'Q', count)[0]
+
+def unpack_accesses(raw):
+    """Decode packed accesses into a list of (address, size, kind, type) tuples."""
+    data = _decode(raw)
+    (count, _) = _ACCESSES_HEADER.unpack_from(data)
+    (addresses, offset) = _read_array(data, _ACCESSES_HEADER.size, 'Q', count)
+    (sizes, offset) = _read_array(data, offset, 'H', count)
+    (codes, offset) = _read_array(data, offset, 'B', count)
+    return [
+        (address, size, KIND_CODES[code & ~_WRITE_FLAG], 'W' if code & _WRITE_FLAG else 'R')
+        for address, size, code in zip(addresses, sizes, codes)
+    ]
+
+def pack_results(hits, evicted, optimal_misses=None):
+    """
+    Encode per-access results: whether each access hit, and the evicted
+    block address or None; plus, if given, the number of misses with
+    optimal replacement.
+    """
+    flags = []
+    evicted_addresses = []
+    for hit, evicted_address in zip(hits, evicted):
+        flags.append((_RESULT_HIT if hit else 0) | (_RESULT_EVICTED if evicted_address != None else 0))
+        evicted_addresses.append(evicted_address if evicted_address != None else 0)
+    out = bytearray(_RESULTS_HEADER.pack(len(flags), 0 if optimal_misses == None else optimal_misses + 1))
+    _append_array(out, 'Q', evicted_addresses)
+    _append_array(out, 'B', flags)
+    return _encode(out)
+
+def unpack_results(raw):
+    """Decode pack_results() output into a list of (hit, evicted address or None)."""
+    data = _decode(raw)
+    (count, _) = _RESULTS_HEADER.unpack_from(data)
+    (evicted, offset) = _read_array(data, _RESULTS_HEADER.size, 'Q', count)
+    (flags, offset) = _read_array(data, offset, 'B', count)
+    return [
+        (flag & _RESULT_HIT != 0, address if flag & _RESULT_EVICTED else None)
+        for flag, address in zip(flags, evicted)
+    ]
+
+def unpack_optimal_misses(raw):
+    """Return the optimal miss count stored by pack_results(), or None if there is none."""
+    (_, stored) = _RESULTS_HEADER.unpack_from(_decode(raw))
+    return stored - 1 if stored > 0 else None
+
+def _tag_typecode(tag_bits):
+    for typecode in ['B', 'H', 'I', 'Q']:
+        if array.array(typecode).itemsize * 8 >= tag_bits:
+            return typecode
+    raise ValueError('tags of {} bits are too large to pack'.format(tag_bits))
+
+def pack_state(sparse, num_ways, tag_bits, indices, tags, valid, dirty):
+    """
+    Encode a cache state. indices lists the sets stored (for a dense state,
+    every set in order); tags, valid and dirty have num_ways entries for each
+    of them, each set's entries in the order they would be replaced. Tags use
+    the smallest array type that fits tag_bits, and the valid and dirty bits
+    are packed four entries to a byte.
+    """
+    typecode = _tag_typecode(tag_bits)
+    out = bytearray(_STATE_HEADER.pack(1 if sparse else 0, typecode.encode('ascii'), num_ways, len(indices)))
+    if sparse:
+        _append_array(out, 'Q', indices)
+    _append_array(out, typecode, tags)
+    flags = bytearray((len(tags) + 3) // 4)
+    for entry, (is_valid, is_dirty) in enumerate(zip(valid, dirty)):
+        bits = (_VALID if is_valid else 0) | (_DIRTY if is_dirty else 0)
+        flags[entry >> 2] |= bits << ((entry & 3) * 2)
+    out += flags
+    return _encode(out)
+
+def unpack_state(raw):
+    """
+    Decode pack_state() output into (sparse, num_ways, indices, tags, flags),
+    where entry_flags(flags, entry) gives the valid and dirty bits of an entry.
+    """
+    data = _decode(raw)
+    (sparse, typecode, num_ways, num_rows) = _STATE_HEADER.unpack_from(data)
+    offset = _STATE_HEADER.size
+    if sparse:
+        (indices, offset) = _read_array(data, offset, 'Q', num_rows)
+    else:
+        indices = range(num_rows)
+    (tags, offset) = _read_array(data, offset, typecode.decode('ascii'), num_rows * num_ways)
+    flags = data[offset:offset + (num_rows * num_ways + 3) // 4]
+    return (sparse != 0, num_ways, indices, tags, flags)
+
+def entry_flags(flags, entry):
+    """Return (valid, dirty) for an entry of unpack_state() output."""
+    bits = flags[entry >> 2] >> ((entry & 3) * 2)
+    return (bits & _VALID != 0, bits & _DIRTY != 0)
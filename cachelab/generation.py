@@ -0,0 +1,466 @@
+# Generation of questions as plain values, without Django or the database,
+# so it can be timed, tested and run in many processes at once.
+# models.py saves what these functions return (see
+# CachePattern.from_generated and CachePattern.bulk_create_generated).
+#
+# Every function takes an rng argument: None to use the random module's
+# shared generator (so random.seed() applies), a random.Random, or a seed
+# for a new random.Random.
+
+import bisect
+import itertools
+import logging
+import math
+import random
+
+from .sampling import UnusedSampler
+from .simulation import CacheAccess, CacheGeometry, CacheState, count_optimal_misses
+
+logger = logging.getLogger('cachelab')
+
+def make_rng(rng=None):
+    if rng == None or rng == random:
+        return random
+    elif isinstance(rng, random.Random):
+        return rng
+    else:
+        return random.Random(rng)
+
+class RandomSet():
+    """A set with constant-time add, discard and uniformly random choice."""
+    def __init__(self, items=(), rng=random):
+        self._rng = rng
+        self._items = []
+        self._positions = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._positions
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def add(self, item):
+        if item not in self._positions:
+            self._positions[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        position = self._positions.pop(item, None)
+        if position == None:
+            return
+        last = self._items.pop()
+        if position < len(self._items):
+            self._items[position] = last
+            self._positions[last] = position
+
+    def choice(self):
+        return self._rng.choice(self._items)
+
+# because random.choices isn't available until Python 3.6
+def _random_weighted(possibilities, weights, rng=random):
+    cumulative_weights = list(itertools.accumulate(weights))
+    weight_index = rng.random() * cumulative_weights[-1]
+    index = bisect.bisect_left(cumulative_weights, weight_index)
+    return possibilities[index]
+
+def random_geometry(rng=None,
+        min_ways=1, max_ways=12, min_sets_log=0,
+        max_sets_log=24, min_block_size_log=0,
+        max_block_size_log=8,
+        min_address_bits=8,
+        max_address_bits=64,
+        address_bits_rounding=8,
+        min_tag_bits=1,
+        max_cache_size=128 * 1024 * 1024):
+    rng = make_rng(rng)
+    while True:
+        num_ways = rng.randint(min_ways, max_ways)
+        way_bits = int(math.log2(num_ways)) + 1
+        index_bits = rng.randint(min_sets_log, max_sets_log)
+        num_sets = 1 << index_bits
+        offset_bits = rng.randint(min_block_size_log, max_block_size_log)
+        block_size = 1 << offset_bits
+        min_tag_bits = max(min_tag_bits, way_bits)
+        min_address_bits = max(min_address_bits, index_bits + offset_bits + min_tag_bits)
+        address_bits = rng.randint(min_address_bits, max_address_bits)
+        if address_bits % address_bits_rounding > 0:
+            address_bits += address_bits_rounding - (address_bits % address_bits_rounding)
+        cache_size = num_ways * block_size * num_sets
+        if cache_size < max_cache_size:
+            break
+    return CacheGeometry(num_ways=num_ways, num_sets=num_sets, block_size=block_size, address_bits=address_bits)
+
+# limits on random_geometry() for pattern questions
+PATTERN_GEOMETRY_LIMITS = dict(
+    min_ways=2, max_ways=3,
+    min_sets_log=3, max_sets_log=6,
+    min_block_size_log=2, max_block_size_log=3,
+    min_address_bits=12, max_address_bits=12,
+    address_bits_rounding=4,
+)
+
+def random_geometry_for_pattern(rng=None):
+    return random_geometry(rng, **PATTERN_GEOMETRY_LIMITS)
+
+def pattern_geometries():
+    """Every geometry random_geometry_for_pattern() can return."""
+    limits = PATTERN_GEOMETRY_LIMITS
+    result = []
+    for num_ways in range(limits['min_ways'], limits['max_ways'] + 1):
+        way_bits = int(math.log2(num_ways)) + 1
+        for index_bits in range(limits['min_sets_log'], limits['max_sets_log'] + 1):
+            for offset_bits in range(limits['min_block_size_log'], limits['max_block_size_log'] + 1):
+                min_address_bits = max(limits['min_address_bits'], index_bits + offset_bits + max(1, way_bits))
+                rounding = limits['address_bits_rounding']
+                address_bits_choices = set(
+                    address_bits + (-address_bits % rounding)
+                    for address_bits in range(min_address_bits, max(min_address_bits, limits['max_address_bits']) + 1)
+                )
+                for address_bits in sorted(address_bits_choices):
+                    result.append(CacheGeometry(num_ways, 1 << index_bits, 1 << offset_bits, address_bits))
+    return result
+
+def parameter_sweep_cases(trials=6):
+    """
+    Yield (geometry, seed, start_actions) for patterns over many small cache
+    geometries, with start actions using every kind of access; the workload
+    of tests.PatternQuestionTest.test_generate_parameter_sweep and the
+    benchmark_patterns command.
+    """
+    for offset_bits in range(0, 4):
+        for index_bits in range(0, 4):
+            for ways in range(1, 4):
+                for address_bits in range(offset_bits + index_bits + ways + 1, offset_bits + index_bits + 6):
+                    geometry = CacheGeometry(ways, 1 << index_bits, 1 << offset_bits, address_bits)
+                    start_actions = ['random_miss'] + (['setup_conflict_aggressive'] * ways) + ['conflict_miss'] + \
+                                    ['hit', 'random_miss', 'conflict_miss', 'hit', 'hit']
+                    for trial in range(trials):
+                        yield (geometry, trial, start_actions)
+
+all_cache_question_parameters = [
+    'tag_bits',
+    'index_bits',
+    'offset_bits',
+    'cache_size_bytes',
+    'num_sets',
+    'num_ways',
+    'block_size',
+    'set_size_bytes',
+    'way_size_bytes',
+    'address_bits',
+]
+
+def _can_find_parameters_from(given_parts):
+    known_parts = given_parts
+    done = False
+    equations = [
+        set(['block_size', 'offset_bits']),
+        set(['index_bits', 'num_sets']),
+        set(['block_size', 'set_size_bytes', 'num_ways']),
+        set(['block_size', 'num_ways', 'num_sets', 'cache_size_bytes']),
+        set(['tag_bits', 'index_bits', 'offset_bits', 'address_bits']),
+        set(['cache_size_bytes', 'set_size_bytes', 'num_sets']),
+        set(['cache_size_bytes', 'way_size_bytes', 'num_ways']),
+    ]
+    while not done:
+        done = True
+        for equation in equations:
+            if len(known_parts & equation) == len(equation) - 1:
+                known_parts |= equation
+                done = False
+    return len(known_parts) == len(all_cache_question_parameters)
+
+def _all_subsets(lst):
+    iters = []
+    for i in range(len(lst)):
+        iters.append(itertools.combinations(lst, i))
+    return map(frozenset, itertools.chain(*iters))
+
+def _get_cache_givens_to_ask():
+    possible = set()
+    for givens in _all_subsets(all_cache_question_parameters):
+        if _can_find_parameters_from(givens):
+            possible.add(givens)
+    filtered = set()
+    for givens in possible:
+        can_trim = False
+        for item in givens:
+            if givens - set([item]) in possible:
+                can_trim = True
+        if not can_trim:
+            filtered.add(givens)
+    logger.debug('all_cache_given_sets = %s', filtered)
+    # in a fixed order (not set order, which varies between processes) so seeded generation is repeatable
+    return sorted(filtered, key=sorted)
+
+all_cache_given_sets = _get_cache_givens_to_ask()
+
+def random_given_parts(rng=None):
+    """Choose which of all_cache_question_parameters a parameter question gives."""
+    given = make_rng(rng).choice(all_cache_given_sets)
+    return [part for part in all_cache_question_parameters if part in given]
+
+class GeneratedParameterQuestion():
+    """A parameter question from generate_parameter_question, not yet given to anyone."""
+    def __init__(self, geometry, given_parts):
+        self.geometry = geometry
+        self.given_parts = given_parts
+
+    @property
+    def missing_parts(self):
+        return [part for part in all_cache_question_parameters if part not in self.given_parts]
+
+def generate_parameter_question(rng=None):
+    rng = make_rng(rng)
+    given_parts = random_given_parts(rng)
+    return GeneratedParameterQuestion(random_geometry(rng), given_parts)
+
+class GeneratedPattern():
+    """
+    An access pattern from generate_pattern, with its expected results, the
+    final cache state and the number of misses with optimal replacement.
+    """
+    def __init__(self, geometry, access_size, replacement_policy, accesses, results, final_state, optimal_misses):
+        self.geometry = geometry
+        self.access_size = access_size
+        self.replacement_policy = replacement_policy
+        self.accesses = accesses
+        self.results = results
+        self.final_state = final_state
+        self.optimal_misses = optimal_misses
+
+def generate_pattern(parameters,
+        rng=None,
+        num_accesses=14,
+        start_actions=None,
+        access_size=2,
+        replacement_policy='lru',
+        chance_setup_conflict_aggressive=0,
+        chance_setup_conflict=0.5,
+        chance_conflict_miss=0.5,
+        chance_hit=1.5,
+        chance_random_miss=1,
+        chance_miss_prefer_empty=0,
+        chance_miss_prefer_used=0.5):
+    """
+    Generate a psuedorandom access pattern.
+
+    Takes relative frequencies of the types of accesses (on average, chosen randomly) and a fixed pattern
+    to start with.
+
+    The access types:
+    * random_miss --- a cache miss, by choosing a random address, with fallback to explicitly searching for
+        a missing address
+    * miss_prefer_empty --- a cache miss, in an empty set if possible
+    * miss_prefer_used --- a cache miss, in a used set if possible, with a preference to avoid conflict misses
+    * conflict_miss --- a cache miss to a previously evicted block
+    * setup_conflict --- a cache miss to an already-accessed set
+    * setup_conflict_aggressive --- a cache miss to a most-full already accessed set
+    * hit_lru --- a cache hit to a LRU item (for other replacement policies, the item which would
+        be replaced next)
+
+    replacement_policy names one of replacement.POLICIES.
+    """
+    DEFAULT_START_ACTIONS = ['random_miss', 'setup_conflict_aggressive', 'hit_lru', 'setup_conflict_aggressive', 'setup_conflict_aggressive', 'random_miss']
+    if start_actions == None:
+        start_actions = DEFAULT_START_ACTIONS
+    MAX_TRIES = 20
+    rng = make_rng(rng)
+    parameters = CacheGeometry.of(parameters)
+    accesses =  []
+    results = []
+    state = CacheState(parameters, policy=replacement_policy)
+    would_hit = RandomSet(rng=rng)
+    would_miss = RandomSet(rng=rng)  # miss AND previously accessed
+    used_indices = RandomSet(rng=rng)
+    # accesses to each used set, up to num_ways, and the sets with each count
+    used_by_count = {}
+    indices_by_count = {count: RandomSet(rng=rng) for count in range(1, parameters.num_ways + 1)}
+    # the block in each set that would be replaced next (for hit_lru)
+    lru_block_for_index = {}
+    lru_blocks = RandomSet(rng=rng)
+    tag_bits = parameters.tag_bits
+    index_bits = parameters.index_bits
+    offset_bits = parameters.offset_bits
+    address_bits = parameters.address_bits
+    # indices in a random order, skipping used ones (used_indices only grows)
+    unused_index_sampler = UnusedSampler(index_bits, rng)
+    # for each index that needed one, tags in a random order, skipping
+    # accessed blocks (every accessed block is in would_hit or would_miss)
+    unused_tag_samplers = {}
+    def _find_unused_miss():
+        if len(used_indices) != parameters.num_sets:
+            for _ in range(MAX_TRIES):
+                index = rng.randrange(0, 1 << index_bits)
+                if index not in used_indices:
+                    tag = rng.randrange(0, 1 << tag_bits)
+                    return parameters.unsplit_address(tag, index, 0)
+            index = unused_index_sampler.next(used_indices.__contains__)
+            tag = rng.randrange(0, 1 << tag_bits)
+            return parameters.unsplit_address(tag, index, 0)
+        else:
+            return None
+
+    def _find_unaccessed_for_index(index):
+        sampler = unused_tag_samplers.get(index)
+        if sampler == None:
+            sampler = unused_tag_samplers[index] = UnusedSampler(tag_bits, rng)
+        def _is_accessed(tag):
+            block_address = parameters.unsplit_address(tag, index, 0)
+            return block_address in would_hit or block_address in would_miss
+        tag = sampler.next(_is_accessed)
+        if tag == None:
+            return None
+        return parameters.unsplit_address(tag, index, 0)
+
+    def _find_miss_for_index(index, prefer_non_conflict=True):
+        if prefer_non_conflict:
+            # first try to find a random non-conflict miss
+            for _ in range(MAX_TRIES):
+                tag = rng.randrange(0, 1 << parameters.tag_bits)
+                block_address = parameters.unsplit_address(tag, index, 0)
+                if block_address in would_hit or block_address in would_miss:
+                    continue
+                return block_address
+        # then try to find a random maybe-conflict-miss
+        for _ in range(MAX_TRIES):
+            tag = rng.randrange(0, 1 << parameters.tag_bits)
+            block_address = parameters.unsplit_address(tag, index, 0)
+            if block_address in would_hit:
+                continue
+            return block_address
+        # then take a tag never used with this index
+        block_address = _find_unaccessed_for_index(index)
+        if block_address != None:
+            return block_address
+        # every tag was used with this index, so there are few enough to list
+        possible_blocks = []
+        for tag in range(0, 1 << parameters.tag_bits):
+            block_address = parameters.unsplit_address(tag, index, 0)
+            if block_address not in would_hit:
+                possible_blocks.append(block_address)
+        return rng.choice(possible_blocks)
+
+    def _find_used_miss():
+        if len(used_indices) == 0:
+            return rng.randrange(0, 1 << address_bits)
+        index = used_indices.choice()
+        return _find_miss_for_index(index)
+
+    def _find_random_miss():
+        for _ in range(MAX_TRIES):
+            address = rng.randrange(0, 1 << address_bits)
+            address &= ~(access_size - 1)
+            (tag, index, _) = parameters.split_address(address)
+            block_address = parameters.unsplit_address(tag, index, 0)
+            if block_address not in would_hit:
+                return block_address
+        # fallback to other mechanisms
+        address = _find_unused_miss()
+        if address == None:
+            address = _find_used_miss()
+        return address
+
+    def _find_hit_lru():
+        if len(lru_blocks) > 0:
+            return lru_blocks.choice()
+        else:
+            return would_hit.choice()
+
+    def _find_setup_conflict_aggressive():
+        # prefer the most-used set that is not full
+        for count in range(parameters.num_ways - 1, 0, -1):
+            if len(indices_by_count[count]) > 0:
+                break
+        else:
+            count = parameters.num_ways
+        logger.debug('looking for count %s', count)
+        if len(indices_by_count[count]) == 0:
+            return _find_random_miss()
+        index = indices_by_count[count].choice()
+        return _find_miss_for_index(index, prefer_non_conflict=False)
+
+    for i in range(num_accesses):
+        if i < len(start_actions):
+            access_kind = start_actions[i]
+        else:
+            possible = ['random_miss']
+            possible_weights = [chance_random_miss]
+            possible.append('miss_prefer_empty')
+            possible_weights.append(chance_miss_prefer_empty)
+            possible.append('miss_prefer_used')
+            possible_weights.append(chance_miss_prefer_used)
+            if len(would_hit) > 0:
+                possible.append('hit')
+                possible_weights.append(chance_hit)
+                possible.append('setup_conflict_aggressive')
+                possible_weights.append(chance_setup_conflict_aggressive)
+                possible.append('setup_conflict')
+                possible_weights.append(chance_setup_conflict)
+            if len(would_miss) > 0:
+                possible.append('conflict_miss')
+                possible_weights.append(chance_conflict_miss)
+            access_kind = _random_weighted(possible, possible_weights, rng)
+        logger.debug('chosen access kind is %s', access_kind)
+        if access_kind == 'random_miss':
+            address = _find_random_miss()
+        elif access_kind == 'miss_prefer_empty':
+            address = _find_unused_miss()
+            if address == None:
+                address = _find_random_miss()
+        elif access_kind == 'miss_prefer_used':
+            address = _find_used_miss()
+        elif access_kind == 'hit_lru':
+            address = _find_hit_lru()
+        elif access_kind == 'hit':
+            address = would_hit.choice()
+        elif access_kind == 'conflict_miss':
+            address = would_miss.choice()
+        elif access_kind == 'setup_conflict_aggressive':
+            address = _find_setup_conflict_aggressive()
+        elif access_kind == 'setup_conflict':
+            base_address = would_hit.choice()
+            (_, index, _) = parameters.split_address(base_address)
+            address = _find_miss_for_index(index, prefer_non_conflict=False)
+        else:
+            raise Exception("Could not identify access type")
+        assert address != None, 'no address generated for kind {}'.format(access_kind)
+        without_offset = parameters.drop_offset(address)
+        (tag, index, _) = parameters.split_address(address)
+        new_offset = rng.randrange(0, 1 << offset_bits) & ~(access_size - 1)
+        address = without_offset | new_offset
+        accesses.append(CacheAccess(address=address, size=access_size, kind=access_kind))
+        access_result = state.apply_access(accesses[-1])
+        results.append(access_result)
+        (new_tag, new_index, _) = parameters.split_address(address)
+        assert tag == new_tag
+        assert index == new_index
+        used_indices.add(index)
+        old_count = used_by_count.get(index, 0)
+        new_count = min(old_count + 1, parameters.num_ways)
+        if new_count != old_count:
+            if old_count > 0:
+                indices_by_count[old_count].discard(index)
+            indices_by_count[new_count].add(index)
+            used_by_count[index] = new_count
+        would_hit.add(without_offset)
+        would_miss.discard(without_offset)
+        if access_result.evicted.value != None:
+            would_miss.add(access_result.evicted.value)
+            would_hit.discard(access_result.evicted.value)
+        # only the accessed set's replacement order changed
+        old_lru_block = lru_block_for_index.get(index)
+        new_lru_block = state.next_victim(index)
+        if old_lru_block != new_lru_block:
+            lru_blocks.discard(old_lru_block)
+            lru_blocks.add(new_lru_block)
+            lru_block_for_index[index] = new_lru_block
+    return GeneratedPattern(
+        parameters, access_size, replacement_policy, accesses, results, state,
+        count_optimal_misses(parameters, accesses),
+    )
\ No newline at end of file
@@ -0,0 +1,170 @@
+# Simulates a multi-level cache hierarchy (L1, L2, ...) as a pipeline of
+# generators.
+#
+# Each level consumes a stream of requests from the level above and yields the
+# requests it cannot satisfy itself to the level below, so only the (usually
+# much smaller) miss and writeback stream of a level ever reaches the next one,
+# and nothing is materialized between levels. A request is a tuple
+# (kind, address, dirty): FETCH asks for the block containing address (for
+# the first level, dirty is whether the access is a write); EVICT hands a
+# block being removed from the level above to the level below.
+#
+# All levels are write-back and write-allocate. In an inclusive hierarchy every
+# block in a level is also in the levels below it: EVICT carries only dirty
+# blocks, and a level evicting a block invalidates it in the levels above
+# (merging in their dirty data). In an exclusive hierarchy a block is in at most
+# one level: fills from memory go to the first level only, a hit in a lower
+# level moves the block up to the first level, and every block evicted from a
+# level (clean or dirty) is inserted into the level below.
+
+from .simulation import CacheState
+
+FETCH = 'fetch'
+EVICT = 'evict'
+
+MODES = ['inclusive', 'exclusive']
+
+class CacheLevel():
+    """One level of a CacheHierarchy: its CacheState and counts of what happened to it."""
+    def __init__(self, params, policy='lru'):
+        self.params = params
+        self.state = CacheState(params, policy=policy)
+        # hits and misses count FETCH requests (for the first level, accesses)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # dirty blocks evicted from this level
+        self.writebacks = 0
+        # blocks removed to keep an inclusive hierarchy inclusive
+        self.invalidations = 0
+
+    @property
+    def accesses(self):
+        return self.hits + self.misses
+
+class CacheHierarchy():
+    """
+    A hierarchy of caches, first level first, described by a list of
+    CacheParameters. Block sizes may not shrink away from the first level,
+    and must all be equal for an exclusive hierarchy.
+
+    State and counts persist between calls to run(), so a long trace can be
+    replayed in pieces.
+    """
+    def __init__(self, parameters_list, mode='inclusive', policy='lru'):
+        if mode not in MODES:
+            raise ValueError('unknown hierarchy mode {!r}'.format(mode))
+        if len(parameters_list) == 0:
+            raise ValueError('need at least one level')
+        block_sizes = [params.block_size for params in parameters_list]
+        if block_sizes != sorted(block_sizes):
+            raise ValueError('block sizes cannot decrease from one level to the next')
+        if mode == 'exclusive' and len(set(block_sizes)) != 1:
+            raise ValueError('all levels of an exclusive hierarchy must have the same block size')
+        self.mode = mode
+        self.levels = [CacheLevel(params, policy=policy) for params in parameters_list]
+        self.memory_reads = 0
+        self.memory_writes = 0
+
+    def memory_requests(self, accesses):
+        """
+        Return a generator of the requests reaching memory for the CacheAccesses
+        in accesses, which are consumed (and the levels updated) only as the
+        result is iterated.
+        """
+        requests = ((FETCH, access.address, access.is_write) for access in accesses)
+        for position in range(len(self.levels)):
+            if self.mode == 'inclusive':
+                requests = self._inclusive_level(position, requests)
+            elif position == 0:
+                requests = self._exclusive_first_level(requests)
+            else:
+                requests = self._exclusive_level(position, requests)
+        return requests
+
+    def run(self, accesses):
+        for kind, _, dirty in self.memory_requests(accesses):
+            if kind == FETCH:
+                self.memory_reads += 1
+            elif dirty:
+                self.memory_writes += 1
+        return self
+
+    def _invalidate_above(self, position, address):
+        """Remove the block at address from the levels above position, returning whether any copy was dirty."""
+        dirty = False
+        block_size = self.levels[position].params.block_size
+        for level in self.levels[:position]:
+            for inner_address in range(address, address + block_size, level.params.block_size):
+                inner_dirty = level.state.invalidate(inner_address)
+                if inner_dirty != None:
+                    level.invalidations += 1
+                    dirty = dirty or inner_dirty
+        return dirty
+
+    def _inclusive_level(self, position, requests):
+        level = self.levels[position]
+        state = level.state
+        for kind, address, dirty in requests:
+            if kind == EVICT:
+                # a writeback from the level above; inclusion means we normally have the block
+                if not state.mark_dirty(address):
+                    yield (EVICT, address, True)
+                continue
+            (was_hit, evicted, evicted_dirty) = state.access_address(address, dirty)
+            if was_hit:
+                level.hits += 1
+                continue
+            level.misses += 1
+            if evicted != None:
+                level.evictions += 1
+                if position > 0 and self._invalidate_above(position, evicted):
+                    evicted_dirty = True
+                if evicted_dirty:
+                    level.writebacks += 1
+                    yield (EVICT, evicted, True)
+            yield (FETCH, address, False)
+
+    def _exclusive_first_level(self, requests):
+        level = self.levels[0]
+        state = level.state
+        for _, address, is_write in requests:
+            (was_hit, evicted, evicted_dirty) = state.access_address(address, is_write)
+            if was_hit:
+                level.hits += 1
+                continue
+            level.misses += 1
+            # fetch before passing on the victim, so the victim cannot displace the block being fetched
+            yield (FETCH, address, False)
+            if evicted != None:
+                level.evictions += 1
+                if evicted_dirty:
+                    level.writebacks += 1
+                yield (EVICT, evicted, evicted_dirty)
+
+    def _exclusive_level(self, position, requests):
+        level = self.levels[position]
+        state = level.state
+        first_state = self.levels[0].state
+        for kind, address, dirty in requests:
+            if kind == FETCH:
+                # the first level has already allocated the block; move it there
+                moved_dirty = state.invalidate(address)
+                if moved_dirty == None:
+                    level.misses += 1
+                    yield (FETCH, address, False)
+                else:
+                    level.hits += 1
+                    if moved_dirty:
+                        first_state.mark_dirty(address)
+                continue
+            (_, evicted, evicted_dirty) = state.access_address(address, dirty)
+            if evicted != None:
+                level.evictions += 1
+                if evicted_dirty:
+                    level.writebacks += 1
+                yield (EVICT, evicted, evicted_dirty)
+
+def simulate_hierarchy(parameters_list, accesses, mode='inclusive', policy='lru'):
+    """Replay accesses against an initially empty hierarchy and return it."""
+    return CacheHierarchy(parameters_list, mode=mode, policy=policy).run(accesses)
@@ -0,0 +1,41 @@
+# A generation number shared by all the server processes, for the caches
+# each process keeps of rows that are normally never changed or deleted
+# (pattern_cache.PatternCache and the CacheParameters registry in
+# models.py). Deleting such rows must call bump_generation(); the caches
+# compare the current generation with the one their entries were loaded
+# under, and drop their entries when it differs.
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+GENERATION_KEY = 'cachelab-pattern-generation'
+
+def shared_cache():
+    """The Django cache shared by the server processes: the 'patterns' entry of settings.CACHES, if there is one."""
+    if 'patterns' in getattr(settings, 'CACHES', {}):
+        return caches['patterns']
+    return caches['default']
+
+def _new_generation():
+    # not a counter starting from 0, so a generation lost from the shared
+    # cache is not reused while processes still have entries from it
+    return int(time.time() * 1000)
+
+def current_generation(shared=None):
+    if shared == None:
+        shared = shared_cache()
+    generation = shared.get(GENERATION_KEY)
+    if generation == None:
+        shared.add(GENERATION_KEY, _new_generation(), timeout=None)
+        generation = shared.get(GENERATION_KEY)
+    return generation
+
+def bump_generation(shared=None):
+    if shared == None:
+        shared = shared_cache()
+    try:
+        shared.incr(GENERATION_KEY)
+    except ValueError:
+        shared.set(GENERATION_KEY, _new_generation(), timeout=None)
@@ -0,0 +1,109 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cachelab.generation import parameter_sweep_cases
+from cachelab.models import CacheAccessResult, CacheParameters, CachePattern, PatternQuestion
+
+import gc
+import random
+import time
+import tracemalloc
+
+class _Rollback(Exception):
+    pass
+
+def _parameter_sweep():
+    for geometry, seed, start_actions in parameter_sweep_cases():
+        parameters = CacheParameters.for_geometry(geometry)
+        random.seed(seed)
+        question = PatternQuestion.generate_random(parameters, 'benchmark',
+            num_accesses=len(start_actions),
+            start_actions=start_actions
+        )
+        question.pattern.accesses
+        question.pattern.access_results
+
+class _Unslotted():
+    """Holds a copy of a value type's attributes in a __dict__, as the value types did before __slots__."""
+
+def _copy_values(value, slotted):
+    """Copy value and the value types inside it, keeping __slots__ if slotted; other attributes are shared."""
+    slots = [name for cls in type(value).__mro__ for name in getattr(cls, '__slots__', ())]
+    if len(slots) == 0:
+        return value
+    copy = object.__new__(type(value)) if slotted else _Unslotted()
+    for name in slots:
+        if hasattr(value, name):
+            setattr(copy, name, _copy_values(getattr(value, name), slotted))
+    return copy
+
+def _traced_size(make):
+    gc.collect()
+    tracemalloc.start()
+    result = make()
+    (memory, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (memory, result)
+
+class Command(BaseCommand):
+    help = 'Time pattern generation and measure the memory used by decoded patterns (nothing is saved)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--accesses', type=int, default=1000,
+            help='number of accesses in the pattern used to measure memory')
+
+    def handle(self, *args, **options):
+        best = None
+        for _ in range(options['repeat']):
+            try:
+                with transaction.atomic():
+                    start = time.perf_counter()
+                    _parameter_sweep()
+                    elapsed = time.perf_counter() - start
+                    raise _Rollback()
+            except _Rollback:
+                pass
+            if best == None or elapsed < best:
+                best = elapsed
+        print('parameter sweep: {:.3f} s (best of {})'.format(best, options['repeat']))
+
+        count = options['accesses']
+        try:
+            with transaction.atomic():
+                random.seed(0)
+                parameters = CacheParameters.get(num_ways=4, num_sets=64, block_size=16, address_bits=32)
+                pattern_id = CachePattern.generate_random(parameters, num_accesses=count).pattern_id
+                patterns = [
+                    CachePattern.objects.select_related('parameters').get(pattern_id=pattern_id)
+                    for _ in range(options['repeat'] + 1)
+                ]
+                raise _Rollback()
+        except _Rollback:
+            pass
+        best = None
+        for pattern in patterns[1:]:
+            start = time.perf_counter()
+            pattern.accesses
+            pattern.access_results
+            elapsed = time.perf_counter() - start
+            if best == None or elapsed < best:
+                best = elapsed
+        (memory, _) = _traced_size(lambda: (patterns[0].accesses, patterns[0].access_results))
+        print('decoding {} accesses and results: {:.2f} ms, {} bytes ({:.0f} per access)'.format(
+            count, best * 1000, memory, memory / count,
+        ))
+        # the same objects with and without __slots__, sharing the field values
+        decoded = (patterns[0].accesses, patterns[0].access_results)
+        for slotted in [True, False]:
+            (memory, _) = _traced_size(lambda: [
+                [_copy_values(value, slotted) for value in values] for values in decoded
+            ])
+            print('  value objects {}: {:.0f} bytes per access'.format(
+                'with __slots__' if slotted else 'with __dict__ (baseline)', memory / count,
+            ))
+        start = time.perf_counter()
+        for _ in range(count):
+            CacheAccessResult.empty()
+        elapsed = time.perf_counter() - start
+        print('creating {} empty results: {:.2f} ms'.format(count, elapsed * 1000))
@@ -0,0 +1,70 @@
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cachelab import invalidation
+from cachelab.models import CacheParameters, CachePattern, ParameterAnswer, PatternAnswer, parameters_registry
+
+class Command(BaseCommand):
+    help = (
+        'Delete answers nothing reads (incomplete answers that are not the latest for their question), '
+        'then patterns and cache parameters nothing uses. Best run while no questions are being handed out.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--archive', metavar='FILE',
+            help='append the deleted rows to FILE (JSON lines, which loaddata can read back)')
+        parser.add_argument('--keep-orphans', action='store_true',
+            help='only delete answers, not unused patterns and cache parameters')
+        parser.add_argument('--dry-run', action='store_true', help='only report what would be deleted')
+
+    def delete_batch(self, queryset, pks, options, archive_fh):
+        if options['dry_run']:
+            return len(pks)
+        with transaction.atomic():
+            batch = queryset.filter(pk__in=pks)
+            if archive_fh != None:
+                serializers.serialize('jsonl', batch, stream=archive_fh)
+            (count, _) = batch.delete()
+        return count
+
+    def delete_in_batches(self, name, queryset, pks, options, archive_fh):
+        """
+        Delete the rows of queryset whose pks the query pks returns, reading
+        the pks as they are streamed from the database and rechecking
+        queryset's conditions in each batch.
+        """
+        deleted = 0
+        batch = []
+        for pk in pks.iterator(chunk_size=options['batch_size']):
+            batch.append(pk)
+            if len(batch) >= options['batch_size']:
+                deleted += self.delete_batch(queryset, batch, options, archive_fh)
+                batch = []
+        if batch:
+            deleted += self.delete_batch(queryset, batch, options, archive_fh)
+        print('{}: {} rows {}deleted'.format(name, deleted, 'would be ' if options['dry_run'] else ''))
+        return deleted
+
+    def handle(self, *args, **options):
+        archive_fh = None
+        if options['archive'] != None and not options['dry_run']:
+            archive_fh = open(options['archive'], 'a')
+        try:
+            for model in [ParameterAnswer, PatternAnswer]:
+                self.delete_in_batches(model.__name__, model.objects.all(), model.find_defunct(), options, archive_fh)
+            if options['keep_orphans']:
+                return
+            deleted = 0
+            # patterns first, since deleting them can leave more cache parameters unused
+            for model in [CachePattern, CacheParameters]:
+                pks = model.find_orphans().order_by('pk').values_list('pk', flat=True)
+                deleted += self.delete_in_batches(model.__name__, model.find_orphans(), pks, options, archive_fh)
+            if deleted > 0 and not options['dry_run']:
+                # other processes cache these rows
+                invalidation.bump_generation()
+                parameters_registry.clear()
+        finally:
+            if archive_fh != None:
+                archive_fh.close()
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cachelab.models import PooledQuestion
+
+import multiprocessing
+import random
+import time
+
+def _generate_batch(batch):
+    # may run in a worker process: generation does not touch the database
+    (kind, count, seed) = batch
+    return PooledQuestion.generate_values(kind, count, random.Random(seed))
+
+class Command(BaseCommand):
+    help = 'Generate questions ahead of time, so the web server does not need to when students ask for new ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=200,
+            help='number of unassigned questions of each kind to fill the pool to')
+        parser.add_argument('--low-water', type=int, default=100,
+            help='only refill a kind of question when it has fewer than this many left')
+        parser.add_argument('--kind', action='append', choices=PooledQuestion.KINDS,
+            help='kind of question to generate (default: all)')
+        parser.add_argument('--batch-size', type=int, default=50,
+            help='questions to generate and save at a time')
+        parser.add_argument('--jobs', type=int, default=1,
+            help='number of processes generating questions')
+        parser.add_argument('--loop', type=float, default=None, metavar='SECONDS',
+            help='keep running, checking the pool this often')
+
+    def fill(self, pool, kinds, size, low_water, batch_size):
+        for kind in kinds:
+            count = PooledQuestion.objects.filter(kind=kind).count()
+            if count >= low_water:
+                continue
+            needed = size - count
+            batches = [
+                (kind, min(batch_size, needed - start), random.getrandbits(64))
+                for start in range(0, needed, batch_size)
+            ]
+            if pool != None:
+                generated_batches = pool.imap_unordered(_generate_batch, batches)
+            else:
+                generated_batches = map(_generate_batch, batches)
+            for generated in generated_batches:
+                with transaction.atomic():
+                    PooledQuestion.bulk_create_generated(kind, generated)
+            print('{}: {} -> {} questions'.format(kind, count, size))
+
+    def handle(self, *args, **options):
+        kinds = options['kind'] or PooledQuestion.KINDS
+        pool = None
+        if options['jobs'] > 1:
+            pool = multiprocessing.Pool(options['jobs'])
+        try:
+            while True:
+                self.fill(pool, kinds, options['size'], options['low_water'], options['batch_size'])
+                if options['loop'] == None:
+                    break
+                time.sleep(options['loop'])
+        finally:
+            if pool != None:
+                pool.close()
+                pool.join()
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cachelab.hierarchy import MODES, CacheHierarchy
+from cachelab.models import CacheParameters
+from cachelab.replacement import POLICIES
+from cachelab.traces import TRACE_READERS, open_trace, read_trace
+
+def _parse_level(value, address_bits):
+    try:
+        (num_ways, num_sets, block_size) = [int(item) for item in value.split(':')]
+    except ValueError:
+        raise CommandError('--level must look like WAYS:SETS:BLOCK_SIZE, not {!r}'.format(value))
+    if num_ways <= 0:
+        raise CommandError('way counts must be positive')
+    for item in [num_sets, block_size]:
+        if item <= 0 or item & (item - 1) != 0:
+            raise CommandError('set counts and block sizes must be powers of two')
+    return CacheParameters(num_ways=num_ways, num_sets=num_sets, block_size=block_size, address_bits=address_bits)
+
+class Command(BaseCommand):
+    help = 'Print per-level hit/miss/writeback totals for a trace replayed against a multi-level cache hierarchy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='trace file (- for stdin, .gz files are decompressed)')
+        parser.add_argument('--format', choices=sorted(TRACE_READERS), default='lackey')
+        parser.add_argument('--level', action='append', required=True,
+            help='WAYS:SETS:BLOCK_SIZE of a cache level; repeat for each level, first level first')
+        parser.add_argument('--mode', choices=MODES, default='inclusive')
+        parser.add_argument('--policy', choices=sorted(POLICIES), default='lru')
+        parser.add_argument('--address-bits', type=int, default=64)
+
+    def handle(self, *args, **options):
+        parameters_list = [_parse_level(value, options['address_bits']) for value in options['level']]
+        try:
+            hierarchy = CacheHierarchy(parameters_list, mode=options['mode'], policy=options['policy'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        with open_trace(options['trace']) as fh:
+            hierarchy.run(read_trace(fh, options['format']))
+        for number, level in enumerate(hierarchy.levels, start=1):
+            print('L{} accesses {} hits {} misses {} evictions {} writebacks {} invalidations {}'.format(
+                number, level.accesses, level.hits, level.misses, level.evictions, level.writebacks, level.invalidations,
+            ))
+        print('memory reads', hierarchy.memory_reads)
+        print('memory writes', hierarchy.memory_writes)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cachelab.sweep import StackDistanceSweep
+from cachelab.traces import TRACE_READERS, open_trace, read_trace
+
+import csv
+import sys
+
+def _parse_counts(value):
+    return [int(item) for item in value.split(',') if item != '']
+
+class Command(BaseCommand):
+    help = 'Print a CSV table of LRU miss ratios for several set counts and associativities from one pass over a trace'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='trace file (- for stdin, .gz files are decompressed)')
+        parser.add_argument('--format', choices=sorted(TRACE_READERS), default='lackey')
+        parser.add_argument('--block-size', type=int, required=True)
+        parser.add_argument('--sets', default='1', help='comma-separated list of set counts')
+        parser.add_argument('--ways', default='1,2,4,8', help='comma-separated list of associativities')
+
+    def handle(self, *args, **options):
+        set_counts = _parse_counts(options['sets'])
+        way_counts = _parse_counts(options['ways'])
+        for value in set_counts + [options['block_size']]:
+            if value <= 0 or value & (value - 1) != 0:
+                raise CommandError('block size and set counts must be powers of two')
+        if len(set_counts) == 0 or len(way_counts) == 0 or min(way_counts) <= 0:
+            raise CommandError('need at least one set count and one positive way count')
+        sweep = StackDistanceSweep(options['block_size'], set_counts, max(way_counts))
+        with open_trace(options['trace']) as fh:
+            sweep.add_addresses(access.address for access in read_trace(fh, options['format']))
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['block_size', 'num_sets', 'num_ways', 'cache_size_bytes', 'accesses', 'hits', 'misses', 'miss_ratio'])
+        for num_sets in sweep.set_counts:
+            for num_ways in sorted(set(way_counts)):
+                hits = sweep.hits(num_sets, num_ways)
+                misses = sweep.accesses - hits
+                writer.writerow([
+                    sweep.block_size, num_sets, num_ways, sweep.block_size * num_sets * num_ways,
+                    sweep.accesses, hits, misses,
+                    '{:.6f}'.format(misses / sweep.accesses) if sweep.accesses > 0 else '',
+                ])
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cachelab import encoding
+from cachelab.models import CachePattern
+
+class Command(BaseCommand):
+    help = (
+        'Convert cache patterns stored as JSON to the compact encoding (see cachelab/encoding.py), '
+        'and store the optimal miss count in packed results saved without one'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='only report how much space would be saved')
+
+    def handle(self, *args, **options):
+        fields = ['accesses_raw', 'results_raw', 'final_state_raw']
+        # the optimal miss count is inside the packed results, so rows only missing that are found below
+        legacy = CachePattern.objects.select_related('parameters').order_by('pk')
+        converted = old_size = new_size = 0
+        last_pk = None
+        while True:
+            batch = legacy
+            if last_pk != None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:options['batch_size']])
+            if len(batch) == 0:
+                break
+            last_pk = batch[-1].pk
+            batch = [
+                pattern for pattern in batch
+                if not all(encoding.is_packed(getattr(pattern, field)) for field in fields) or
+                    encoding.unpack_optimal_misses(pattern.results_raw) == None
+            ]
+            with transaction.atomic():
+                for pattern in batch:
+                    old_size += sum(len(getattr(pattern, field)) for field in fields)
+                    # decode (replaying the accesses if needed, without saving the
+                    # results yet, so a dry run changes nothing) and re-encode
+                    pattern.generate_results(write_back=False)
+                    accesses = pattern.accesses
+                    results = pattern.access_results
+                    final_state = pattern.final_state
+                    pattern.accesses = accesses
+                    pattern.set_results(results, final_state)
+                    new_size += sum(len(getattr(pattern, field)) for field in fields)
+                    converted += 1
+                    if not options['dry_run']:
+                        pattern.save(update_fields=fields)
+        print('{} patterns {}converted, {} bytes -> {} bytes'.format(
+            converted, 'would be ' if options['dry_run'] else '', old_size, new_size,
+        ))
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cachelab.batch import BatchSimulator, ParallelSimulator
+from cachelab.misses import MISS_TYPES, MissClassifier
+from cachelab.models import CacheParameters
+from cachelab.traces import TRACE_READERS, address_chunks, open_trace, read_trace
+
+class Command(BaseCommand):
+    help = 'Print hit/miss/eviction totals for a trace file replayed against an LRU cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='trace file (- for stdin, .gz files are decompressed)')
+        parser.add_argument('--format', choices=sorted(TRACE_READERS), default='lackey')
+        parser.add_argument('--ways', type=int, required=True)
+        parser.add_argument('--sets', type=int, required=True)
+        parser.add_argument('--block-size', type=int, required=True)
+        parser.add_argument('--address-bits', type=int, default=64)
+        parser.add_argument('--chunk-size', type=int, default=1 << 16)
+        parser.add_argument('--processes', type=int, default=1,
+            help='number of worker processes to split the sets across (0 for one per CPU)')
+        parser.add_argument('--no-classify', action='store_true',
+            help='do not count compulsory, capacity and conflict misses')
+
+    def handle(self, *args, **options):
+        for name in ['ways', 'sets', 'block_size', 'address_bits']:
+            if options[name] <= 0:
+                raise CommandError('--{} must be positive'.format(name.replace('_', '-')))
+        parameters = CacheParameters(
+            num_ways=options['ways'],
+            num_sets=options['sets'],
+            block_size=options['block_size'],
+            address_bits=options['address_bits'],
+        )
+        for name in ['sets', 'block_size']:
+            value = options[name]
+            if value <= 0 or value & (value - 1) != 0:
+                raise CommandError('--{} must be a power of two'.format(name.replace('_', '-')))
+        if options['processes'] == 1:
+            simulator = BatchSimulator(parameters)
+        else:
+            simulator = ParallelSimulator(parameters, options['processes'] or None)
+        classifier = None if options['no_classify'] else MissClassifier(parameters)
+        accesses = hits = evictions = 0
+        try:
+            with open_trace(options['trace']) as fh:
+                for chunk in address_chunks(read_trace(fh, options['format']), options['chunk_size']):
+                    result = simulator.simulate(chunk)
+                    accesses += len(chunk)
+                    hits += int(result.hit.sum())
+                    evictions += int(result.has_evicted.sum())
+                    if classifier != None:
+                        classifier.classify_all(chunk, result.hit.tolist())
+        finally:
+            if options['processes'] != 1:
+                simulator.close()
+        print('accesses', accesses)
+        print('hits', hits)
+        print('misses', accesses - hits)
+        print('evictions', evictions)
+        if classifier != None:
+            for miss_type in MISS_TYPES:
+                print('{} misses'.format(miss_type), classifier.counts[miss_type])
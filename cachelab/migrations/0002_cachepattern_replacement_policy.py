@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachepattern',
+            name='replacement_policy',
+            field=models.CharField(default='lru', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='patternquestion',
+            name='give_first',
+            field=models.IntegerField(default=6),
+        ),
+    ]
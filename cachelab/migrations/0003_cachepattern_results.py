@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0002_cachepattern_replacement_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachepattern',
+            name='final_state_raw',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='cachepattern',
+            name='results_raw',
+            field=models.TextField(default=''),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0003_cachepattern_results'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledQuestion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('given_parts_raw', models.TextField(default='')),
+                ('parameters', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='cachelab.cacheparameters')),
+                ('pattern', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='cachelab.cachepattern')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'id'], name='cachelab_po_kind_feb5b7_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:46
+
+from django.db import migrations, models
+
+
+def merge_duplicate_parameters(apps, schema_editor):
+    """Point everything using a duplicate CacheParameters row at the oldest row with that geometry, then delete the duplicates."""
+    CacheParameters = apps.get_model('cachelab', 'CacheParameters')
+    referencing = [
+        apps.get_model('cachelab', 'ParameterQuestion'),
+        apps.get_model('cachelab', 'CachePattern'),
+        apps.get_model('cachelab', 'PooledQuestion'),
+    ]
+    kept = {}
+    duplicates = {}
+    for row in CacheParameters.objects.order_by('pk'):
+        key = (row.num_ways, row.num_sets, row.block_size, row.address_bits)
+        if key in kept:
+            duplicates[row.pk] = kept[key]
+        else:
+            kept[key] = row.pk
+    for duplicate_pk, kept_pk in duplicates.items():
+        for model in referencing:
+            model.objects.filter(parameters_id=duplicate_pk).update(parameters_id=kept_pk)
+    CacheParameters.objects.filter(pk__in=list(duplicates)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0004_pooledquestion'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_parameters, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cacheparameters',
+            constraint=models.UniqueConstraint(fields=('num_ways', 'num_sets', 'block_size', 'address_bits'), name='cachelab_cacheparameters_unique_geometry'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0005_cacheparameters_unique_geometry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserProgress',
+            fields=[
+                ('for_user', models.TextField(primary_key=True, serialize=False)),
+                ('parameter_complete', models.IntegerField(default=0)),
+                ('parameter_best_raw', models.TextField(default='[]')),
+                ('last_parameter_index', models.IntegerField(null=True)),
+                ('parameter_in_progress', models.BooleanField(default=False)),
+                ('pattern_complete', models.IntegerField(default=0)),
+                ('pattern_score', models.IntegerField(null=True)),
+                ('pattern_max_score', models.IntegerField(null=True)),
+                ('last_pattern_index', models.IntegerField(null=True)),
+                ('pattern_in_progress', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0006_userprogress'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patternanswer',
+            index=models.Index(fields=['question', 'for_user', 'submit_time'], name='cachelab_pa_questio_7b9a2a_idx'),
+        ),
+    ]
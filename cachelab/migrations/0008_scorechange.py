@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:53
+
+from django.db import migrations, models
+import itertools
+import json
+
+from cachelab import timeline
+
+# models.NEEDED_PARAMETER_PERFECT when this migration was written
+NEEDED_PARAMETER_PERFECT = 3
+
+
+def _by_user(answers):
+    return itertools.groupby(answers, key=lambda answer: answer[0])
+
+
+def fill_score_timelines(apps, schema_editor):
+    """Sweep every user's existing complete answers into ScoreChange rows."""
+    ParameterAnswer = apps.get_model('cachelab', 'ParameterAnswer')
+    PatternAnswer = apps.get_model('cachelab', 'PatternAnswer')
+    ScoreChange = apps.get_model('cachelab', 'ScoreChange')
+    parameter_answers = dict(
+        (user, [
+            (submit_time, score_ratio, score, len(json.loads(missing_parts_raw)))
+            for _, submit_time, score_ratio, score, missing_parts_raw in answers
+        ])
+        for user, answers in _by_user(ParameterAnswer.objects.filter(was_complete=True).order_by(
+            'for_user', 'submit_time'
+        ).values_list('for_user', 'submit_time', 'score_ratio', 'score', 'question__missing_parts_raw').iterator())
+    )
+    pattern_answers = dict(
+        (user, [answer[1:] for answer in answers])
+        for user, answers in _by_user(PatternAnswer.objects.filter(was_complete=True).order_by(
+            'for_user', 'submit_time'
+        ).values_list('for_user', 'submit_time', 'score', 'max_score').iterator())
+    )
+    changes = []
+    for user in set(parameter_answers) | set(pattern_answers):
+        answers = timeline.merge_answers(parameter_answers.get(user, []), pattern_answers.get(user, []))
+        for change_time, parameter_scores, pattern_score in timeline.sweep(answers, NEEDED_PARAMETER_PERFECT):
+            change = ScoreChange(
+                for_user=user,
+                change_time=change_time,
+                parameter_scores_raw=json.dumps([list(item) for item in parameter_scores]),
+            )
+            if pattern_score != None:
+                (change.pattern_score, change.pattern_max_score) = pattern_score
+            changes.append(change)
+    ScoreChange.objects.bulk_create(changes, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cachelab', '0007_patternanswer_question_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('for_user', models.TextField()),
+                ('change_time', models.DateTimeField()),
+                ('parameter_scores_raw', models.TextField(default='[]')),
+                ('pattern_score', models.IntegerField(null=True)),
+                ('pattern_max_score', models.IntegerField(null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['for_user', 'change_time'], name='cachelab_sc_for_use_1361c9_idx')],
+            },
+        ),
+        migrations.RunPython(fill_score_timelines, migrations.RunPython.noop),
+    ]
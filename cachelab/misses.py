@@ -0,0 +1,59 @@
+# Classifies cache misses as compulsory, capacity or conflict misses (the
+# "three Cs", Hill 1987).
+#
+# A miss is compulsory if its block was never accessed before. Otherwise it
+# is a capacity miss if a fully associative LRU cache with the same number of
+# blocks would also have missed, and a conflict miss if that cache would have
+# hit. The fully associative "shadow" cache is an OrderedDict of block
+# numbers from least to most recently used, so each access costs a hash
+# lookup and a move to the end regardless of the cache size.
+
+import collections
+import math
+
+COMPULSORY = 'compulsory'
+CAPACITY = 'capacity'
+CONFLICT = 'conflict'
+
+MISS_TYPES = [COMPULSORY, CAPACITY, CONFLICT]
+
+class MissClassifier():
+    """
+    Tracks the accesses to a cache with the given parameters (only
+    block_size, num_sets and num_ways are used). Every access, hit or
+    miss, must be passed to classify() in order.
+    """
+    def __init__(self, parameters):
+        self.offset_bits = int(math.log2(parameters.block_size))
+        self.capacity = parameters.num_sets * parameters.num_ways
+        self._shadow = collections.OrderedDict()
+        self._seen = set()
+        self.counts = {miss_type: 0 for miss_type in MISS_TYPES}
+
+    def classify(self, address, was_hit):
+        """Return the type of miss of an access to address, or None if was_hit."""
+        block = address >> self.offset_bits
+        shadow = self._shadow
+        shadow_hit = block in shadow
+        if shadow_hit:
+            shadow.move_to_end(block)
+        else:
+            shadow[block] = None
+            if len(shadow) > self.capacity:
+                shadow.popitem(last=False)
+        first_touch = block not in self._seen
+        if first_touch:
+            self._seen.add(block)
+        if was_hit:
+            return None
+        if first_touch:
+            miss_type = COMPULSORY
+        elif shadow_hit:
+            miss_type = CONFLICT
+        else:
+            miss_type = CAPACITY
+        self.counts[miss_type] += 1
+        return miss_type
+
+    def classify_all(self, addresses, hits):
+        return [self.classify(address, was_hit) for address, was_hit in zip(addresses, hits)]
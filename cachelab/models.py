@@ -1,343 +1,176 @@
-from django.db import models
-from django.db.models import F
-import bisect
-import itertools
+from django.db import models, transaction
+from django.db.models import Exists, F, OuterRef, Subquery, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
 import json
 import logging
-import math
 import random
+import threading
+import time
 import uuid
 
-logger = logging.getLogger('cachelab')
-
-class CacheAccess():
-    def __init__(self, address, size=1, kind=None, type='R'):
-        self.address = address
-        self.size = size
-        self.kind = kind
-
-    @property
-    def address_hex(self):
-        return hex(self.address)
-
-    @property
-    def is_write(self):
-        return False
-
-    @property
-    def is_read(self):
-        return True
-
-    def as_dump(self):
-        return {
-            'address': self.address,
-            'size': self.size,
-            'kind': self.kind,
-        }
-
-    def __repr__(self):
-        return 'CacheAccess[0x{:x},kind={},size={}]'.format(self.address, self.kind, self.size)
-
-    def __eq__(self, other):
-        return self.address == other.address and self.size == other.size
-
-def format_hex(value, bits=None):
-    if value == None:
-        return ''
-    elif bits != None:
-        width = int((bits + 3) / 4)
-        return '0x{:0{width}x}'.format(value, width=width)
-    else:
-        return '0x{:x}'.format(value)
-
-class ResultItem():
-    def __init__(self, value, string=None, invalid=False, correct=True):
-        self.value = value
-        self.string = string
-        self.invalid = invalid
-        self.correct = correct
-
-    @staticmethod
-    def empty_invalid():
-        return ResultItem(None, string='', invalid=True, correct=False)
-
-    def __repr__(self):
-        return '{} ({},invalid={},correct={})'.format(
-            str(self.string),
-            hex(self.value) if self.value != None else '(none)',
-            str(self.invalid),
-            str(self.correct),
-        )
-
-    def __eq__(self, other):
-        return (
-            self.string == other.string and
-            self.value == other.value and
-            self.invalid == other.invalid and
-            self.correct == other.correct
-        )
-
-class CacheAccessResult():
-    @staticmethod
-    def from_reference(hit, tag, index, offset, evicted, tag_bits=None, index_bits=None, offset_bits=None, address_bits=None):
-        self = CacheAccessResult()
-        self.hit = ResultItem(value=hit)
-        self.tag = ResultItem(value=tag, string=format_hex(tag, tag_bits))
-        self.index = ResultItem(value=index, string=format_hex(index, index_bits))
-        self.offset = ResultItem(value=offset, string=format_hex(offset, offset_bits))
-        self.evicted = ResultItem(value=evicted, string=format_hex(evicted, address_bits))
-        return self
-
-    @staticmethod
-    def empty():
-        self = CacheAccessResult()
-        self.hit = ResultItem(None, string='', invalid=True)
-        self.tag = ResultItem(None, string='', invalid=True)
-        self.index = ResultItem(None, string='', invalid=True)
-        self.offset = ResultItem(None, string='', invalid=True)
-        self.evicted = ResultItem(None, string='', invalid=True)
-        return self
-
-    def set_from_string(self, key, value):
-        int_value = value_from_hex(value)
-        self.__dict__[key] = ResultItem(
-            value=int_value,
-            string=value,
-            invalid=int_value==None,
-            correct=None
-        )
-        return int_value != None
-
-    def set_bool(self, key, value):
-        self.__dict__[key] = ResultItem(
-            value=value,
-            invalid=False,
-            correct=None
-        )
-
-    def set_invalid(self, key):
-        self.__dict__[key] = ResultItem(
-            value=None,
-            invalid=True,
-            correct=None
-        )
-
-    def as_dump_reference(self):
-        return {
-            'hit': self.hit.value,
-            'tag': self.tag.value,
-            'index': self.index.value,
-            'offset': self.offset.value,
-            'evicted': self.evicted.value
-        }
-    
-    def as_dump(self):
-        return {
-            'hit': vars(self.hit),
-            'tag': vars(self.tag),
-            'index': vars(self.index),
-            'offset': vars(self.offset),
-            'evicted': vars(self.evicted),
-        }
-
-    def __repr__(self):
-        return 'CacheAccessResult[hit={},tag={},index={},offset={},evicted={}]'.format(
-            repr(self.hit),
-            repr(self.tag),
-            repr(self.index),
-            repr(self.offset),
-            repr(self.evicted),
-        )
+from . import encoding, invalidation, timeline
+from .generation import (
+    GeneratedParameterQuestion, GeneratedPattern, RandomSet, all_cache_given_sets, all_cache_question_parameters,
+    generate_parameter_question, generate_pattern, make_rng, pattern_geometries, random_geometry,
+    random_geometry_for_pattern, random_given_parts,
+)
+from .misses import MissClassifier
+from .replacement import POLICIES, OptimalPolicy, make_policy, next_use_indices
+from .simulation import (
+    SPARSE_STATE_THRESHOLD, CacheAccess, CacheAccessResult, CacheEntry, CacheGeometry, CacheGeometryMixin,
+    CacheState, ResultItem, count_optimal_misses, format_hex, value_from_hex,
+)
 
-    def __eq__(self, other):
-        return (
-            self.hit == other.hit and
-            self.tag == other.tag and
-            self.index == other.index and
-            self.offset == other.offset and
-            self.evicted == other.evicted
-        )
-
-class CacheEntry():
-    def __init__(self, data):
-        self.valid = data['valid']
-        self.lru = data['lru']
-        if self.valid:
-            self.tag = data['tag']
-            self.dirty = data['dirty']
-        else:
-            self.tag = self.dirty = None
-
-    def as_dump(self):
-        return {
-            'valid': self.valid,
-            'tag': self.tag,
-            'lru': self.lru,
-            'dirty': self.dirty
-        }
+logger = logging.getLogger('cachelab')
 
-    def __repr__(self):
-        return 'CacheEntry(%s)' % (self.as_dump())
+# complete parameter answers that need to be perfect
+NEEDED_PARAMETER_PERFECT = 3
 
-class CacheParameters(models.Model):
+class CacheParameters(CacheGeometryMixin, models.Model):
     num_ways = models.IntegerField(default=2)
     num_sets = models.IntegerField(default=4)
     block_size = models.IntegerField(default=8)
     address_bits = models.IntegerField(default=8)
     # FIXME: is_writeback support
 
-    @property
-    def offset_bits(self):
-        return int(math.log2(self.block_size))
-    
-    @property
-    def index_bits(self):
-        return int(math.log2(self.num_sets))
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['num_ways', 'num_sets', 'block_size', 'address_bits'],
+                name='cachelab_cacheparameters_unique_geometry',
+            ),
+        ]
 
-    @property
-    def tag_bits(self):
-        return self.address_bits - self.offset_bits - self.index_bits
+    @staticmethod
+    def get(num_ways, num_sets, block_size, address_bits):
+        """Return the CacheParameters row for a geometry, creating it if needed (usually without a query)."""
+        return parameters_registry.get((num_ways, num_sets, block_size, address_bits))
 
-    @property
-    def set_size_bytes(self):
-        return self.num_ways * self.block_size
+    @staticmethod
+    def for_geometry(geometry):
+        """Return the CacheParameters with the same shape as a CacheGeometry, creating it if needed."""
+        return CacheParameters.get(
+            num_ways=geometry.num_ways,
+            num_sets=geometry.num_sets,
+            block_size=geometry.block_size,
+            address_bits=geometry.address_bits,
+        )
 
-    @property
-    def way_size_bytes(self):
-        return self.num_sets * self.block_size
+    @staticmethod
+    def generate_random(rng=None, **limits):
+        """See generation.random_geometry for the limits."""
+        return CacheParameters.for_geometry(random_geometry(rng, **limits))
 
-    @property
-    def cache_size_bytes(self):
-        return self.num_ways * self.num_sets * self.block_size
-
-    def split_address(self, address):
-        offset = address & ~((~0) << self.offset_bits)
-        index = (address >> self.offset_bits) & ~((~0) << self.index_bits)
-        tag = (address >> (self.offset_bits + self.index_bits))
-        return (tag, index, offset)
-
-    def unsplit_address(self, tag, index, offset):
-        return (
-            (tag << (self.offset_bits + self.index_bits)) |
-            (index << self.offset_bits) |
-            offset
+    @staticmethod
+    def find_orphans():
+        """
+        Return the rows no pattern, question or pooled question uses, except
+        those for pattern question geometries, which are kept for reuse.
+        """
+        orphans = CacheParameters.objects.filter(
+            ~Exists(CachePattern.objects.filter(parameters=OuterRef('pk'))),
+            ~Exists(ParameterQuestion.objects.filter(parameters=OuterRef('pk'))),
+            ~Exists(PooledQuestion.objects.filter(parameters=OuterRef('pk'))),
         )
+        for geometry in pattern_geometries():
+            orphans = orphans.exclude(
+                num_ways=geometry.num_ways, num_sets=geometry.num_sets,
+                block_size=geometry.block_size, address_bits=geometry.address_bits,
+            )
+        return orphans
 
-    def drop_offset(self, address):
-        return address & ((~0) << self.offset_bits)
+class _ParametersRegistry():
+    """
+    Interns CacheParameters rows in each process, by geometry, so that
+    CacheParameters.get does not need a query for geometries used before.
+    The geometries of pattern questions are loaded (and created) together
+    on first use, retried at most every CHECK_INTERVAL seconds until that
+    is committed. Rows are only added once the transaction that read them
+    has committed, so a rolled back row is never handed out. Since rows are
+    only deleted along with everything using them (see
+    views.clear_all_questions), the entries are dropped when the shared
+    generation number changes, checked at most every CHECK_INTERVAL seconds.
+    """
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self):
+        self._rows = {}
+        self._generation = None
+        self._checked_at = None
+        self._preloaded = False
+        self._preload_tried_at = None
+        self._lock = threading.Lock()
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if self._checked_at != None and now - self._checked_at < self.CHECK_INTERVAL:
+            return
+        generation = invalidation.current_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._rows.clear()
+                self._preloaded = False
+                self._preload_tried_at = None
+                self._generation = generation
+            self._checked_at = now
+
+    def _add_on_commit(self, rows, preloaded=False):
+        generation = self._generation
+        def add():
+            with self._lock:
+                if generation == self._generation:
+                    for row in rows:
+                        self._rows[row.geometry_key()] = row
+                    if preloaded:
+                        self._preloaded = True
+        transaction.on_commit(add)
+
+    def _preload(self):
+        now = time.monotonic()
+        if self._preload_tried_at != None and now - self._preload_tried_at < self.CHECK_INTERVAL:
+            # an earlier try has not committed (yet)
+            return
+        self._preload_tried_at = now
+        keys = [geometry.geometry_key() for geometry in pattern_geometries()]
+        CacheParameters.objects.bulk_create([
+            CacheParameters(num_ways=num_ways, num_sets=num_sets, block_size=block_size, address_bits=address_bits)
+            for num_ways, num_sets, block_size, address_bits in keys
+        ], ignore_conflicts=True)
+        wanted = set(keys)
+        rows = CacheParameters.objects.filter(
+            num_ways__in=set(key[0] for key in keys),
+            num_sets__in=set(key[1] for key in keys),
+            block_size__in=set(key[2] for key in keys),
+            address_bits__in=set(key[3] for key in keys),
+        )
+        self._add_on_commit([row for row in rows if row.geometry_key() in wanted], preloaded=True)
+
+    def get(self, key):
+        self._check_generation()
+        if not self._preloaded:
+            self._preload()
+        row = self._rows.get(key)
+        if row == None:
+            (num_ways, num_sets, block_size, address_bits) = key
+            # with the unique constraint, concurrent creators end up with the same row
+            (row, _) = CacheParameters.objects.get_or_create(
+                num_ways=num_ways, num_sets=num_sets, block_size=block_size, address_bits=address_bits,
+            )
+            self._add_on_commit([row])
+        return row
 
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._preloaded = False
+            self._preload_tried_at = None
+            self._checked_at = None
 
-    @staticmethod
-    def get(num_ways, num_sets, block_size, address_bits):
-        possible = CacheParameters.objects.filter(
-            num_ways=num_ways,
-            num_sets=num_sets,
-            block_size=block_size,
-            address_bits=address_bits,
-        )
-        if len(possible) == 0:
-            result = CacheParameters()
-            result.num_ways = num_ways
-            result.num_sets = num_sets
-            result.block_size = block_size
-            result.address_bits = address_bits
-            result.save()
-            return result
-        else:
-            return possible[0]
-
-    @staticmethod
-    def generate_random(
-            min_ways=1, max_ways=12, min_sets_log=0,
-            max_sets_log=24, min_block_size_log=0,
-            max_block_size_log=8,
-            min_address_bits=8,
-            max_address_bits=64,
-            address_bits_rounding=8,
-            min_tag_bits=1,
-            max_cache_size=128 * 1024 * 1024):
-        while True:
-            num_ways = random.randint(min_ways, max_ways)
-            way_bits = int(math.log2(num_ways)) + 1
-            index_bits = random.randint(min_sets_log, max_sets_log)
-            num_sets = 1 << index_bits
-            offset_bits = random.randint(min_block_size_log, max_block_size_log)
-            block_size = 1 << offset_bits
-            min_tag_bits = max(min_tag_bits, way_bits)
-            min_address_bits = max(min_address_bits, index_bits + offset_bits + min_tag_bits)
-            address_bits = random.randint(min_address_bits, max_address_bits)
-            if address_bits % address_bits_rounding > 0:
-                address_bits += address_bits_rounding - (address_bits % address_bits_rounding)
-            cache_size = num_ways * block_size * num_sets
-            if cache_size < max_cache_size:
-                break
-        return CacheParameters.get(num_ways=num_ways, num_sets=num_sets, block_size=block_size, address_bits=address_bits)
-
-def random_parameters_for_pattern():
-    return CacheParameters.generate_random(
-        min_ways=2, max_ways=3,
-        min_sets_log=3, max_sets_log=6,
-        min_block_size_log=2, max_block_size_log=3,
-        min_address_bits=12, max_address_bits=12,
-        address_bits_rounding=4,
-    )
-
-all_cache_question_parameters = [
-    'tag_bits',
-    'index_bits',
-    'offset_bits',
-    'cache_size_bytes',
-    'num_sets',
-    'num_ways',
-    'block_size',
-    'set_size_bytes',
-    'way_size_bytes',
-    'address_bits',
-]
-
-def _can_find_parameters_from(given_parts):
-    known_parts = given_parts
-    done = False
-    equations = [
-        set(['block_size', 'offset_bits']),
-        set(['index_bits', 'num_sets']),
-        set(['block_size', 'set_size_bytes', 'num_ways']),
-        set(['block_size', 'num_ways', 'num_sets', 'cache_size_bytes']),
-        set(['tag_bits', 'index_bits', 'offset_bits', 'address_bits']),
-        set(['cache_size_bytes', 'set_size_bytes', 'num_sets']),
-        set(['cache_size_bytes', 'way_size_bytes', 'num_ways']),
-    ]
-    while not done:
-        done = True
-        for equation in equations:
-            if len(known_parts & equation) == len(equation) - 1:
-                known_parts |= equation
-                done = False
-    return len(known_parts) == len(all_cache_question_parameters)
-
-def _all_subsets(lst):
-    iters = []
-    for i in range(len(lst)):
-        iters.append(itertools.combinations(lst, i))
-    return map(frozenset, itertools.chain(*iters))
-
-def _get_cache_givens_to_ask():
-    possible = set()
-    for givens in _all_subsets(all_cache_question_parameters):
-        if _can_find_parameters_from(givens):
-            possible.add(givens)
-    filtered = set()
-    for givens in possible:
-        can_trim = False
-        for item in givens:
-            if givens - set([item]) in possible:
-                can_trim = True
-        if not can_trim:
-            filtered.add(givens)
-    logger.debug('all_cache_given_sets = %s', filtered)
-    return list(filtered)
-
-all_cache_given_sets = _get_cache_givens_to_ask()
+parameters_registry = _ParametersRegistry()
+
+def random_parameters_for_pattern(rng=None):
+    return CacheParameters.for_geometry(random_geometry_for_pattern(rng))
 
 class ParameterQuestion(models.Model):
     question_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -367,9 +200,21 @@ class ParameterQuestion(models.Model):
         return getattr(self.parameters, name)
    
     @staticmethod
-    def generate_new(for_user):
-        which_given = list(random.choice(all_cache_given_sets))
-        which_parameters = CacheParameters.generate_random()
+    def generate_new(for_user, rng=None):
+        generated = generate_parameter_question(rng)
+        return ParameterQuestion._create(for_user, CacheParameters.for_geometry(generated.geometry), generated.given_parts)
+
+    @staticmethod
+    def new_for_user(for_user):
+        """Give for_user a question from the pool, or a newly generated one if it is empty."""
+        with transaction.atomic():
+            pooled = PooledQuestion.claim(PooledQuestion.KIND_PARAMETER)
+            if pooled == None:
+                return ParameterQuestion.generate_new(for_user)
+            return ParameterQuestion._create(for_user, pooled.parameters, pooled.given_parts)
+
+    @staticmethod
+    def _create(for_user, parameters, given_parts):
         q = ParameterQuestion()
         last_question = ParameterQuestion.last_for_user(for_user)
         if last_question != None:
@@ -377,10 +222,12 @@ class ParameterQuestion(models.Model):
         else:
             q.index = 0
         q.for_user = for_user
-        q.parameters = which_parameters
-        q.given_parts = which_given
-        q.missing_parts = list(filter(lambda x: x not in which_given, all_cache_question_parameters))
-        q.save()
+        q.parameters = parameters
+        q.given_parts = given_parts
+        q.missing_parts = list(filter(lambda x: x not in given_parts, all_cache_question_parameters))
+        with transaction.atomic():
+            q.save()
+            UserProgress.record_parameter_question(q)
         return q
 
     @staticmethod
@@ -407,7 +254,7 @@ class ParameterAnswer(models.Model):
 
     def set_answer_from_post(self, post):
         self._answer = self._post_to_scored_answer(post)
-        self.answer_raw = json.dumps({k: vars(v) for k, v in self._answer.items()})
+        self.answer_raw = json.dumps({k: v.as_dump() for k, v in self._answer.items()})
         self.score_ratio = float(self.score) / self.max_score
 
     def get_answer(self):
@@ -445,6 +292,13 @@ class ParameterAnswer(models.Model):
         self.was_complete = not incomplete
         return result
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                UserProgress.record_parameter_answer(self)
+
     @staticmethod
     def last_for_question_and_user(question, user):
         if question == None:
@@ -468,145 +322,60 @@ class ParameterAnswer(models.Model):
         return ParameterAnswer.objects.filter(for_user__exact=user, was_complete=True, submit_time__lte=time).order_by('-score_ratio', '-submit_time')[:K]
 
     @staticmethod
-    def find_defunct(limit_per_user):
-        objects = ParameterAnswer.objects.raw('''
-            WITH by_user_index AS (
-                SELECT *,
-                    ROW_NUMBER() as which_index_time OVER window_by_user_time,
-                    ROW_NUMBER() as whcih_index_score OVER window_by_user_score,
-                WINDOW window_by_user_time (PARTITION BY user ORDER BY submit_time DESC)
-                WINDOW window_by_user_score (PARTITION BY user ORDER BY score_ratio DESC)
-                FROM cachelab_parameteranswer
-            ) SELECT * FROM by_user_index WHERE
-                which_index_time == 1 OR which_index_score <= %s
-        ''', [limit_per_user])
-
-def _update_lru(entry_list, new_most_recent):
-    new_most_recent.lru = len(entry_list)
-    entry_list.sort(key=lambda e: e.lru)
-    for i, e in enumerate(entry_list):
-        e.lru = i
-
-def _get_lru(entry_list):
-    logger.debug('entry_list = %s', entry_list)
-    return list(filter(lambda e: e.lru == 0, entry_list))[0]
-
-class CacheState():
-    def __init__(self, params):
-        self.params = params
-        entries = []
-        for index in range(params.num_sets):
-            entries.append([])
-            for way in range(params.num_ways):
-                entries[-1].append(
-                    CacheEntry({
-                        'valid': False,
-                        'tag': None,
-                        'lru': way,
-                        'dirty': False
-                    })
-                )
-        self.entries = entries
-
-    def to_entries(self):
-        return self.entries
-
-    def get_recentness(self, address):
-        (tag, index, _) = self.params.split_address(address)
-        entries_at_index = self.entries[index]
-        missing_entries = 0
-        for possible in entries_at_index:
-            if possible.valid == False:
-                missing_entries += 1
-        for possible in entries_at_index:
-            if possible.tag == tag:
-                found = possible
-                break
-        if found == None:
-            return None
-        else:
-            return found.lru - missing_entries
-
-     
-    def apply_access(self, access, dry_run=False):
-        (tag, index, offset) = self.params.split_address(access.address)
-        logger.debug('apply_access(%x,%x,%x)', tag, index, offset)
-        found = None
-        entries_at_index = self.entries[index]
-        was_hit = False
-        for possible in entries_at_index:
-            if possible.tag == tag:
-                found = possible
-                was_hit = True
-                break
-        evicted = None
-        if found == None:
-            # FIXME: record dirty flush here
-            found = _get_lru(entries_at_index)
-            if found.valid:
-                logger.debug('evicted %x', found.tag)
-                evicted = self.params.unsplit_address(found.tag, index, 0)
-            else:
-                logger.debug('no eviction')
-            if not dry_run:
-                found.valid = True
-                found.tag = tag
-        # FIXME: conditional on is_writeback?
-        if access.is_write:
-            found.dirty = True
-        if not dry_run:
-            _update_lru(entries_at_index, found)
-        return CacheAccessResult.from_reference(
-            hit=was_hit,
-            tag=tag,
-            index=index,
-            offset=offset,
-            evicted=evicted,
-            tag_bits=self.params.tag_bits,
-            index_bits=self.params.index_bits,
-            offset_bits=self.params.offset_bits,
-            address_bits=self.params.address_bits,
-        )
-
-    def to_json(self):
-        return json.dumps(list(
-            map(lambda row: list(map(lambda x: x.as_dump(), row)),
-                self.entries)
-        ))
-
-    @staticmethod
-    def from_json(params, the_json):
-        raw_data = json.loads(the_json)
-        result = []
-        for raw_row in raw_data:
-            row = []
-            for raw_entry in raw_row:
-                row.append(CacheEntry(raw_entry))
-            result.append(row)
-        state = CacheState(params)
-        state.entries = result
-
-# because random.choices isn't available until Python 3.6
-def _random_weighted(possibilities, weights):
-    cumulative_weights = list(itertools.accumulate(weights))
-    weight_index = random.random() * cumulative_weights[-1]
-    index = bisect.bisect_left(cumulative_weights, weight_index)
-    return possibilities[index]
+    def find_defunct():
+        return defunct_answers(ParameterAnswer)
 
 class CachePattern(models.Model):
     pattern_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     parameters = models.ForeignKey('CacheParameters', on_delete=models.PROTECT)
     access_size = models.IntegerField(default=2)
     address_bits = models.IntegerField(default=8)
-    # JSON list of cache accesses
+    # name of a policy in replacement.POLICIES
+    replacement_policy = models.CharField(max_length=16, default='lru')
+    # cache accesses, packed by encoding.pack_accesses (or, in old rows, a JSON list)
     accesses_raw = models.TextField()
+    # whether each access hit and what it evicted, and the miss count with optimal replacement,
+    # packed by encoding.pack_results (or, in old rows, a JSON list of [hit, tag, index, offset,
+    # evicted]); filled in by generate_results
+    results_raw = models.TextField(default='')
+    # CacheState.dumps() (or, in old rows, to_json()) of the state after all the accesses,
+    # filled in by generate_results
+    final_state_raw = models.TextField(default='')
+    _accesses = None
     _have_access_results = False
+    _final_state = None
+    _optimal_miss_count = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # for pattern_cache: the final state is large and can be rebuilt from final_state_raw
+        state.pop('_final_state', None)
+        return state
 
     def get_accesses(self):
-        return list(map(lambda x: CacheAccess(**x), json.loads(self.accesses_raw)))
+        if self._accesses == None:
+            if encoding.is_packed(self.accesses_raw):
+                self._accesses = [
+                    CacheAccess(address, size, kind, access_type)
+                    for address, size, kind, access_type in encoding.unpack_accesses(self.accesses_raw)
+                ]
+            else:
+                self._accesses = list(map(lambda x: CacheAccess(**x), json.loads(self.accesses_raw)))
+        return self._accesses
 
     def set_accesses(self, accesses):
-        self.accesses_raw = json.dumps(list(map(lambda x: x.as_dump(), accesses)))
+        accesses = list(accesses)
+        self.accesses_raw = encoding.pack_accesses(
+            (access.address, access.size, access.kind, access.type) for access in accesses
+        )
+        if self.accesses_raw == None:
+            self.accesses_raw = json.dumps(list(map(lambda x: x.as_dump(), accesses)))
+        self._accesses = accesses
+        self.results_raw = ''
+        self.final_state_raw = ''
+        self._have_access_results = False
+        self._final_state = None
+        self._optimal_miss_count = None
 
     accesses = property(get_accesses, set_accesses)
 
@@ -621,223 +390,139 @@ class CachePattern(models.Model):
     
     @property
     def final_state(self):
-        self.generate_results()
+        if self._final_state == None:
+            self.generate_results()
+        if self._final_state == None:
+            self._final_state = CacheState.loads(self.parameters, self.final_state_raw, policy=self.replacement_policy)
         return self._final_state
 
-    def generate_results(self):
-        if not self._have_access_results:
-            state = CacheState(self.parameters)
-            results = []
-            for access in self.accesses:
-                results.append(state.apply_access(access))
-            self._access_results = results
-            self._final_state = state
+    @property
+    def replacement_policy_description(self):
+        return POLICIES[self.replacement_policy].description
+
+    def generate_results(self, write_back=True):
+        """
+        Set up access_results, decoding them from results_raw if it is set.
+        Otherwise the accesses are replayed and the results stored in
+        results_raw and final_state_raw (and, for rows saved before those
+        fields existed, written back to the database unless write_back is
+        false) so this happens once.
+        """
+        if self._have_access_results:
+            return
+        parameters = self.parameters
+        if self.results_raw != '':
+            if encoding.is_packed(self.results_raw):
+                self._optimal_miss_count = encoding.unpack_optimal_misses(self.results_raw)
+                raw_results = [
+                    (hit,) + tuple(parameters.split_address(access.address)) + (evicted,)
+                    for access, (hit, evicted) in zip(self.accesses, encoding.unpack_results(self.results_raw))
+                ]
+            else:
+                raw_results = json.loads(self.results_raw)
+            self._access_results = [
+                CacheAccessResult.from_reference(
+                    hit=hit, tag=tag, index=index, offset=offset, evicted=evicted,
+                    tag_bits=parameters.tag_bits,
+                    index_bits=parameters.index_bits,
+                    offset_bits=parameters.offset_bits,
+                    address_bits=parameters.address_bits,
+                )
+                for hit, tag, index, offset, evicted in raw_results
+            ]
+            self._classify_misses()
             self._have_access_results = True
+            return
+        state = CacheState(parameters, policy=self.replacement_policy)
+        results = []
+        for access in self.accesses:
+            results.append(state.apply_access(access))
+        self.set_results(results, state)
+        if write_back and not self._state.adding:
+            CachePattern.objects.filter(pattern_id=self.pattern_id).update(
+                results_raw=self.results_raw,
+                final_state_raw=self.final_state_raw,
+            )
 
+    def _classify_misses(self):
+        classifier = MissClassifier(self.parameters)
+        for access, result in zip(self.accesses, self._access_results):
+            result.miss_type = classifier.classify(access.address, result.hit.value)
+
+    def set_results(self, results, final_state, optimal_misses=None):
+        """
+        Store the expected results of the accesses, the final state and the
+        miss count with optimal replacement (computed here if not given).
+        """
+        if optimal_misses == None:
+            optimal_misses = count_optimal_misses(self.parameters, self.accesses)
+        self._access_results = results
+        self._classify_misses()
+        self._final_state = final_state
+        self._optimal_miss_count = optimal_misses
+        self._have_access_results = True
+        self.results_raw = encoding.pack_results(
+            [result.hit.value for result in results],
+            [result.evicted.value for result in results],
+            optimal_misses,
+        )
+        self.final_state_raw = final_state.dumps()
+
+    @property
+    def miss_count(self):
+        return sum(1 for result in self.access_results if not result.hit.value)
+
+    @property
+    def optimal_miss_count(self):
+        """Misses for these accesses with Belady's optimal replacement policy, for comparison with miss_count."""
+        self.generate_results()
+        if self._optimal_miss_count == None:
+            # only rows whose results are still JSON (see pack_patterns) do not store it
+            self._optimal_miss_count = count_optimal_misses(self.parameters, self.accesses)
+        return self._optimal_miss_count
 
-    """
-    Generate a psuedorandom access pattern.
-    
-    Takes relative frequencies of the types of accesses (on average, chosen randomly) and a fixed pattern
-    to start with.
-
-    The access types:
-    * random_miss --- a cache miss, by choosing a random address, with fallback to explicitly searching for
-        a missing address
-    * miss_prefer_empty --- a cache miss, in an empty set if possible
-    * miss_prefer_used --- a cache miss, in a used set if possible, with a preference to avoid conflict misses
-    * conflict_miss --- a cache miss to a previously evicted block
-    * setup_conflict --- a cache miss to an already-accessed set
-    * setup_conflict_aggressive --- a cache miss to a most-full already accessed set
-    * hit_lru --- a cache hit to a LRU item
-    """
     @staticmethod
-    def generate_random(parameters,
-            num_accesses=14,
-            start_actions=None,
-            access_size=2,
-            chance_setup_conflict_aggressive=0,
-            chance_setup_conflict=0.5,
-            chance_conflict_miss=0.5,
-            chance_hit=1.5,
-            chance_random_miss=1,
-            chance_miss_prefer_empty=0,
-            chance_miss_prefer_used=0.5):
-        DEFAULT_START_ACTIONS = ['random_miss', 'setup_conflict_aggressive', 'hit_lru', 'setup_conflict_aggressive', 'setup_conflict_aggressive', 'random_miss']
-        if start_actions == None:
-            start_actions = DEFAULT_START_ACTIONS
-        MAX_TRIES = 20
-        MAX_RANDOM_LIST = 1000
+    def from_generated(generated, parameters=None):
+        """
+        Return an unsaved CachePattern for a generation.GeneratedPattern;
+        parameters is the CacheParameters for its geometry, looked up if not given.
+        """
+        if parameters == None:
+            parameters = CacheParameters.for_geometry(generated.geometry)
         result = CachePattern()
-        result.access_size = 2
+        result.access_size = generated.access_size
         result.parameters = parameters
-        accesses =  []
-        state = CacheState(parameters)
-        would_hit = set()
-        would_miss = set()  # miss AND previously accessed
-        used_indices = set()
-        used_by_count = {}
-        tag_bits = parameters.tag_bits
-        index_bits = parameters.index_bits
-        offset_bits = parameters.offset_bits
-        address_bits = parameters.address_bits
-        def _find_unused_miss():
-            if len(used_indices) != parameters.num_sets:
-                possible_indices = []
-                for _ in range(MAX_TRIES):
-                    index = random.randrange(0, 1 << index_bits)
-                    if index not in used_indices:
-                        tag = random.randrange(0, 1 << tag_bits)
-                        return parameters.unsplit_address(tag, index, 0)
-                for index in range(parameters.num_sets):
-                    if index in used_indices:
-                        continue
-                    possible_indices.append(index)
-                    if len(possible_indices) > MAX_RANDOM_LIST:
-                        break
-                index = random.choice(possible_indices)
-                tag = random.randrange(0, 1 << tag_bits)
-                return parameters.unsplit_address(tag, index, 0)
-            else:
-                return None
-
-        def _find_miss_for_index(index, prefer_non_conflict=True):
-            if prefer_non_conflict:
-                # first try to find a random non-conflict miss
-                for _ in range(MAX_TRIES):
-                    tag = random.randrange(0, 1 << parameters.tag_bits)
-                    block_address = parameters.unsplit_address(tag, index, 0)
-                    if block_address in would_hit or block_address in would_miss:
-                        continue
-                    return block_address
-            # then try to find a random maybe-conflict-miss
-            for _ in range(MAX_TRIES):
-                tag = random.randrange(0, 1 << parameters.tag_bits)
-                block_address = parameters.unsplit_address(tag, index, 0)
-                if block_address in would_hit:
-                    continue
-                return block_address
-            # then search exhaustively for possible blocks
-            possible_blocks = []
-            for tag in range(0, 1 << parameters.tag_bits):
-                block_address = parameters.unsplit_address(tag, index, 0)
-                if block_address in would_hit:
-                    continue
-                possible_blocks.append(block_address)
-                if len(possible_blocks) > MAX_RANDOM_LIST:
-                    break
-            return random.choice(possible_blocks)
-
-        def _find_used_miss():
-            if len(used_indices) == 0:
-                return random.randrange(0, 1 << address_bits)
-            index = random.choice(list(used_indices))
-            return _find_miss_for_index(index)
-
-        def _find_random_miss():
-            for _ in range(MAX_TRIES):
-                address = random.randrange(0, 1 << address_bits)
-                address &= ~(result.access_size - 1)
-                (tag, index, _) = parameters.split_address(address)
-                block_address = parameters.unsplit_address(tag, index, 0)
-                if block_address not in would_hit:
-                    return block_address
-            # fallback to other mechanisms
-            address = _find_unused_miss()
-            if address == None:
-                address = _find_used_miss()
-            return address
-
-        def _find_hit_lru():
-            would_hit_lru = list(filter(lambda x: state.get_recentness(x) == 0, would_hit))
-            if len(would_hit_lru) > 0:
-                return random.choice(would_hit_lru)
-            else:
-                return random.choice(list(would_hit))
-            
-        for i in range(num_accesses):
-            if i < len(start_actions):
-                access_kind = start_actions[i]
-            else:
-                possible = ['random_miss']
-                possible_weights = [chance_random_miss]
-                possible.append('miss_prefer_empty')
-                possible_weights.append(chance_miss_prefer_empty)
-                possible.append('miss_prefer_used')
-                possible_weights.append(chance_miss_prefer_used)
-                if len(would_hit) > 0:
-                    possible.append('hit')
-                    possible_weights.append(chance_hit)
-                    possible.append('setup_conflict_aggressive')
-                    possible_weights.append(chance_setup_conflict_aggressive)
-                    possible.append('setup_conflict')
-                    possible_weights.append(chance_setup_conflict)
-                if len(would_miss) > 0:
-                    possible.append('conflict_miss')
-                    possible_weights.append(chance_conflict_miss)
-                access_kind = _random_weighted(possible, possible_weights)
-            logger.debug('chosen access kind is %s', access_kind)
-            if access_kind == 'random_miss':
-                address = _find_random_miss()
-            elif access_kind == 'miss_prefer_empty':
-                address = _find_unused_miss()
-                if address == None:
-                    address = _find_random_miss()
-            elif access_kind == 'miss_prefer_used':
-                address = _find_used_miss()
-            elif access_kind == 'hit_lru':
-                address = _find_hit_lru()
-            elif access_kind == 'hit':
-                address = random.choice(list(would_hit))
-            elif access_kind == 'conflict_miss':
-                address = random.choice(list(would_miss))
-            elif access_kind == 'setup_conflict_aggressive':
-                best_count = None
-                for v in used_by_count.values():
-                    if best_count == None:
-                        best_count = v
-                    elif v > best_count or (v > 0 and best_count == parameters.num_ways):
-                        best_count = v
-                logger.debug('looking for count %s', best_count)
-                candidates = []
-                for k, v in used_by_count.items():
-                    if v == best_count:
-                        candidates.append(k)
-                logger.debug('candidates are %s', candidates)
-                index = random.choice(candidates)
-                address = _find_miss_for_index(index, prefer_non_conflict=False)
-            elif access_kind == 'setup_conflict':
-                base_address = random.choice(list(would_hit))
-                (_, index, _) = parameters.split_address(address)
-                address = _find_miss_for_index(index, prefer_non_conflict=False)
-            else:
-                raise Exception("Could not identify access type")
-            assert address != None, 'no address generated for kind {}'.format(access_kind)
-            without_offset = parameters.drop_offset(address)
-            (tag, index, _) = parameters.split_address(address)
-            new_offset = random.randrange(0, 1 << offset_bits) & ~(result.access_size - 1)
-            address = without_offset | new_offset
-            accesses.append(CacheAccess(address=address, size=result.access_size, kind=access_kind))
-            access_result = state.apply_access(accesses[-1])
-            (new_tag, new_index, _) = parameters.split_address(address)
-            assert tag == new_tag
-            assert index == new_index
-            used_indices.add(index)
-            if index in used_by_count:
-                used_by_count[index] = max(used_by_count[index] + 1, parameters.num_ways)
-            else:
-                used_by_count[index] = 1
-            would_hit.add(without_offset)
-            would_miss.discard(without_offset)
-            if access_result.evicted.value != None:
-                would_miss.add(access_result.evicted.value)
-                would_hit.discard(access_result.evicted.value)
-        result.accesses_raw = json.dumps(list(map(lambda a: a.as_dump(), accesses)))
-        result.generate_results()
+        result.replacement_policy = generated.replacement_policy
+        result.accesses = generated.accesses
+        result.set_results(generated.results, generated.final_state, generated.optimal_misses)
+        return result
+
+    @staticmethod
+    def generate_random(parameters, rng=None, **options):
+        """Generate and save a pseudorandom access pattern; see generation.generate_pattern for the options."""
+        result = CachePattern.from_generated(generate_pattern(parameters, rng, **options), parameters)
         result.save()
         return result
 
-    # FIXME: function to create
+    @staticmethod
+    def find_orphans():
+        """Return the patterns no question or pooled question uses."""
+        return CachePattern.objects.filter(
+            ~Exists(PatternQuestion.objects.filter(pattern=OuterRef('pk'))),
+            ~Exists(PooledQuestion.objects.filter(pattern=OuterRef('pk'))),
+        )
+
+    @staticmethod
+    def bulk_create_generated(generated_patterns, batch_size=500):
+        """Save many GeneratedPatterns with one query per batch (plus one per new geometry)."""
+        parameters_for_geometry = {}
+        patterns = []
+        for generated in generated_patterns:
+            key = generated.geometry.geometry_key()
+            if key not in parameters_for_geometry:
+                parameters_for_geometry[key] = CacheParameters.for_geometry(generated.geometry)
+            patterns.append(CachePattern.from_generated(generated, parameters_for_geometry[key]))
+        return CachePattern.objects.bulk_create(patterns, batch_size=batch_size)
 
 class PatternQuestion(models.Model):
     question_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -872,29 +557,142 @@ class PatternQuestion(models.Model):
     def last_for_user(for_user):
         return PatternQuestion.objects.filter(for_user__exact=for_user).order_by('-index').first()    
 
+    # fields of the last answer that history_for_user() adds as answer_<field>
+    HISTORY_ANSWER_FIELDS = ['score', 'max_score', 'was_complete', 'was_save', 'submit_time']
+
+    @staticmethod
+    def history_for_user(for_user, before_index=None, limit=50):
+        """
+        Return up to limit of for_user's questions with an index below
+        before_index (or the newest if None), newest first, with the last
+        answer to each as answer_<field> attributes (None if unanswered), in
+        one query whose cost does not depend on how far back the page is.
+        """
+        last_answer = PatternAnswer.objects.filter(
+            question=OuterRef('pk'), for_user__exact=for_user
+        ).order_by('-submit_time')
+        questions = PatternQuestion.objects.filter(for_user__exact=for_user)
+        if before_index != None:
+            questions = questions.filter(index__lt=before_index)
+        questions = questions.annotate(**{
+            'answer_' + field: Subquery(last_answer.values(field)[:1])
+            for field in PatternQuestion.HISTORY_ANSWER_FIELDS
+        })
+        return list(questions.order_by('-index')[:limit])
+
+    @staticmethod
+    def generate_random(parameters, for_user, rng=None, **extra_args):
+        # in one transaction, so the pattern is never seen without its question (see CachePattern.find_orphans)
+        with transaction.atomic():
+            pattern = CachePattern.generate_random(parameters, rng, **extra_args)
+            return PatternQuestion._create(for_user, pattern)
+
+    @staticmethod
+    def new_for_user(for_user):
+        """Give for_user a question from the pool, or a newly generated one if it is empty."""
+        with transaction.atomic():
+            pooled = PooledQuestion.claim(PooledQuestion.KIND_PATTERN)
+            if pooled == None:
+                return PatternQuestion.generate_random(random_parameters_for_pattern(), for_user)
+            return PatternQuestion._create(for_user, pooled.pattern)
+
     @staticmethod
-    def generate_random(parameters, for_user, **extra_args):
+    def _create(for_user, pattern):
         last_question = PatternQuestion.last_for_user(for_user)
         if last_question:
             index = last_question.index + 1
         else:
             index = 0
-        pattern = CachePattern.generate_random(parameters, **extra_args)
         result = PatternQuestion()
         result.pattern = pattern
         result.for_user = for_user
         result.index = index
-        result.save()
+        with transaction.atomic():
+            result.save()
+            UserProgress.record_pattern_question(result)
         return result
 
-def value_from_hex(x):
-    if x != None and (x.startswith('0x') or x.startswith('0X')):
-        x = x[2:]
-    try:
-        return int(x, 16)
-    except TypeError:
-        return None
-    except ValueError:
+class PooledQuestion(models.Model):
+    """
+    A question generated ahead of time and not yet given to anyone, so
+    that giving out a new question does not need to generate one (see the
+    fill_question_pool command). A pattern question only has pattern set;
+    a parameter question has parameters and given_parts.
+    """
+    KIND_PATTERN = 'pattern'
+    KIND_PARAMETER = 'parameter'
+    KINDS = [KIND_PATTERN, KIND_PARAMETER]
+    CLAIM_CANDIDATES = 8
+
+    kind = models.CharField(max_length=16)
+    pattern = models.ForeignKey('CachePattern', null=True, on_delete=models.PROTECT)
+    parameters = models.ForeignKey('CacheParameters', null=True, on_delete=models.PROTECT)
+    given_parts_raw = models.TextField(default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'id']),
+        ]
+
+    def get_given_parts(self):
+        return json.loads(self.given_parts_raw)
+
+    def set_given_parts(self, given_parts):
+        self.given_parts_raw = json.dumps(given_parts)
+
+    given_parts = property(get_given_parts, set_given_parts)
+
+    @staticmethod
+    def generate_values(kind, count, rng=None):
+        """
+        Generate count questions of kind as GeneratedPatterns or
+        GeneratedParameterQuestions, without using the database.
+        """
+        rng = make_rng(rng)
+        if kind == PooledQuestion.KIND_PATTERN:
+            return [generate_pattern(random_geometry_for_pattern(rng), rng) for _ in range(count)]
+        elif kind == PooledQuestion.KIND_PARAMETER:
+            return [generate_parameter_question(rng) for _ in range(count)]
+        else:
+            raise ValueError('unknown question kind {!r}'.format(kind))
+
+    @staticmethod
+    def bulk_create_generated(kind, generated):
+        """Add generate_values() output to the pool with a few queries; returns the new entries."""
+        if kind == PooledQuestion.KIND_PATTERN:
+            entries = [
+                PooledQuestion(kind=kind, pattern=pattern)
+                for pattern in CachePattern.bulk_create_generated(generated)
+            ]
+        else:
+            parameters_for_geometry = {}
+            entries = []
+            for question in generated:
+                key = question.geometry.geometry_key()
+                if key not in parameters_for_geometry:
+                    parameters_for_geometry[key] = CacheParameters.for_geometry(question.geometry)
+                entry = PooledQuestion(kind=kind, parameters=parameters_for_geometry[key])
+                entry.given_parts = question.given_parts
+                entries.append(entry)
+        return PooledQuestion.objects.bulk_create(entries)
+
+    @staticmethod
+    def generate(kind, rng=None):
+        return PooledQuestion.bulk_create_generated(kind, PooledQuestion.generate_values(kind, 1, rng))[0]
+
+    @staticmethod
+    def claim(kind):
+        """Remove and return one of the oldest pooled questions of kind, or None if there are none."""
+        candidates = list(
+            PooledQuestion.objects.filter(kind=kind).select_related('pattern', 'parameters').order_by('pk')[:PooledQuestion.CLAIM_CANDIDATES]
+        )
+        # so concurrent claims mostly try different rows
+        random.shuffle(candidates)
+        for entry in candidates:
+            # the delete is the claim: only one process can delete the row
+            (deleted, _) = PooledQuestion.objects.filter(pk=entry.pk).delete()
+            if deleted > 0:
+                return entry
         return None
 
 sizes = {
@@ -943,6 +741,7 @@ class PatternAnswer(models.Model):
         indexes = [
             models.Index(fields=['for_user', 'submit_time']),
             models.Index(fields=['for_user', 'was_complete', 'score']),
+            models.Index(fields=['question', 'for_user', 'submit_time']),
         ]
 
     _access_results = None
@@ -985,6 +784,13 @@ class PatternAnswer(models.Model):
         self.max_score = max_score
         return submitted_results
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                UserProgress.record_pattern_answer(self)
+
     @staticmethod
     def last_for_question_and_user(question, for_user):
         if question == None:
@@ -1010,8 +816,271 @@ class PatternAnswer(models.Model):
     def last_for_user(user):
         return PatternAnswer.objects.filter(for_user__exact=user).order_by('-submit_time').first()
 
+    @staticmethod
+    def find_defunct():
+        return defunct_answers(PatternAnswer)
+
+def defunct_answers(model):
+    """
+    Return a query for the pks of the ParameterAnswers or PatternAnswers
+    (model) that nothing reads: incomplete answers (saves and invalid
+    submissions) that are not the latest answer to their question. Complete
+    answers are all kept, since grades and progress are rebuilt from them.
+    """
+    not_latest = model.objects.annotate(
+        rank_in_question=Window(
+            RowNumber(), partition_by=[F('for_user'), F('question')], order_by=[F('submit_time').desc(), F('pk').desc()],
+        ),
+    ).filter(rank_in_question__gt=1).values('pk')
+    # the window ranks all the answers, so was_complete is only checked outside it
+    return model.objects.filter(pk__in=Subquery(not_latest), was_complete=False).order_by('pk').values_list('pk', flat=True)
+
+class UserProgress(models.Model):
+    """
+    A summary of a user's questions and answers for the index and question
+    pages, so they need one lookup instead of a query for each part. It is
+    updated in the same transaction as the question or answer that changes
+    it; a missing row is rebuilt from the answers when first needed, and
+    rebuild() must be called after changing questions or answers any other
+    way (e.g. bulk updates).
+    """
+    for_user = models.TextField(primary_key=True)
+    parameter_complete = models.IntegerField(default=0)
+    # [score_ratio, submit time as a timestamp, score, max_score] for the best
+    # NEEDED_PARAMETER_PERFECT complete parameter answers, in the order of
+    # ParameterAnswer.best_K_for_user
+    parameter_best_raw = models.TextField(default='[]')
+    last_parameter_index = models.IntegerField(null=True)
+    parameter_in_progress = models.BooleanField(default=False)
+    pattern_complete = models.IntegerField(default=0)
+    pattern_score = models.IntegerField(null=True)
+    pattern_max_score = models.IntegerField(null=True)
+    last_pattern_index = models.IntegerField(null=True)
+    pattern_in_progress = models.BooleanField(default=False)
+
+    def get_parameter_best(self):
+        return json.loads(self.parameter_best_raw)
+
+    def set_parameter_best(self, parameter_best):
+        self.parameter_best_raw = json.dumps(parameter_best)
+
+    parameter_best = property(get_parameter_best, set_parameter_best)
+
+    @property
+    def parameter_scores(self):
+        """(score, max_score) of the best complete parameter answers."""
+        return [(score, max_score) for _, _, score, max_score in self.parameter_best]
+
+    @property
+    def parameter_perfect_count(self):
+        return sum(1 for score, max_score in self.parameter_scores if score == max_score)
+
+    @property
+    def parameter_perfect(self):
+        return self.parameter_perfect_count >= NEEDED_PARAMETER_PERFECT
+
+    @property
+    def pattern_perfect(self):
+        return self.pattern_score != None and self.pattern_score == self.pattern_max_score
+
+    @staticmethod
+    def for_user_or_rebuild(for_user):
+        progress = UserProgress.objects.filter(for_user=for_user).first()
+        if progress == None:
+            with transaction.atomic():
+                progress = UserProgress.rebuild(for_user)
+        return progress
+
+    @staticmethod
+    def rebuild(for_user):
+        """Recompute for_user's progress (and score timeline) from their questions and answers."""
+        progress = UserProgress(for_user=for_user)
+        progress.parameter_complete = ParameterAnswer.num_complete_for_user(for_user)
+        progress.parameter_best = [
+            [answer.score_ratio, answer.submit_time.timestamp(), answer.score, answer.max_score]
+            for answer in ParameterAnswer.best_K_for_user(for_user, NEEDED_PARAMETER_PERFECT)
+        ]
+        last_parameter_question = ParameterQuestion.last_for_user(for_user)
+        if last_parameter_question != None:
+            progress.last_parameter_index = last_parameter_question.index
+            last_parameter_answer = ParameterAnswer.last_for_question_and_user(last_parameter_question, for_user)
+            progress.parameter_in_progress = last_parameter_answer != None and not last_parameter_answer.was_complete
+        progress.pattern_complete = PatternAnswer.num_complete_for_user(for_user)
+        best_pattern_answer = PatternAnswer.objects.filter(for_user__exact=for_user, was_complete=True).order_by(
+            F('max_score') - F('score'), 'submit_time'
+        ).first()
+        if best_pattern_answer != None:
+            progress.pattern_score = best_pattern_answer.score
+            progress.pattern_max_score = best_pattern_answer.max_score
+        last_pattern_question = PatternQuestion.last_for_user(for_user)
+        if last_pattern_question != None:
+            progress.last_pattern_index = last_pattern_question.index
+            last_pattern_answer = PatternAnswer.last_for_question_and_user(last_pattern_question, for_user)
+            progress.pattern_in_progress = last_pattern_answer == None or not last_pattern_answer.was_complete
+        fields = {
+            field.attname: getattr(progress, field.attname)
+            for field in UserProgress._meta.fields if not field.primary_key
+        }
+        with transaction.atomic():
+            # not save(): concurrent first requests for a user would both try to insert the row
+            (progress, _) = UserProgress.objects.update_or_create(for_user=for_user, defaults=fields)
+            ScoreChange.rebuild(for_user)
+        return progress
+
+    @staticmethod
+    def _update(for_user, change):
+        """Apply change to for_user's row, or rebuild it (which includes the change) if there is none."""
+        progress = UserProgress.objects.select_for_update().filter(for_user=for_user).first()
+        if progress == None:
+            UserProgress.rebuild(for_user)
+        else:
+            change(progress)
+            progress.save()
+
+    @staticmethod
+    def record_parameter_question(question):
+        def change(progress):
+            progress.last_parameter_index = question.index
+            progress.parameter_in_progress = False
+        UserProgress._update(question.for_user, change)
+
+    @staticmethod
+    def record_pattern_question(question):
+        def change(progress):
+            progress.last_pattern_index = question.index
+            progress.pattern_in_progress = True
+        UserProgress._update(question.for_user, change)
+
+    @staticmethod
+    def record_parameter_answer(answer):
+        def change(progress):
+            if answer.question.index == progress.last_parameter_index:
+                progress.parameter_in_progress = not answer.was_complete
+            if answer.was_complete:
+                progress.parameter_complete += 1
+                old_scores = progress.parameter_scores
+                progress.parameter_best = timeline.add_parameter_answer(
+                    progress.parameter_best,
+                    [answer.score_ratio, answer.submit_time.timestamp(), answer.score, answer.max_score],
+                    NEEDED_PARAMETER_PERFECT,
+                )
+                if progress.parameter_scores != old_scores:
+                    ScoreChange.record(progress, answer.submit_time)
+        UserProgress._update(answer.for_user, change)
+
+    @staticmethod
+    def record_pattern_answer(answer):
+        def change(progress):
+            if answer.question.index == progress.last_pattern_index:
+                progress.pattern_in_progress = not answer.was_complete
+            if answer.was_complete:
+                progress.pattern_complete += 1
+                if timeline.is_better_pattern(answer.score, answer.max_score, progress.pattern_score, progress.pattern_max_score):
+                    progress.pattern_score = answer.score
+                    progress.pattern_max_score = answer.max_score
+                    ScoreChange.record(progress, answer.submit_time)
+        UserProgress._update(answer.for_user, change)
+
+class ScoreChange(models.Model):
+    """
+    A point on a user's score timeline (see timeline.py): the scores that
+    are graded for deadlines from change_time until the user's next
+    ScoreChange. Rows are added under the user's locked UserProgress row
+    when an answer changes the scores, and rebuilt with it.
+    """
+    for_user = models.TextField()
+    change_time = models.DateTimeField()
+    # [[score, max_score], ...] for the best NEEDED_PARAMETER_PERFECT complete parameter answers, best first
+    parameter_scores_raw = models.TextField(default='[]')
+    pattern_score = models.IntegerField(null=True)
+    pattern_max_score = models.IntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['for_user', 'change_time']),
+        ]
+
+    @property
+    def parameter_scores(self):
+        return [timeline.GradedScore(*item) for item in json.loads(self.parameter_scores_raw)]
+
+    @property
+    def pattern(self):
+        if self.pattern_score == None:
+            return None
+        return timeline.GradedScore(self.pattern_score, self.pattern_max_score)
+
+    @staticmethod
+    def _make(for_user, change_time, parameter_scores, pattern_score):
+        change = ScoreChange(for_user=for_user, change_time=change_time)
+        change.parameter_scores_raw = json.dumps([list(item) for item in parameter_scores])
+        if pattern_score != None:
+            (change.pattern_score, change.pattern_max_score) = pattern_score
+        return change
+
+    @staticmethod
+    def record(progress, change_time):
+        """Add the scores in progress, just changed by an answer submitted at change_time."""
+        pattern_score = None
+        if progress.pattern_score != None:
+            pattern_score = (progress.pattern_score, progress.pattern_max_score)
+        ScoreChange._make(progress.for_user, change_time, progress.parameter_scores, pattern_score).save()
+
+    @staticmethod
+    def rebuild(for_user):
+        """Recompute for_user's timeline from their complete answers."""
+        ScoreChange.objects.filter(for_user=for_user).delete()
+        parameter_answers = (
+            (submit_time, score_ratio, score, len(json.loads(missing_parts_raw)))
+            for submit_time, score_ratio, score, missing_parts_raw in ParameterAnswer.objects.filter(
+                for_user__exact=for_user, was_complete=True
+            ).order_by('submit_time').values_list('submit_time', 'score_ratio', 'score', 'question__missing_parts_raw')
+        )
+        pattern_answers = PatternAnswer.objects.filter(for_user__exact=for_user, was_complete=True).order_by(
+            'submit_time'
+        ).values_list('submit_time', 'score', 'max_score')
+        ScoreChange.objects.bulk_create([
+            ScoreChange._make(for_user, *change)
+            for change in timeline.sweep(timeline.merge_answers(parameter_answers, pattern_answers), NEEDED_PARAMETER_PERFECT)
+        ])
+
+    @staticmethod
+    def load_timelines():
+        """Return {user: timeline.ScoreTimeline} for every user with a complete answer."""
+        timelines = {}
+        for change in ScoreChange.objects.order_by('for_user', 'change_time', 'pk').iterator():
+            if change.for_user not in timelines:
+                timelines[change.for_user] = timeline.ScoreTimeline()
+            timelines[change.for_user].append(change.change_time, change.parameter_scores, change.pattern)
+        return timelines
+
 def extract_best_for_user(user, due_datetime, num_parameter):
     return {
         'parameters': ParameterAnswer.best_K_for_user_by_time(user, num_parameter, due_datetime),
         'pattern': PatternAnswer.best_complete_for_user_by_time(user, due_datetime),
     }
+
+def _aware(value):
+    if timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.get_current_timezone())
+    return value
+
+def extract_best_for_all_users(due_datetime, override_due_datetime, num_parameter, timelines=None):
+    """
+    Return {user: scores} for every user with a complete answer, like
+    extract_best_for_user(user, due, num_parameter) but with the scores as
+    timeline.GradedScores rather than answers, where due is
+    override_due_datetime.get(user, due_datetime). Pass timelines from
+    ScoreChange.load_timelines() to look up several deadlines without
+    loading them again.
+    """
+    if timelines == None:
+        timelines = ScoreChange.load_timelines()
+    # like the ORM, take deadlines without a UTC offset (e.g. from dump_grades) as local time
+    due_datetime = _aware(due_datetime)
+    override_due_datetime = {user: _aware(user_due) for user, user_due in override_due_datetime.items()}
+    result = {}
+    for user, user_timeline in timelines.items():
+        (parameter_scores, pattern_score) = user_timeline.at(override_due_datetime.get(user, due_datetime))
+        result[user] = {'parameters': parameter_scores[:num_parameter], 'pattern': pattern_score}
+    return result
@@ -0,0 +1,72 @@
+# Two-tier cache of CachePatterns ready to display or grade: their parameters,
+# decoded accesses and expected results.
+#
+# The first tier is a small LRU dictionary in each process. Behind it is a
+# Django cache shared by all the server processes (the 'patterns' entry of
+# settings.CACHES if there is one, otherwise 'default'), so a pattern one
+# process has loaded does not need to be read from the database and decoded
+# again by the others. Patterns never change once generated, so the only
+# invalidation needed is when they are deleted: invalidate() bumps a
+# generation number kept in the shared cache, which is part of every shared
+# key and which each process compares against before using its own entries
+# (see invalidation.py).
+
+import collections
+import threading
+
+from .invalidation import bump_generation, current_generation, shared_cache
+from .models import CachePattern
+
+LOCAL_CACHE_SIZE = 256
+SHARED_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+class PatternCache():
+    def __init__(self, max_size=LOCAL_CACHE_SIZE):
+        self.max_size = max_size
+        self._local = collections.OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def get(self, pattern_id):
+        """Return the CachePattern with pattern_id, with its parameters, accesses and results already loaded."""
+        shared = shared_cache()
+        generation = current_generation(shared)
+        key = str(pattern_id)
+        with self._lock:
+            if generation != self._generation:
+                self._local.clear()
+                self._generation = generation
+            pattern = self._local.get(key)
+            if pattern != None:
+                self._local.move_to_end(key)
+                return pattern
+        shared_key = 'cachelab-pattern:{}:{}'.format(generation, key)
+        pattern = shared.get(shared_key)
+        if pattern == None:
+            pattern = CachePattern.objects.select_related('parameters').get(pattern_id=pattern_id)
+            pattern.accesses
+            pattern.generate_results()
+            shared.set(shared_key, pattern, SHARED_CACHE_TIMEOUT)
+        with self._lock:
+            if generation == self._generation:
+                self._local[key] = pattern
+                while len(self._local) > self.max_size:
+                    self._local.popitem(last=False)
+        return pattern
+
+    def invalidate(self):
+        """Forget all cached patterns, in this process immediately and in others on their next lookup."""
+        bump_generation()
+        with self._lock:
+            self._local.clear()
+            self._generation = None
+
+pattern_cache = PatternCache()
+
+def get_pattern(pattern_id):
+    return pattern_cache.get(pattern_id)
+
+def use_cached_pattern(question):
+    """Replace question.pattern by the cached copy, saving the queries to load it."""
+    question.pattern = get_pattern(question.pattern_id)
+    return question
@@ -0,0 +1,381 @@
+# Replacement policies for CacheState.
+#
+# A policy keeps the replacement state for every set of a cache, with sets
+# identified by their slot number in the CacheState and entries by way number.
+# CacheState fills invalid ways itself (lowest way first), so victim() is only
+# called for sets where every way is valid, and peek_victim() for dry runs.
+
+import array
+import heapq
+import random
+
+class ReplacementPolicy():
+    name = None
+    description = None
+
+    def __init__(self, num_ways):
+        self.num_ways = num_ways
+
+    def add_sets(self, count):
+        """Allocate state for count more sets (slots are numbered in order of allocation)."""
+        raise NotImplementedError()
+
+    def victim(self, slot):
+        """Return the way to replace in a full set."""
+        raise NotImplementedError()
+
+    def peek_victim(self, slot):
+        """Return the way victim() would return, without changing any state."""
+        return self.eviction_order(slot)[0]
+
+    def on_hit(self, slot, way):
+        pass
+
+    def on_fill(self, slot, way):
+        pass
+
+    def on_invalidate(self, slot, way):
+        pass
+
+    def eviction_order(self, slot):
+        """Return all ways of a set, the one which would be replaced next first."""
+        raise NotImplementedError()
+
+    def restore_order(self, slot, order):
+        """Set up a set's state from an eviction order, as saved by CacheState.to_json."""
+        for way in order:
+            self.on_fill(slot, way)
+
+class LRUPolicy(ReplacementPolicy):
+    """
+    True LRU. Each set is a doubly-linked list of ways from least to most
+    recently used, stored in flat arrays (_older/_newer, -1 marking the ends),
+    so updates and victim selection take constant time.
+    """
+    name = 'lru'
+    description = 'an LRU replacement policy'
+
+    def __init__(self, num_ways):
+        super().__init__(num_ways)
+        # initially way 0 is least recently used, as if each way had lru = way
+        self._older_row = array.array('i', [way - 1 for way in range(num_ways)])
+        self._newer_row = array.array('i', [way + 1 for way in range(num_ways - 1)] + [-1])
+        self._older = array.array('i')
+        self._newer = array.array('i')
+        self._lru_way = array.array('i')
+        self._mru_way = array.array('i')
+
+    def add_sets(self, count):
+        self._older.extend(self._older_row * count)
+        self._newer.extend(self._newer_row * count)
+        self._lru_way.extend(array.array('i', [0]) * count)
+        self._mru_way.extend(array.array('i', [self.num_ways - 1]) * count)
+
+    def _unlink(self, slot, way):
+        base = slot * self.num_ways
+        older = self._older[base + way]
+        newer = self._newer[base + way]
+        if older == -1:
+            self._lru_way[slot] = newer
+        else:
+            self._newer[base + older] = newer
+        if newer == -1:
+            self._mru_way[slot] = older
+        else:
+            self._older[base + newer] = older
+
+    def _make_most_recent(self, slot, way):
+        if self._mru_way[slot] == way:
+            return
+        self._unlink(slot, way)
+        base = slot * self.num_ways
+        most_recent = self._mru_way[slot]
+        self._newer[base + most_recent] = way
+        self._older[base + way] = most_recent
+        self._newer[base + way] = -1
+        self._mru_way[slot] = way
+
+    def _make_least_recent(self, slot, way):
+        if self._lru_way[slot] == way:
+            return
+        self._unlink(slot, way)
+        base = slot * self.num_ways
+        least_recent = self._lru_way[slot]
+        self._older[base + least_recent] = way
+        self._newer[base + way] = least_recent
+        self._older[base + way] = -1
+        self._lru_way[slot] = way
+
+    def victim(self, slot):
+        return self._lru_way[slot]
+
+    def peek_victim(self, slot):
+        return self._lru_way[slot]
+
+    def on_hit(self, slot, way):
+        self._make_most_recent(slot, way)
+
+    def on_fill(self, slot, way):
+        self._make_most_recent(slot, way)
+
+    def on_invalidate(self, slot, way):
+        self._make_least_recent(slot, way)
+
+    def eviction_order(self, slot):
+        base = slot * self.num_ways
+        order = []
+        way = self._lru_way[slot]
+        while way != -1:
+            order.append(way)
+            way = self._newer[base + way]
+        return order
+
+class FIFOPolicy(LRUPolicy):
+    """First-in, first-out: LRU order that is only updated when a block is brought in."""
+    name = 'fifo'
+    description = 'a FIFO (first-in, first-out) replacement policy'
+
+    def on_hit(self, slot, way):
+        pass
+
+class RandomPolicy(ReplacementPolicy):
+    """Replaces a uniformly random way, using its own seeded generator so results are repeatable."""
+    name = 'random'
+    description = 'a random replacement policy'
+
+    def __init__(self, num_ways, seed=0):
+        super().__init__(num_ways)
+        self._random = random.Random(seed)
+
+    def add_sets(self, count):
+        pass
+
+    def victim(self, slot):
+        return self._random.randrange(self.num_ways)
+
+    def peek_victim(self, slot):
+        # draw from a copy of the generator, so the real victim() makes the same choice
+        copy = random.Random()
+        copy.setstate(self._random.getstate())
+        return copy.randrange(self.num_ways)
+
+    def eviction_order(self, slot):
+        return list(range(self.num_ways))
+
+class TreePLRUPolicy(ReplacementPolicy):
+    """
+    Tree pseudo-LRU. Each set has a binary tree over its ways stored as a bit
+    vector in heap order (node n has children 2n and 2n + 1); each bit points
+    towards the half that was used less recently. Ways are padded to a power
+    of two leaves, and the walk to the victim never enters a subtree with no
+    real ways. Updates and victim selection take O(log ways).
+    """
+    name = 'plru'
+    description = 'a tree pseudo-LRU replacement policy'
+
+    def __init__(self, num_ways):
+        super().__init__(num_ways)
+        self._levels = max(num_ways - 1, 0).bit_length()
+        self._leaves = 1 << self._levels
+        self._bits = array.array('Q')
+
+    def add_sets(self, count):
+        self._bits.extend(array.array('Q', [0]) * count)
+
+    def victim(self, slot):
+        bits = self._bits[slot]
+        node = 1
+        low = 0
+        size = self._leaves
+        while size > 1:
+            size >>= 1
+            go_right = (bits >> node) & 1
+            if go_right and low + size >= self.num_ways:
+                go_right = 0
+            if go_right:
+                low += size
+            node = 2 * node + go_right
+        return low
+
+    def peek_victim(self, slot):
+        return self.victim(slot)
+
+    def _touch(self, slot, way):
+        bits = self._bits[slot]
+        node = 1
+        for level in range(self._levels - 1, -1, -1):
+            went_right = (way >> level) & 1
+            # point away from the half containing way
+            if went_right:
+                bits &= ~(1 << node)
+            else:
+                bits |= 1 << node
+            node = 2 * node + went_right
+        self._bits[slot] = bits
+
+    def on_hit(self, slot, way):
+        self._touch(slot, way)
+
+    def on_fill(self, slot, way):
+        self._touch(slot, way)
+
+    def eviction_order(self, slot):
+        victim = self.victim(slot)
+        return [victim] + [way for way in range(self.num_ways) if way != victim]
+
+class SRRIPPolicy(ReplacementPolicy):
+    """
+    Static re-reference interval prediction (Jaleel et al., 2010) with 2-bit
+    re-reference prediction values: blocks are inserted with a "long"
+    prediction, promoted to "near-immediate" on a hit, and the victim is a
+    block with a "distant" prediction, aging the whole set until one exists.
+
+    Each set keeps a bitmask of its ways for each prediction value, so aging
+    the set moves whole masks and the victim is the lowest bit of the
+    "distant" mask: constant time however many ways there are.
+    """
+    name = 'srrip'
+    description = 'an SRRIP (static re-reference interval prediction) replacement policy'
+
+    MAX_RRPV = 3
+    INSERT_RRPV = 2
+
+    def __init__(self, num_ways):
+        super().__init__(num_ways)
+        self._levels = self.MAX_RRPV + 1
+        # masks of the ways with each prediction value, self._levels for each set
+        # (Python ints, since a set may have more than 64 ways)
+        self._masks = []
+
+    def add_sets(self, count):
+        row = [0] * self.MAX_RRPV + [(1 << self.num_ways) - 1]
+        self._masks.extend(row * count)
+
+    def _set_rrpv(self, slot, way, rrpv):
+        masks = self._masks
+        base = slot * self._levels
+        bit = 1 << way
+        for level in range(self._levels):
+            masks[base + level] &= ~bit
+        masks[base + rrpv] |= bit
+
+    def victim(self, slot):
+        masks = self._masks
+        base = slot * self._levels
+        oldest = self.MAX_RRPV
+        while masks[base + oldest] == 0:
+            oldest -= 1
+        age = self.MAX_RRPV - oldest
+        if age > 0:
+            # every way's prediction goes up by age; none passes MAX_RRPV
+            for level in range(self.MAX_RRPV, -1, -1):
+                masks[base + level] = masks[base + level - age] if level >= age else 0
+        distant = masks[base + self.MAX_RRPV]
+        return (distant & -distant).bit_length() - 1
+
+    def peek_victim(self, slot):
+        # aging keeps the order of the ways, so this is the lowest way with the highest prediction
+        masks = self._masks
+        base = slot * self._levels
+        oldest = self.MAX_RRPV
+        while masks[base + oldest] == 0:
+            oldest -= 1
+        mask = masks[base + oldest]
+        return (mask & -mask).bit_length() - 1
+
+    def on_hit(self, slot, way):
+        self._set_rrpv(slot, way, 0)
+
+    def on_fill(self, slot, way):
+        self._set_rrpv(slot, way, self.INSERT_RRPV)
+
+    def on_invalidate(self, slot, way):
+        self._set_rrpv(slot, way, self.MAX_RRPV)
+
+    def eviction_order(self, slot):
+        base = slot * self._levels
+        order = []
+        for level in range(self.MAX_RRPV, -1, -1):
+            mask = self._masks[base + level]
+            order.extend(way for way in range(self.num_ways) if mask >> way & 1)
+        return order
+
+def next_use_indices(blocks):
+    """
+    For each position in a sequence of block addresses, return the position
+    of the next access to the same block, or len(blocks) if there is none.
+    """
+    never = len(blocks)
+    next_use = array.array('q', [never]) * never
+    last_seen = {}
+    for position in range(never - 1, -1, -1):
+        block = blocks[position]
+        next_use[position] = last_seen.get(block, never)
+        last_seen[block] = position
+    return next_use
+
+class OptimalPolicy(ReplacementPolicy):
+    """
+    Belady's optimal policy: replace the block whose next use is furthest in
+    the future. It is built from next_use_indices() over the block addresses
+    of the accesses to be simulated, and must see every one of those
+    accesses, in order, through on_hit/on_fill.
+
+    Each set keeps a max-heap of (next use, way) with stale entries
+    discarded lazily, so each eviction costs O(log ways) amortized.
+    """
+    name = 'optimal'
+    description = 'an optimal (Belady) replacement policy'
+
+    def __init__(self, num_ways, next_use):
+        super().__init__(num_ways)
+        self._next_use = next_use
+        self._position = 0
+        self._never = len(next_use)
+        self._next_use_of_way = array.array('q')
+        self._heaps = []
+
+    def add_sets(self, count):
+        self._next_use_of_way.extend(array.array('q', [self._never]) * (count * self.num_ways))
+        self._heaps.extend([] for _ in range(count))
+
+    def _record_use(self, slot, way):
+        next_use = self._next_use[self._position]
+        self._position += 1
+        self._next_use_of_way[slot * self.num_ways + way] = next_use
+        heap = self._heaps[slot]
+        if len(heap) > 4 * self.num_ways:
+            # drop stale entries so the heap stays O(ways)
+            base = slot * self.num_ways
+            heap[:] = [(-self._next_use_of_way[base + w], w) for w in range(self.num_ways)]
+            heapq.heapify(heap)
+        else:
+            heapq.heappush(heap, (-next_use, way))
+
+    def victim(self, slot):
+        heap = self._heaps[slot]
+        base = slot * self.num_ways
+        while -heap[0][0] != self._next_use_of_way[base + heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][1]
+
+    def peek_victim(self, slot):
+        # victim() only drops stale heap entries
+        return self.victim(slot)
+
+    def on_hit(self, slot, way):
+        self._record_use(slot, way)
+
+    def on_fill(self, slot, way):
+        self._record_use(slot, way)
+
+    def eviction_order(self, slot):
+        base = slot * self.num_ways
+        return sorted(range(self.num_ways), key=lambda way: -self._next_use_of_way[base + way])
+
+POLICIES = {
+    policy.name: policy for policy in [LRUPolicy, FIFOPolicy, RandomPolicy, TreePLRUPolicy, SRRIPPolicy]
+}
+
+def make_policy(name, num_ways):
+    return POLICIES[name](num_ways)
@@ -0,0 +1,70 @@
+# Sampling without replacement from range(1 << bits), for spaces far too
+# large to list (tags and set indices of 64-bit addresses).
+#
+# FeistelPermutation is a keyed pseudorandom bijection on range(1 << bits)
+# that is evaluated one value at a time, so walking positions 0, 1, 2, ...
+# through it visits every value exactly once in a shuffled order without
+# storing the order. A Feistel network permutes an even number of bits; for
+# an odd bits it permutes one bit more and "cycle walks", reapplying the
+# network until the value is back in range (at most twice on average).
+#
+# UnusedSampler keeps a cursor into such a permutation and skips the values
+# the caller says are taken. Since the callers' "taken" sets only grow, a
+# skipped value never needs to be reconsidered, so each value is looked at
+# once over the sampler's whole life, and drawing costs O(1) amortized
+# however much of the space is taken.
+
+import random
+
+_ROUNDS = 4
+_MASK_64 = (1 << 64) - 1
+
+class FeistelPermutation():
+    def __init__(self, bits, rng=random):
+        self.bits = bits
+        self.size = 1 << bits
+        self._half_bits = (bits + 1) // 2
+        self._half_mask = (1 << self._half_bits) - 1
+        self._keys = [rng.getrandbits(64) for _ in range(_ROUNDS)]
+
+    def _round(self, value, key):
+        value = ((value ^ key) * 0x9E3779B97F4A7C15) & _MASK_64
+        value ^= value >> 29
+        value = (value * 0xBF58476D1CE4E5B9) & _MASK_64
+        value ^= value >> 32
+        return value & self._half_mask
+
+    def __call__(self, value):
+        """Return the value at position value of the permutation."""
+        if not (0 <= value < self.size):
+            raise ValueError('{} is not in range(1 << {})'.format(value, self.bits))
+        half_bits = self._half_bits
+        half_mask = self._half_mask
+        while True:
+            left = value >> half_bits
+            right = value & half_mask
+            for key in self._keys:
+                (left, right) = (right, left ^ self._round(right, key))
+            value = (left << half_bits) | right
+            if value < self.size:
+                return value
+
+class UnusedSampler():
+    """
+    Hands out values from range(1 << bits) in pseudorandom order, each at
+    most once, skipping those for which is_taken(value) is true. Values
+    that are taken when skipped must stay taken.
+    """
+    def __init__(self, bits, rng=random):
+        self._permutation = FeistelPermutation(bits, rng)
+        self._position = 0
+
+    def next(self, is_taken):
+        """Return the next value that is not taken, or None if there are no more."""
+        permutation = self._permutation
+        while self._position < permutation.size:
+            value = permutation(self._position)
+            self._position += 1
+            if not is_taken(value):
+                return value
+        return None
@@ -90,6 +90,26 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+#
+# 'patterns' holds generated cache patterns (see cachelab/pattern_cache.py); it
+# should be shared by all the server processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'patterns': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'pattern-cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -0,0 +1,631 @@
+# The cache simulator and the values it works with, independent of Django
+# and the database: cache geometries, accesses, expected results and
+# CacheState. models.py re-exports all of these and stores them;
+# generation.py builds questions out of them.
+
+import array
+import collections.abc
+import json
+import logging
+import math
+
+from . import encoding
+from .replacement import OptimalPolicy, make_policy, next_use_indices
+
+logger = logging.getLogger('cachelab')
+
+class CacheAccess():
+    __slots__ = ('address', 'size', 'kind', 'type')
+
+    def __init__(self, address, size=1, kind=None, type='R'):
+        self.address = address
+        self.size = size
+        self.kind = kind
+        self.type = type
+
+    @property
+    def address_hex(self):
+        return hex(self.address)
+
+    @property
+    def is_write(self):
+        return self.type == 'W'
+
+    @property
+    def is_read(self):
+        return self.type == 'R'
+
+    def as_dump(self):
+        return {
+            'address': self.address,
+            'size': self.size,
+            'kind': self.kind,
+        }
+
+    def __repr__(self):
+        return 'CacheAccess[0x{:x},kind={},size={}]'.format(self.address, self.kind, self.size)
+
+    def __eq__(self, other):
+        return self.address == other.address and self.size == other.size
+
+def format_hex(value, bits=None):
+    if value == None:
+        return ''
+    elif bits != None:
+        width = int((bits + 3) / 4)
+        return '0x{:0{width}x}'.format(value, width=width)
+    else:
+        return '0x{:x}'.format(value)
+
+class ResultItem():
+    __slots__ = ('value', 'string', 'invalid', 'correct')
+
+    def __init__(self, value, string=None, invalid=False, correct=True):
+        self.value = value
+        self.string = string
+        self.invalid = invalid
+        self.correct = correct
+
+    def as_dump(self):
+        return {
+            'value': self.value,
+            'string': self.string,
+            'invalid': self.invalid,
+            'correct': self.correct,
+        }
+
+    @staticmethod
+    def empty_invalid():
+        return ResultItem(None, string='', invalid=True, correct=False)
+
+    def __repr__(self):
+        return '{} ({},invalid={},correct={})'.format(
+            str(self.string),
+            hex(self.value) if self.value != None else '(none)',
+            str(self.invalid),
+            str(self.correct),
+        )
+
+    def __eq__(self, other):
+        return (
+            self.string == other.string and
+            self.value == other.value and
+            self.invalid == other.invalid and
+            self.correct == other.correct
+        )
+
+class CacheAccessResult():
+    __slots__ = ('hit', 'tag', 'index', 'offset', 'evicted', 'miss_type')
+
+    def __init__(self):
+        # for expected results, one of misses.MISS_TYPES for misses (not part of the answer)
+        self.miss_type = None
+
+    @staticmethod
+    def from_reference(hit, tag, index, offset, evicted, tag_bits=None, index_bits=None, offset_bits=None, address_bits=None):
+        self = CacheAccessResult()
+        self.hit = ResultItem(value=hit)
+        self.tag = ResultItem(value=tag, string=format_hex(tag, tag_bits))
+        self.index = ResultItem(value=index, string=format_hex(index, index_bits))
+        self.offset = ResultItem(value=offset, string=format_hex(offset, offset_bits))
+        self.evicted = ResultItem(value=evicted, string=format_hex(evicted, address_bits))
+        return self
+
+    @staticmethod
+    def empty():
+        self = CacheAccessResult()
+        self.hit = ResultItem(None, string='', invalid=True)
+        self.tag = ResultItem(None, string='', invalid=True)
+        self.index = ResultItem(None, string='', invalid=True)
+        self.offset = ResultItem(None, string='', invalid=True)
+        self.evicted = ResultItem(None, string='', invalid=True)
+        return self
+
+    def set_from_string(self, key, value):
+        int_value = value_from_hex(value)
+        setattr(self, key, ResultItem(
+            value=int_value,
+            string=value,
+            invalid=int_value==None,
+            correct=None
+        ))
+        return int_value != None
+
+    def set_bool(self, key, value):
+        setattr(self, key, ResultItem(
+            value=value,
+            invalid=False,
+            correct=None
+        ))
+
+    def set_invalid(self, key):
+        setattr(self, key, ResultItem(
+            value=None,
+            invalid=True,
+            correct=None
+        ))
+
+    def as_dump_reference(self):
+        return {
+            'hit': self.hit.value,
+            'tag': self.tag.value,
+            'index': self.index.value,
+            'offset': self.offset.value,
+            'evicted': self.evicted.value
+        }
+    
+    def as_dump(self):
+        return {
+            'hit': self.hit.as_dump(),
+            'tag': self.tag.as_dump(),
+            'index': self.index.as_dump(),
+            'offset': self.offset.as_dump(),
+            'evicted': self.evicted.as_dump(),
+        }
+
+    def __repr__(self):
+        return 'CacheAccessResult[hit={},tag={},index={},offset={},evicted={}]'.format(
+            repr(self.hit),
+            repr(self.tag),
+            repr(self.index),
+            repr(self.offset),
+            repr(self.evicted),
+        )
+
+    def __eq__(self, other):
+        return (
+            self.hit == other.hit and
+            self.tag == other.tag and
+            self.index == other.index and
+            self.offset == other.offset and
+            self.evicted == other.evicted
+        )
+
+class CacheEntry():
+    __slots__ = ('valid', 'lru', 'tag', 'dirty')
+
+    def __init__(self, data):
+        self.valid = data['valid']
+        self.lru = data['lru']
+        if self.valid:
+            self.tag = data['tag']
+            self.dirty = data['dirty']
+        else:
+            self.tag = self.dirty = None
+
+    def as_dump(self):
+        return {
+            'valid': self.valid,
+            'tag': self.tag,
+            'lru': self.lru,
+            'dirty': self.dirty
+        }
+
+    def __repr__(self):
+        return 'CacheEntry(%s)' % (self.as_dump())
+
+class CacheGeometryMixin():
+    """
+    Derived sizes and address splitting for a class with num_ways, num_sets,
+    block_size and address_bits attributes: CacheGeometry and
+    models.CacheParameters.
+    """
+    @property
+    def offset_bits(self):
+        return int(math.log2(self.block_size))
+    
+    @property
+    def index_bits(self):
+        return int(math.log2(self.num_sets))
+
+    @property
+    def tag_bits(self):
+        return self.address_bits - self.offset_bits - self.index_bits
+
+    @property
+    def set_size_bytes(self):
+        return self.num_ways * self.block_size
+
+    @property
+    def way_size_bytes(self):
+        return self.num_sets * self.block_size
+
+    @property
+    def cache_size_bytes(self):
+        return self.num_ways * self.num_sets * self.block_size
+
+    def split_address(self, address):
+        offset = address & ~((~0) << self.offset_bits)
+        index = (address >> self.offset_bits) & ~((~0) << self.index_bits)
+        tag = (address >> (self.offset_bits + self.index_bits))
+        return (tag, index, offset)
+
+    def unsplit_address(self, tag, index, offset):
+        return (
+            (tag << (self.offset_bits + self.index_bits)) |
+            (index << self.offset_bits) |
+            offset
+        )
+
+    def drop_offset(self, address):
+        return address & ((~0) << self.offset_bits)
+
+    def geometry_key(self):
+        return (self.num_ways, self.num_sets, self.block_size, self.address_bits)
+
+class CacheGeometry(CacheGeometryMixin):
+    """The shape of a cache, like a CacheParameters that is not in the database."""
+    def __init__(self, num_ways, num_sets, block_size, address_bits):
+        self.num_ways = num_ways
+        self.num_sets = num_sets
+        self.block_size = block_size
+        self.address_bits = address_bits
+
+    @staticmethod
+    def of(parameters):
+        """Return a CacheGeometry with the same shape as parameters (e.g. a CacheParameters)."""
+        return CacheGeometry(parameters.num_ways, parameters.num_sets, parameters.block_size, parameters.address_bits)
+
+    def __repr__(self):
+        return 'CacheGeometry(num_ways={}, num_sets={}, block_size={}, address_bits={})'.format(*self.geometry_key())
+
+    def __eq__(self, other):
+        return isinstance(other, CacheGeometry) and self.geometry_key() == other.geometry_key()
+
+    def __hash__(self):
+        return hash(self.geometry_key())
+
+def value_from_hex(x):
+    if x != None and (x.startswith('0x') or x.startswith('0X')):
+        x = x[2:]
+    try:
+        return int(x, 16)
+    except TypeError:
+        return None
+    except ValueError:
+        return None
+
+# caches with more blocks than this default to a sparse CacheState
+SPARSE_STATE_THRESHOLD = 1 << 16
+
+class _SparseRows(collections.abc.Sequence):
+    """Rows of a sparse CacheState, built as they are indexed."""
+    def __init__(self, state):
+        self._state = state
+
+    def __len__(self):
+        return self._state.params.num_sets
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self._state._entries_for_index(index)
+
+class CacheState():
+    """
+    Simulated contents of a cache.
+
+    Per-way state lives in flat arrays indexed by `slot * num_ways + way`,
+    and each set has a map from tag to way for its valid entries, so lookups
+    take constant time. Invalid ways are filled first (lowest way first);
+    otherwise the replacement policy (a name from replacement.POLICIES or a
+    ReplacementPolicy) picks the victim.
+
+    Normally the slot of a set is its index. A sparse state instead assigns
+    slots to sets the first time they are accessed, so its size depends on
+    the number of sets used rather than on the cache geometry; untouched sets
+    read as all-invalid. `sparse` defaults to True for caches with more
+    than SPARSE_STATE_THRESHOLD blocks.
+    """
+    def __init__(self, params, sparse=None, policy='lru'):
+        self.params = params
+        num_sets = params.num_sets
+        num_ways = params.num_ways
+        if sparse == None:
+            sparse = num_sets * num_ways > SPARSE_STATE_THRESHOLD
+        self.sparse = sparse
+        if isinstance(policy, str):
+            policy = make_policy(policy, num_ways)
+        self.policy = policy
+        self._num_ways = num_ways
+        self._all_free = (1 << num_ways) - 1
+        if sparse:
+            self._slot_for_index = {}
+            num_slots = 0
+        else:
+            self._slot_for_index = None
+            num_slots = num_sets
+        num_blocks = num_slots * num_ways
+        self._tags = array.array('Q', bytes(8 * num_blocks))
+        self._valid = bytearray(num_blocks)
+        self._dirty = bytearray(num_blocks)
+        # per-set bit masks of invalid ways
+        self._free = [self._all_free] * num_slots
+        # tag -> way maps, created the first time a set is accessed
+        self._way_for_tag = [None] * num_slots
+        policy.add_sets(num_slots)
+
+    def _slot(self, index, create=True):
+        """Return the slot for a set, or None if it is untouched and create is False."""
+        if self._slot_for_index == None:
+            return index
+        slot = self._slot_for_index.get(index)
+        if slot == None and create:
+            slot = len(self._slot_for_index)
+            self._slot_for_index[index] = slot
+            num_ways = self._num_ways
+            self._tags.frombytes(bytes(8 * num_ways))
+            self._valid.extend(bytes(num_ways))
+            self._dirty.extend(bytes(num_ways))
+            self._free.append(self._all_free)
+            self._way_for_tag.append(None)
+            self.policy.add_sets(1)
+        return slot
+
+    def touched_indices(self):
+        """Return the indices of sets which have been accessed (all sets for a non-sparse state)."""
+        if self._slot_for_index == None:
+            return range(self.params.num_sets)
+        return sorted(self._slot_for_index)
+
+    def _ways_for_slot(self, slot):
+        way_for_tag = self._way_for_tag[slot]
+        if way_for_tag == None:
+            way_for_tag = {}
+            self._way_for_tag[slot] = way_for_tag
+        return way_for_tag
+
+    def _eviction_order(self, slot):
+        """Return the ways of a set in the order they would be replaced, invalid ways first."""
+        base = slot * self._num_ways
+        order = self.policy.eviction_order(slot)
+        return [way for way in order if not self._valid[base + way]] + [way for way in order if self._valid[base + way]]
+
+    def _entries_for_index(self, index):
+        # entries are listed in the order they would be replaced
+        slot = self._slot(index, create=False)
+        if slot == None:
+            return [
+                CacheEntry({'valid': False, 'tag': None, 'lru': way, 'dirty': False})
+                for way in range(self._num_ways)
+            ]
+        base = slot * self._num_ways
+        return [
+            CacheEntry({
+                'valid': self._valid[base + way] == 1,
+                'tag': self._tags[base + way],
+                'lru': lru,
+                'dirty': self._dirty[base + way] == 1,
+            })
+            for lru, way in enumerate(self._eviction_order(slot))
+        ]
+
+    def to_entries(self):
+        if self.sparse:
+            return _SparseRows(self)
+        return [self._entries_for_index(index) for index in range(self.params.num_sets)]
+
+    entries = property(to_entries)
+
+    def get_recentness(self, address):
+        """Return how many valid blocks in address's set would be replaced before it, or None if it is not cached."""
+        (tag, index, _) = self.params.split_address(address)
+        slot = self._slot(index, create=False)
+        if slot == None:
+            return None
+        found = self._ways_for_slot(slot).get(tag)
+        if found == None:
+            return None
+        base = slot * self._num_ways
+        missing_entries = 0
+        for lru, way in enumerate(self._eviction_order(slot)):
+            if not self._valid[base + way]:
+                missing_entries += 1
+            elif way == found:
+                return lru - missing_entries
+
+    def next_victim(self, index):
+        """Return the address of the valid block in a set which would be replaced next (None if there is none)."""
+        slot = self._slot(index, create=False)
+        if slot == None:
+            return None
+        base = slot * self._num_ways
+        for way in self.policy.eviction_order(slot):
+            if self._valid[base + way]:
+                return self.params.unsplit_address(self._tags[base + way], index, 0)
+        return None
+
+    def _choose_victim(self, slot, dry_run):
+        free = self._free[slot]
+        if free:
+            return (free & -free).bit_length() - 1
+        if dry_run:
+            return self.policy.peek_victim(slot)
+        return self.policy.victim(slot)
+
+    def _access(self, tag, index, is_write, dry_run):
+        """Look up and (unless dry_run) update a set; return (was_hit, evicted block address or None, evicted_dirty)."""
+        slot = self._slot(index)
+        way_for_tag = self._ways_for_slot(slot)
+        found = way_for_tag.get(tag)
+        was_hit = found != None
+        evicted = None
+        evicted_dirty = False
+        if was_hit:
+            if not dry_run:
+                self.policy.on_hit(slot, found)
+        else:
+            # FIXME: record dirty flush here
+            found = self._choose_victim(slot, dry_run)
+            block = slot * self._num_ways + found
+            if self._valid[block]:
+                logger.debug('evicted %x', self._tags[block])
+                evicted = self.params.unsplit_address(self._tags[block], index, 0)
+                evicted_dirty = self._dirty[block] == 1
+            else:
+                logger.debug('no eviction')
+            if not dry_run:
+                if self._valid[block]:
+                    del way_for_tag[self._tags[block]]
+                way_for_tag[tag] = found
+                self._valid[block] = 1
+                self._free[slot] &= ~(1 << found)
+                self._tags[block] = tag
+                self._dirty[block] = 0
+                self.policy.on_fill(slot, found)
+        # FIXME: conditional on is_writeback?
+        if is_write and not dry_run:
+            self._dirty[slot * self._num_ways + found] = 1
+        return (was_hit, evicted, evicted_dirty)
+
+    def access_address(self, address, is_write=False):
+        """Like apply_access, but return just (was_hit, evicted block address or None, evicted_dirty)."""
+        (tag, index, _) = self.params.split_address(address)
+        return self._access(tag, index, is_write, False)
+
+    def _find(self, address):
+        (tag, index, _) = self.params.split_address(address)
+        slot = self._slot(index, create=False)
+        if slot == None:
+            return (None, None)
+        return (slot, self._ways_for_slot(slot).get(tag))
+
+    def mark_dirty(self, address):
+        """Mark a cached block dirty without updating the replacement state; return False if it is not cached."""
+        (slot, way) = self._find(address)
+        if way == None:
+            return False
+        self._dirty[slot * self._num_ways + way] = 1
+        return True
+
+    def invalidate(self, address):
+        """Remove a block, returning whether it was dirty, or None if it was not cached."""
+        (slot, way) = self._find(address)
+        if way == None:
+            return None
+        block = slot * self._num_ways + way
+        del self._way_for_tag[slot][self._tags[block]]
+        dirty = self._dirty[block] == 1
+        self._valid[block] = 0
+        self._dirty[block] = 0
+        self._free[slot] |= 1 << way
+        self.policy.on_invalidate(slot, way)
+        return dirty
+
+    def apply_access(self, access, dry_run=False):
+        (tag, index, offset) = self.params.split_address(access.address)
+        logger.debug('apply_access(%x,%x,%x)', tag, index, offset)
+        (was_hit, evicted, _) = self._access(tag, index, access.is_write, dry_run)
+        return CacheAccessResult.from_reference(
+            hit=was_hit,
+            tag=tag,
+            index=index,
+            offset=offset,
+            evicted=evicted,
+            tag_bits=self.params.tag_bits,
+            index_bits=self.params.index_bits,
+            offset_bits=self.params.offset_bits,
+            address_bits=self.params.address_bits,
+        )
+
+    def to_json(self):
+        """
+        Dump the state as JSON: a list of rows of entries, or for a sparse state
+        {"sparse": true, "sets": {index: row}} with only the touched sets.
+        """
+        if self.sparse:
+            return json.dumps({
+                'sparse': True,
+                'sets': {
+                    str(index): list(map(lambda x: x.as_dump(), self._entries_for_index(index)))
+                    for index in self.touched_indices()
+                },
+            })
+        return json.dumps(list(
+            map(lambda row: list(map(lambda x: x.as_dump(), row)),
+                self.to_entries())
+        ))
+
+    @staticmethod
+    def from_json(params, the_json, policy='lru'):
+        """
+        Load a state saved by to_json. The policy's state is rebuilt from the
+        saved replacement order, which is exact for LRU and FIFO.
+        """
+        raw_data = json.loads(the_json)
+        if isinstance(raw_data, dict):
+            state = CacheState(params, sparse=True, policy=policy)
+            raw_rows = ((int(index), raw_row) for index, raw_row in raw_data['sets'].items())
+        else:
+            state = CacheState(params, sparse=False, policy=policy)
+            raw_rows = enumerate(raw_data)
+        for index, raw_row in raw_rows:
+            slot = state._slot(index)
+            base = slot * state._num_ways
+            way_for_tag = state._ways_for_slot(slot)
+            for way, raw_entry in enumerate(raw_row):
+                entry = CacheEntry(raw_entry)
+                if entry.valid:
+                    state._valid[base + way] = 1
+                    state._free[slot] &= ~(1 << way)
+                    state._tags[base + way] = entry.tag
+                    state._dirty[base + way] = 1 if entry.dirty else 0
+                    way_for_tag[entry.tag] = way
+            state.policy.restore_order(slot, sorted(range(len(raw_row)), key=lambda way: raw_row[way]['lru']))
+        return state
+
+    def dumps(self):
+        """Encode the state compactly (see encoding.pack_state); loads() reverses this."""
+        indices = list(self.touched_indices())
+        tags = array.array('Q')
+        valid = bytearray()
+        dirty = bytearray()
+        for index in indices:
+            slot = self._slot(index, create=False)
+            base = slot * self._num_ways
+            for way in self._eviction_order(slot):
+                block = base + way
+                valid.append(self._valid[block])
+                dirty.append(self._dirty[block])
+                tags.append(self._tags[block] if self._valid[block] else 0)
+        return encoding.pack_state(self.sparse, self._num_ways, self.params.tag_bits, indices, tags, valid, dirty)
+
+    @staticmethod
+    def loads(params, raw, policy='lru'):
+        """Load a state saved by dumps() or to_json()."""
+        if not encoding.is_packed(raw):
+            return CacheState.from_json(params, raw, policy=policy)
+        (sparse, num_ways, indices, tags, flags) = encoding.unpack_state(raw)
+        state = CacheState(params, sparse=sparse, policy=policy)
+        for row, index in enumerate(indices):
+            slot = state._slot(index)
+            base = slot * num_ways
+            way_for_tag = state._ways_for_slot(slot)
+            for way in range(num_ways):
+                entry = row * num_ways + way
+                (valid, dirty) = encoding.entry_flags(flags, entry)
+                if valid:
+                    state._valid[base + way] = 1
+                    state._free[slot] &= ~(1 << way)
+                    state._tags[base + way] = tags[entry]
+                    state._dirty[base + way] = 1 if dirty else 0
+                    way_for_tag[tags[entry]] = way
+            # entries were saved in replacement order
+            state.policy.restore_order(slot, range(num_ways))
+        return state
+
+def count_optimal_misses(params, accesses):
+    """Return the number of misses for a sequence of accesses under Belady's optimal replacement."""
+    accesses = list(accesses)
+    next_use = next_use_indices([params.drop_offset(access.address) for access in accesses])
+    state = CacheState(params, policy=OptimalPolicy(params.num_ways, next_use))
+    misses = 0
+    for access in accesses:
+        (was_hit, _, _) = state.access_address(access.address, access.is_write)
+        if not was_hit:
+            misses += 1
+    return misses
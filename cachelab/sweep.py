@@ -0,0 +1,85 @@
+# Hit/miss counts for many LRU cache geometries from one pass over a trace.
+#
+# LRU has the inclusion property: an access hits in a W-way set exactly when
+# fewer than W other blocks of that set were used since the block was last
+# accessed (its "stack distance", Mattson et al. 1970). So keeping, for each
+# set, the blocks in most-recently-used order and histogramming the position
+# of each access gives the hit count for every associativity at once. Set
+# counts are swept by bucketing the same block numbers under each index mask.
+
+import math
+
+class StackDistanceSweep():
+    """
+    Accumulates per-set LRU stack distance histograms for a fixed block size
+    and several set counts (each a power of two), tracking stack distances up
+    to max_ways.
+    """
+    def __init__(self, block_size, set_counts, max_ways):
+        self.offset_bits = int(math.log2(block_size))
+        self.block_size = block_size
+        self.set_counts = sorted(set(set_counts))
+        self.max_ways = max_ways
+        self.accesses = 0
+        # for each set count: index -> list of block numbers, most recent first
+        self._stacks = [{} for _ in self.set_counts]
+        self._histograms = [[0] * max_ways for _ in self.set_counts]
+
+    def add_addresses(self, addresses):
+        offset_bits = self.offset_bits
+        max_ways = self.max_ways
+        per_set_count = list(zip(
+            self._stacks,
+            self._histograms,
+            [num_sets - 1 for num_sets in self.set_counts],
+        ))
+        count = 0
+        for address in addresses:
+            count += 1
+            block = address >> offset_bits
+            for stacks, histogram, index_mask in per_set_count:
+                index = block & index_mask
+                stack = stacks.get(index)
+                if stack == None:
+                    stacks[index] = [block]
+                    continue
+                try:
+                    distance = stack.index(block)
+                except ValueError:
+                    stack.insert(0, block)
+                    if len(stack) > max_ways:
+                        stack.pop()
+                    continue
+                histogram[distance] += 1
+                if distance > 0:
+                    del stack[distance]
+                    stack.insert(0, block)
+        self.accesses += count
+
+    def hits(self, num_sets, num_ways):
+        if num_ways > self.max_ways:
+            raise ValueError('num_ways {} is larger than max_ways {}'.format(num_ways, self.max_ways))
+        histogram = self._histograms[self.set_counts.index(num_sets)]
+        return sum(histogram[:num_ways])
+
+    def misses(self, num_sets, num_ways):
+        return self.accesses - self.hits(num_sets, num_ways)
+
+def sweep_parameters(parameters_list, addresses):
+    """
+    Return a list of (parameters, hits, misses) for each of parameters_list,
+    which must share a block size, from a single pass over addresses.
+    """
+    block_sizes = set(parameters.block_size for parameters in parameters_list)
+    if len(block_sizes) != 1:
+        raise ValueError('all parameters must have the same block size')
+    sweep = StackDistanceSweep(
+        block_size=block_sizes.pop(),
+        set_counts=[parameters.num_sets for parameters in parameters_list],
+        max_ways=max(parameters.num_ways for parameters in parameters_list),
+    )
+    sweep.add_addresses(addresses)
+    return [
+        (parameters, sweep.hits(parameters.num_sets, parameters.num_ways), sweep.misses(parameters.num_sets, parameters.num_ways))
+        for parameters in parameters_list
+    ]
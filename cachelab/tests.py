@@ -1,11 +1,19 @@
-from django.test import Client, TestCase
+from django.test import Client, SimpleTestCase, TestCase
 
 from .models import *
 
+import io
+import json
 import random
+import unittest
 
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger('cachelab')
 
 # Create your tests here.
@@ -23,39 +31,602 @@ class PatternQuestionTest(TestCase):
             )
 
     def test_generate_parameter_sweep(self):
-        for offset_bits in range(0, 4):
-            for index_bits in range(0, 4):
-                for ways in range(1, 4):
-                    for address_bits in range(offset_bits + index_bits + ways + 1, offset_bits + index_bits + 6):
-                        parameters = CacheParameters.get(
-                            num_ways=ways,
-                            num_sets=1<<index_bits,
-                            block_size=1<<offset_bits,
-                            address_bits=address_bits,
-                        )
-                        for trial in range(6):
-                            is_huge = trial > 5
-                            with self.subTest(offset_bits=offset_bits, index_bits=index_bits, ways=ways, trial=trial, address_bits=address_bits, is_huge=is_huge):
-                                random.seed(trial)
-                                desired_actions = ['random_miss'] + (['setup_conflict_aggressive'] * (ways)) + ['conflict_miss'] + \
-                                                    ['hit', 'random_miss', 'conflict_miss', 'hit', 'hit']
-                                question = PatternQuestion.generate_random(parameters, 'test',
-                                    num_accesses=len(desired_actions) if not is_huge else 1000,
-                                    start_actions=desired_actions
-                                    )
-                                accesses = question.pattern.accesses
-                                results = question.pattern.access_results
-                                self.assertEqual(len(results), len(desired_actions) if not is_huge else 1000)
-                                for expect_type, result, access in zip(desired_actions, results, accesses):
-                                    self.assertEqual(expect_type, access.kind)
-                                    if 'miss' in expect_type:
-                                        self.assertFalse(result.hit.value)
-                                    elif 'hit' in expect_type:
-                                        self.assertTrue(result.hit.value)
-                                    if expect_type == 'conflict_miss':
-                                        self.assertTrue(result.evicted.value != None)
+        from .generation import parameter_sweep_cases
+        for geometry, seed, desired_actions in parameter_sweep_cases():
+            parameters = CacheParameters.for_geometry(geometry)
+            with self.subTest(geometry=geometry.geometry_key(), seed=seed):
+                random.seed(seed)
+                question = PatternQuestion.generate_random(parameters, 'test',
+                    num_accesses=len(desired_actions),
+                    start_actions=desired_actions
+                    )
+                accesses = question.pattern.accesses
+                results = question.pattern.access_results
+                self.assertEqual(len(results), len(desired_actions))
+                for expect_type, result, access in zip(desired_actions, results, accesses):
+                    self.assertEqual(expect_type, access.kind)
+                    if 'miss' in expect_type:
+                        self.assertFalse(result.hit.value)
+                    elif 'hit' in expect_type:
+                        self.assertTrue(result.hit.value)
+                    if expect_type == 'conflict_miss':
+                        self.assertTrue(result.evicted.value != None)
+
+    def test_generate_kinds(self):
+        parameters = CacheParameters.get(num_ways=4, num_sets=8, block_size=4, address_bits=12)
+        random.seed(7)
+        actions = ['random_miss'] + ['setup_conflict_aggressive', 'hit_lru', 'setup_conflict', 'hit'] * 50
+        pattern = CachePattern.generate_random(parameters, num_accesses=len(actions), start_actions=actions)
+        state = CacheState(parameters)
+        used_indices = set()
+        for access in pattern.accesses:
+            (_, index, _) = parameters.split_address(access.address)
+            if access.kind == 'hit_lru':
+                self.assertEqual(state.get_recentness(access.address), 0)
+            elif access.kind in ('setup_conflict', 'setup_conflict_aggressive'):
+                self.assertIn(index, used_indices)
+            result = state.apply_access(access)
+            if access.kind.startswith('hit'):
+                self.assertTrue(result.hit.value)
+            else:
+                self.assertFalse(result.hit.value)
+            used_indices.add(index)
+        self.assertEqual(pattern.access_results, CachePattern.objects.get(pattern_id=pattern.pattern_id).access_results)
+
+    def test_generate_nearly_full(self):
+        # fills every set, so the last few unused ones are found by the sampler
+        parameters = CacheParameters.get(num_ways=2, num_sets=64, block_size=1, address_bits=64)
+        random.seed(8)
+        actions = ['miss_prefer_empty'] * 64
+        pattern = CachePattern.generate_random(parameters, num_accesses=len(actions), start_actions=actions)
+        indices = [parameters.split_address(access.address)[1] for access in pattern.accesses]
+        self.assertEqual(sorted(indices), list(range(64)))
+        parameters = CacheParameters.get(num_ways=1, num_sets=1, block_size=1, address_bits=6)
+        actions = ['random_miss'] + ['miss_prefer_used'] * 200
+        pattern = CachePattern.generate_random(parameters, num_accesses=len(actions), start_actions=actions)
+        for result in pattern.access_results:
+            self.assertFalse(result.hit.value)
+
+class SamplingTest(TestCase):
+    def test_permutation(self):
+        from .sampling import FeistelPermutation
+        for bits in range(0, 10):
+            with self.subTest(bits=bits):
+                permutation = FeistelPermutation(bits, random.Random(bits))
+                self.assertEqual(sorted(map(permutation, range(1 << bits))), list(range(1 << bits)))
+        permutation = FeistelPermutation(64, random.Random(1))
+        values = [permutation(position) for position in range(1000)]
+        self.assertEqual(len(set(values)), 1000)
+        self.assertTrue(all(0 <= value < 1 << 64 for value in values))
+        self.assertGreater(max(values), 1 << 60)
+
+    def test_unused(self):
+        from .sampling import UnusedSampler
+        taken = set(range(0, 1 << 12, 3))
+        sampler = UnusedSampler(12, random.Random(2))
+        drawn = []
+        while True:
+            value = sampler.next(taken.__contains__)
+            if value == None:
+                break
+            drawn.append(value)
+            taken.add(value)
+        self.assertEqual(sorted(drawn), [value for value in range(1 << 12) if value % 3 != 0])
+        self.assertNotEqual(drawn, sorted(drawn))
+
+class GenerationTest(SimpleTestCase):
+    # SimpleTestCase fails on any database query
+    def test_pure(self):
+        from .generation import generate_parameter_question, generate_pattern, random_geometry_for_pattern
+        geometry = CacheGeometry(num_ways=2, num_sets=8, block_size=4, address_bits=12)
+        first = generate_pattern(geometry, 5, num_accesses=30)
+        second = generate_pattern(geometry, random.Random(5), num_accesses=30)
+        self.assertEqual(first.accesses, second.accesses)
+        self.assertEqual([access.kind for access in first.accesses], [access.kind for access in second.accesses])
+        self.assertEqual(first.results, second.results)
+        self.assertEqual(first.final_state.dumps(), second.final_state.dumps())
+        state = CacheState(geometry)
+        for access, result in zip(first.accesses, first.results):
+            self.assertEqual(state.apply_access(access), result)
+        rng = random.Random(1)
+        self.assertEqual(random_geometry_for_pattern(rng), random_geometry_for_pattern(random.Random(1)))
+        question = generate_parameter_question(3)
+        self.assertEqual(sorted(question.given_parts + question.missing_parts), sorted(all_cache_question_parameters))
+        self.assertEqual(question.given_parts, generate_parameter_question(3).given_parts)
+
+class GeneratedPatternSaveTest(TestCase):
+    def test_bulk_create(self):
+        from .generation import generate_pattern, random_geometry_for_pattern
+        rng = random.Random(4)
+        generated = [generate_pattern(random_geometry_for_pattern(rng), rng) for _ in range(20)]
+        # start from an empty registry, and forget the rows interned below, which are rolled back with the test
+        parameters_registry.clear()
+        self.addCleanup(parameters_registry.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            CacheParameters.for_geometry(generated[0].geometry)
+        # every pattern geometry was created and interned, so only the insert is left
+        with self.assertNumQueries(1):
+            patterns = CachePattern.bulk_create_generated(generated)
+        for item, pattern in zip(generated, patterns):
+            loaded = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+            self.assertEqual(loaded.parameters.geometry_key(), item.geometry.geometry_key())
+            self.assertEqual(loaded.accesses, item.accesses)
+            self.assertEqual(loaded.access_results, item.results)
+
+class ParametersRegistryTest(TestCase):
+    def test_interned(self):
+        from django.db import IntegrityError, transaction
+        parameters_registry.clear()
+        self.addCleanup(parameters_registry.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=8)
+        with self.assertNumQueries(0):
+            self.assertEqual(CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=8).pk, parameters.pk)
+            pattern_parameters = random_parameters_for_pattern()
+        self.assertEqual(CacheParameters.objects.get(pk=pattern_parameters.pk).geometry_key(), pattern_parameters.geometry_key())
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                CacheParameters.objects.create(num_ways=2, num_sets=4, block_size=8, address_bits=8)
+        # not interned until committed
+        parameters_registry.clear()
+        CacheParameters.get(num_ways=1, num_sets=4, block_size=8, address_bits=8)
+        with self.assertNumQueries(1):
+            CacheParameters.get(num_ways=1, num_sets=4, block_size=8, address_bits=8)
+
+class CacheStateTest(TestCase):
+    def test_lru_order(self):
+        # 4 offset bits, 1 set bit, 3 tag bits
+        parameters = CacheParameters(num_ways=2, num_sets=2, block_size=16, address_bits=8)
+        state = CacheState(parameters)
+        for address in [0x00, 0x20, 0x00, 0x40, 0x10]:
+            state.apply_access(CacheAccess(address))
+        self.assertEqual(state.get_recentness(0x00), 0)
+        self.assertEqual(state.get_recentness(0x40), 1)
+        self.assertEqual(state.get_recentness(0x20), None)
+        entries = state.to_entries()
+        self.assertEqual([(e.valid, e.tag, e.lru) for e in entries[0]], [(True, 0, 0), (True, 2, 1)])
+        self.assertEqual([(e.valid, e.tag, e.lru) for e in entries[1]], [(False, None, 0), (True, 0, 1)])
+        result = state.apply_access(CacheAccess(0x60))
+        self.assertFalse(result.hit.value)
+        self.assertEqual(result.evicted.value, 0x00)
+        restored = CacheState.from_json(parameters, state.to_json())
+        self.assertEqual(restored.to_json(), state.to_json())
+        self.assertTrue(restored.apply_access(CacheAccess(0x40)).hit.value)
+
+    def test_sparse_matches_dense(self):
+        parameters = CacheParameters(num_ways=3, num_sets=16, block_size=4, address_bits=12)
+        dense = CacheState(parameters, sparse=False)
+        sparse = CacheState(parameters, sparse=True)
+        random.seed(1)
+        for _ in range(200):
+            access = CacheAccess(random.randrange(0, 1 << 12))
+            self.assertEqual(dense.apply_access(access), sparse.apply_access(access))
+        self.assertEqual(
+            [[e.as_dump() for e in row] for row in dense.to_entries()],
+            [[e.as_dump() for e in row] for row in sparse.to_entries()],
+        )
+        restored = CacheState.from_json(parameters, sparse.to_json())
+        self.assertTrue(restored.sparse)
+        self.assertEqual(restored.to_json(), sparse.to_json())
+
+    def test_sparse_huge_geometry(self):
+        parameters = CacheParameters(num_ways=12, num_sets=1 << 24, block_size=64, address_bits=64)
+        state = CacheState(parameters)
+        self.assertTrue(state.sparse)
+        state.apply_access(CacheAccess(0x1234_5678_9ac0))
+        self.assertEqual(len(state.touched_indices()), 1)
+        untouched = state.to_entries()[0]
+        self.assertEqual(len(untouched), 12)
+        self.assertFalse(any(e.valid for e in untouched))
+
+class EncodingTest(TestCase):
+    def test_accesses(self):
+        from . import encoding
+        accesses = [(0, 1, None, 'R'), ((1 << 64) - 1, 2, 'hit_lru', 'W'), (0x1234, 8, 'conflict_miss', 'R')]
+        packed = encoding.pack_accesses(accesses)
+        self.assertTrue(encoding.is_packed(packed))
+        self.assertEqual(encoding.unpack_accesses(packed), accesses)
+        self.assertEqual(list(encoding.unpack_addresses(packed)), [0, (1 << 64) - 1, 0x1234])
+        self.assertEqual(encoding.pack_accesses([(0, 1, 'unknown kind', 'R')]), None)
+
+    def test_state(self):
+        for sparse in [False, True]:
+            with self.subTest(sparse=sparse):
+                parameters = CacheParameters(num_ways=3, num_sets=16, block_size=4, address_bits=20)
+                state = CacheState(parameters, sparse=sparse)
+                random.seed(4)
+                for _ in range(100):
+                    state.apply_access(CacheAccess(random.randrange(0, 1 << 20), type=random.choice(['R', 'W'])))
+                restored = CacheState.loads(parameters, state.dumps())
+                self.assertEqual(restored.sparse, sparse)
+                self.assertEqual(restored.to_json(), state.to_json())
+                self.assertEqual(CacheState.loads(parameters, state.to_json()).to_json(), state.to_json())
+                for _ in range(100):
+                    access = CacheAccess(random.randrange(0, 1 << 20))
+                    self.assertEqual(restored.apply_access(access), state.apply_access(access))
+
+    def test_legacy_pattern(self):
+        from django.core.management import call_command
+        parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=12)
+        random.seed(5)
+        pattern = CachePattern.generate_random(parameters, num_accesses=20)
+        self.assertTrue(pattern.accesses_raw.startswith('b1:'))
+        accesses = [access.as_dump() for access in pattern.accesses]
+        expected = pattern.access_results
+        CachePattern.objects.filter(pattern_id=pattern.pattern_id).update(
+            accesses_raw=json.dumps(accesses), results_raw='', final_state_raw='',
+        )
+        legacy = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        self.assertEqual([access.as_dump() for access in legacy.accesses], accesses)
+        # a dry run must not fill in the missing results
+        call_command('pack_patterns', dry_run=True, stdout=io.StringIO())
+        unchanged = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        for field in ['accesses_raw', 'results_raw', 'final_state_raw']:
+            self.assertEqual(getattr(unchanged, field), getattr(legacy, field))
+        CachePattern.objects.filter(pattern_id=pattern.pattern_id).update(
+            results_raw=json.dumps([list(result.as_dump_reference().values()) for result in expected]),
+            final_state_raw=pattern.final_state.to_json(),
+        )
+        legacy = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        self.assertEqual(legacy.access_results, expected)
+        call_command('pack_patterns', stdout=io.StringIO())
+        packed = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        for field in ['accesses_raw', 'results_raw', 'final_state_raw']:
+            self.assertTrue(getattr(packed, field).startswith('b1:'))
+        self.assertEqual(packed.optimal_miss_count, pattern.optimal_miss_count)
+        # packed rows saved before the optimal miss count was stored get it too
+        CachePattern.objects.filter(pattern_id=pattern.pattern_id).update(
+            results_raw=encoding.pack_results([r.hit.value for r in expected], [r.evicted.value for r in expected]),
+        )
+        call_command('pack_patterns', stdout=io.StringIO())
+        packed = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        self.assertEqual(encoding.unpack_optimal_misses(packed.results_raw), pattern.optimal_miss_count)
+        self.assertEqual([access.as_dump() for access in packed.accesses], accesses)
+        self.assertEqual(packed.access_results, expected)
+        self.assertEqual(packed.final_state.to_json(), pattern.final_state.to_json())
+
+class ReplacementPolicyTest(TestCase):
+    def _evictions(self, policy, addresses, num_ways=2):
+        parameters = CacheParameters(num_ways=num_ways, num_sets=1, block_size=1, address_bits=8)
+        state = CacheState(parameters, policy=policy)
+        return [state.apply_access(CacheAccess(address)).evicted.value for address in addresses]
+
+    def test_lru_and_fifo(self):
+        addresses = [1, 2, 1, 3, 4]
+        self.assertEqual(self._evictions('lru', addresses), [None, None, None, 2, 1])
+        self.assertEqual(self._evictions('fifo', addresses), [None, None, None, 1, 2])
+
+    def test_tree_plru(self):
+        # after 0, 1, 2, 3 and a hit on 0, the tree points away from 0 and 1, then away from 2
+        self.assertEqual(self._evictions('plru', [0, 1, 2, 3, 0, 4, 5], num_ways=4), [None] * 5 + [2, 1])
+
+    def test_srrip(self):
+        # 1 is re-referenced, so the other blocks (inserted with a long prediction) go first
+        self.assertEqual(self._evictions('srrip', [1, 2, 1, 3, 4]), [None, None, None, 2, 3])
+
+    def test_srrip_matches_reference(self):
+        # a direct implementation of SRRIP, keeping each way's prediction value
+        def reference_evictions(addresses, num_ways):
+            blocks = []
+            rrpv = []
+            evicted = []
+            for address in addresses:
+                if address in blocks:
+                    rrpv[blocks.index(address)] = 0
+                    evicted.append(None)
+                    continue
+                if len(blocks) < num_ways:
+                    blocks.append(address)
+                    rrpv.append(2)
+                    evicted.append(None)
+                    continue
+                oldest = max(rrpv)
+                rrpv = [value + 3 - oldest for value in rrpv]
+                way = rrpv.index(3)
+                evicted.append(blocks[way])
+                blocks[way] = address
+                rrpv[way] = 2
+            return evicted
+        rng = random.Random(16)
+        for num_ways in [1, 4, 70]:
+            addresses = [rng.randrange(num_ways * 2) for _ in range(500)]
+            self.assertEqual(self._evictions('srrip', addresses, num_ways=num_ways), reference_evictions(addresses, num_ways))
+
+    def test_dry_run_leaves_policy_alone(self):
+        rng = random.Random(5)
+        addresses = [rng.randrange(8) for _ in range(300)]
+        peeked_addresses = [rng.randrange(8) for _ in range(300)]
+        parameters = CacheParameters(num_ways=4, num_sets=1, block_size=1, address_bits=8)
+        for policy in POLICIES:
+            with self.subTest(policy=policy):
+                state = CacheState(parameters, policy=policy)
+                peeking_state = CacheState(parameters, policy=policy)
+                for address, peeked_address in zip(addresses, peeked_addresses):
+                    # a dry run of the same access reports what the real one does
+                    access = CacheAccess(address)
+                    peeked = peeking_state.apply_access(access, dry_run=True)
+                    peeking_state.apply_access(CacheAccess(peeked_address), dry_run=True)
+                    result = peeking_state.apply_access(access)
+                    self.assertEqual(peeked.evicted.value, result.evicted.value)
+                    self.assertEqual(result.evicted.value, state.apply_access(access).evicted.value)
+
+    def test_generate_with_policy(self):
+        parameters = CacheParameters.get(num_ways=4, num_sets=2, block_size=4, address_bits=8)
+        for policy in POLICIES:
+            with self.subTest(policy=policy):
+                random.seed(0)
+                pattern = CachePattern.generate_random(parameters, num_accesses=40, replacement_policy=policy)
+                pattern = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+                self.assertEqual(pattern.replacement_policy, policy)
+                for access, result in zip(pattern.accesses, pattern.access_results):
+                    if access.kind in ('hit', 'hit_lru'):
+                        self.assertTrue(result.hit.value)
+                    elif 'miss' in access.kind:
+                        self.assertFalse(result.hit.value)
+
+    def test_optimal(self):
+        parameters = CacheParameters(num_ways=2, num_sets=1, block_size=1, address_bits=8)
+        addresses = [1, 2, 3, 1, 2, 4, 1, 2]
+        next_use = next_use_indices(addresses)
+        self.assertEqual(list(next_use), [3, 4, 8, 6, 7, 8, 8, 8])
+        state = CacheState(parameters, policy=OptimalPolicy(2, next_use))
+        # 3 replaces 2 (next used after 1), then 2 replaces 3 (never used again)
+        evictions = [state.apply_access(CacheAccess(address)).evicted.value for address in addresses]
+        self.assertEqual(evictions[:6], [None, None, 2, None, 3, 2])
+        accesses = [CacheAccess(address) for address in addresses]
+        self.assertEqual(count_optimal_misses(parameters, accesses), 6)
+
+    def test_optimal_never_worse(self):
+        parameters = CacheParameters.get(num_ways=2, num_sets=2, block_size=4, address_bits=8)
+        for seed in range(5):
+            random.seed(seed)
+            pattern = CachePattern.generate_random(parameters, num_accesses=30)
+            self.assertLessEqual(pattern.optimal_miss_count, pattern.miss_count)
+
+    def test_optimal_stored(self):
+        from unittest import mock
+        parameters = CacheParameters.get(num_ways=2, num_sets=2, block_size=4, address_bits=8)
+        random.seed(6)
+        pattern = CachePattern.generate_random(parameters, num_accesses=30)
+        expected = count_optimal_misses(parameters, pattern.accesses)
+        loaded = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        # read from the stored results, not simulated again
+        with mock.patch('cachelab.models.count_optimal_misses', side_effect=AssertionError('recomputed')):
+            self.assertEqual(loaded.optimal_miss_count, expected)
+
+@unittest.skipIf(numpy == None, 'numpy is not installed')
+class BatchSimulatorTest(TestCase):
+    def test_matches_cache_state(self):
+        from .batch import BatchSimulator
+        parameters = CacheParameters(num_ways=3, num_sets=8, block_size=4, address_bits=16)
+        random.seed(2)
+        addresses = [random.randrange(0, 1 << 9) for _ in range(400)]
+        state = CacheState(parameters)
+        simulator = BatchSimulator(parameters)
+        # split into two chunks to check that state carries over
+        results = [simulator.simulate(addresses[:150]), simulator.simulate(numpy.array(addresses[150:], dtype=numpy.uint64))]
+        batch = {k: numpy.concatenate([getattr(r, k) for r in results]) for k in results[0]._fields}
+        for i, address in enumerate(addresses):
+            expected = state.apply_access(CacheAccess(address))
+            self.assertEqual(expected.hit.value, batch['hit'][i])
+            self.assertEqual(expected.tag.value, batch['tag'][i])
+            self.assertEqual(expected.index.value, batch['index'][i])
+            self.assertEqual(expected.offset.value, batch['offset'][i])
+            self.assertEqual(expected.evicted.value != None, batch['has_evicted'][i])
+            if expected.evicted.value != None:
+                self.assertEqual(expected.evicted.value, batch['evicted'][i])
+
+    def test_parallel_matches_serial(self):
+        from .batch import ParallelSimulator, simulate_batch
+        parameters = CacheParameters(num_ways=2, num_sets=16, block_size=4, address_bits=16)
+        addresses = numpy.random.default_rng(4).integers(0, 1 << 10, size=5000, dtype=numpy.uint64)
+        serial = simulate_batch(parameters, addresses)
+        with ParallelSimulator(parameters, processes=3) as simulator:
+            parallel = [simulator.simulate(addresses[:2000]), simulator.simulate(addresses[2000:])]
+        for field in serial._fields:
+            self.assertTrue((getattr(serial, field) == numpy.concatenate([getattr(r, field) for r in parallel])).all(), field)
+
+class TraceReaderTest(TestCase):
+    def test_read_lackey(self):
+        from .traces import read_lackey
+        lines = [
+            '==123== Lackey, an example Valgrind tool',
+            'I  04016b00,3',
+            ' L 04222cac,8',
+            ' S 7ff000398,8',
+            ' M 0421c7f0,4',
+        ]
+        accesses = list(read_lackey(lines))
+        self.assertEqual([(a.address, a.size, a.type) for a in accesses], [
+            (0x04222cac, 8, 'R'),
+            (0x7ff000398, 8, 'W'),
+            (0x0421c7f0, 4, 'R'),
+            (0x0421c7f0, 4, 'W'),
+        ])
+        self.assertTrue(accesses[1].is_write)
+
+    def test_read_din(self):
+        from .traces import address_chunks, read_din
+        accesses = list(read_din(['0 1000', '1 1004', '2 2000', '4 0']))
+        self.assertEqual([(a.address, a.type) for a in accesses], [(0x1000, 'R'), (0x1004, 'W'), (0x2000, 'R')])
+        self.assertEqual([list(chunk) for chunk in address_chunks(accesses, 2)], [[0x1000, 0x1004], [0x2000]])
+
+    def test_stdin_left_open(self):
+        import sys
+        import tempfile
+        from unittest import mock
+        from .traces import open_trace
+        with tempfile.TemporaryFile('w+') as stdin:
+            stdin.write('0 1000\n')
+            stdin.seek(0)
+            with mock.patch.object(sys, 'stdin', stdin):
+                with open_trace('-') as fh:
+                    self.assertEqual(fh.read(), '0 1000\n')
+            self.assertFalse(stdin.closed)
+
+    def test_trace_stats_rejects_sizes(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        for ways in [0, -1]:
+            with self.assertRaises(CommandError):
+                call_command('trace_stats', '-', ways=ways, sets=4, block_size=16, stdout=io.StringIO())
+
+    def test_hierarchy_stats_rejects_ways(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        for level in ['0:64:64', '-2:64:64']:
+            with self.assertRaises(CommandError):
+                call_command('hierarchy_stats', '-', level=[level], stdout=io.StringIO())
+
+class StackDistanceSweepTest(TestCase):
+    def test_matches_cache_state(self):
+        from .sweep import sweep_parameters
+        random.seed(3)
+        addresses = [random.randrange(0, 1 << 10) for _ in range(1000)]
+        parameters_list = [
+            CacheParameters(num_ways=ways, num_sets=sets, block_size=8, address_bits=16)
+            for ways in [1, 2, 3, 6] for sets in [1, 4, 16]
+        ]
+        for parameters, hits, misses in sweep_parameters(parameters_list, addresses):
+            state = CacheState(parameters)
+            expected_hits = sum(state.apply_access(CacheAccess(address)).hit.value for address in addresses)
+            self.assertEqual(hits, expected_hits)
+            self.assertEqual(misses, len(addresses) - expected_hits)
+
+class CachePatternResultsTest(TestCase):
+    def _replay(self, pattern):
+        state = CacheState(pattern.parameters)
+        return [state.apply_access(access) for access in pattern.accesses], state
+
+    def test_results_stored(self):
+        parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=12)
+        random.seed(1)
+        pattern = CachePattern.generate_random(parameters, num_accesses=20)
+        loaded = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        self.assertNotEqual(loaded.results_raw, '')
+        (expected, expected_state) = self._replay(loaded)
+        self.assertEqual(loaded.access_results, expected)
+        self.assertEqual(loaded.final_state.to_json(), expected_state.to_json())
+
+    def test_legacy_row_backfilled(self):
+        parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=12)
+        random.seed(2)
+        pattern = CachePattern.generate_random(parameters, num_accesses=20)
+        CachePattern.objects.filter(pattern_id=pattern.pattern_id).update(results_raw='', final_state_raw='')
+        loaded = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        (expected, _) = self._replay(loaded)
+        self.assertEqual(loaded.access_results, expected)
+        reloaded = CachePattern.objects.get(pattern_id=pattern.pattern_id)
+        self.assertEqual(reloaded.results_raw, loaded.results_raw)
+        self.assertEqual(reloaded.access_results, expected)
+
+class PatternCacheTest(TestCase):
+    def test_two_tiers(self):
+        from .pattern_cache import PatternCache
+        parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=8, address_bits=12)
+        random.seed(3)
+        pattern = CachePattern.generate_random(parameters, num_accesses=20)
+        cache = PatternCache()
+        cached = cache.get(pattern.pattern_id)
+        self.assertEqual(cached.access_results, pattern.access_results)
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get(pattern.pattern_id), cached)
+        # another process only has the shared tier
+        other_cache = PatternCache()
+        with self.assertNumQueries(0):
+            from_shared = other_cache.get(pattern.pattern_id)
+            self.assertEqual(from_shared.parameters.num_ways, 2)
+            self.assertEqual(from_shared.access_results, pattern.access_results)
+            self.assertEqual(len(from_shared.accesses), 20)
+        cache.invalidate()
+        with self.assertNumQueries(1):
+            other_cache.get(pattern.pattern_id)
 
+class MissClassifierTest(TestCase):
+    def test_three_cs(self):
+        from .misses import MissClassifier
+        parameters = CacheParameters(num_ways=1, num_sets=2, block_size=1, address_bits=8)
+        state = CacheState(parameters)
+        classifier = MissClassifier(parameters)
+        types = []
+        for address in [0, 2, 0, 1, 3, 2, 2]:
+            types.append(classifier.classify(address, state.apply_access(CacheAccess(address)).hit.value))
+        self.assertEqual(types, ['compulsory', 'compulsory', 'conflict', 'compulsory', 'compulsory', 'capacity', None])
+        self.assertEqual(classifier.counts, {'compulsory': 4, 'capacity': 1, 'conflict': 1})
 
+    def test_pattern_results(self):
+        parameters = CacheParameters.get(num_ways=2, num_sets=4, block_size=4, address_bits=10)
+        random.seed(6)
+        pattern = CachePattern.generate_random(parameters, num_accesses=100)
+        for loaded in [pattern, CachePattern.objects.get(pattern_id=pattern.pattern_id)]:
+            fully_associative = CacheState(CacheParameters(num_ways=8, num_sets=1, block_size=4, address_bits=10))
+            seen = set()
+            for access, result in zip(loaded.accesses, loaded.access_results):
+                block = access.address >> 2
+                shadow_hit = fully_associative.apply_access(access).hit.value
+                if result.hit.value:
+                    self.assertEqual(result.miss_type, None)
+                elif block not in seen:
+                    self.assertEqual(result.miss_type, 'compulsory')
+                else:
+                    self.assertEqual(result.miss_type, 'conflict' if shadow_hit else 'capacity')
+                seen.add(block)
+
+class CacheHierarchyTest(TestCase):
+    def _accesses(self, seed, count=2000, address_range=1 << 10):
+        random.seed(seed)
+        return [
+            CacheAccess(random.randrange(0, address_range), type=random.choice(['R', 'W']))
+            for _ in range(count)
+        ]
+
+    def test_single_level(self):
+        from .hierarchy import simulate_hierarchy
+        parameters = CacheParameters(num_ways=2, num_sets=8, block_size=4, address_bits=16)
+        accesses = self._accesses(5)
+        state = CacheState(parameters)
+        results = [state.apply_access(access) for access in accesses]
+        for mode in ['inclusive', 'exclusive']:
+            level = simulate_hierarchy([parameters], accesses, mode=mode).levels[0]
+            self.assertEqual(level.hits, sum(result.hit.value for result in results))
+            self.assertEqual(level.evictions, sum(result.evicted.value != None for result in results))
+
+    def test_inclusive(self):
+        from .hierarchy import CacheHierarchy
+        hierarchy = CacheHierarchy([
+            CacheParameters(num_ways=2, num_sets=4, block_size=4, address_bits=16),
+            CacheParameters(num_ways=4, num_sets=4, block_size=8, address_bits=16),
+            CacheParameters(num_ways=4, num_sets=8, block_size=8, address_bits=16),
+        ])
+        accesses = self._accesses(6)
+        hierarchy.run(accesses)
+        (l1, l2, l3) = hierarchy.levels
+        self.assertEqual(l1.accesses, len(accesses))
+        self.assertEqual(l2.accesses, l1.misses)
+        self.assertEqual(l3.accesses, l2.misses)
+        self.assertEqual(hierarchy.memory_reads, l3.misses)
+        self.assertGreater(l1.invalidations + l2.invalidations, 0)
+        for inner, outer in [(l1, l2), (l2, l3)]:
+            for address in range(0, 1 << 10, inner.params.block_size):
+                if inner.state.get_recentness(address) != None:
+                    self.assertNotEqual(outer.state.get_recentness(address), None)
+
+    def test_exclusive_matches_combined_lru(self):
+        # with fully associative LRU levels, an exclusive hierarchy holds the
+        # most recently used blocks, like one cache with all of their ways
+        from .hierarchy import CacheHierarchy
+        l1_params = CacheParameters(num_ways=2, num_sets=1, block_size=4, address_bits=16)
+        l2_params = CacheParameters(num_ways=6, num_sets=1, block_size=4, address_bits=16)
+        accesses = self._accesses(7, address_range=64)
+        hierarchy = CacheHierarchy([l1_params, l2_params], mode='exclusive')
+        hierarchy.run(accesses)
+        (l1, l2) = hierarchy.levels
+        combined = CacheState(CacheParameters(num_ways=8, num_sets=1, block_size=4, address_bits=16))
+        combined_misses = sum(not combined.apply_access(access).hit.value for access in accesses)
+        self.assertEqual(l2.accesses, l1.misses)
+        self.assertEqual(hierarchy.memory_reads, combined_misses)
+        for address in range(0, 64, 4):
+            self.assertFalse(l1.state.get_recentness(address) != None and l2.state.get_recentness(address) != None)
 
 def login_as(client, username):
     from django.contrib.auth.models import User
@@ -65,6 +636,38 @@ def login_as(client, username):
         account = User.objects.create_user(username)
     client.force_login(account) 
 
+class QuestionPoolTest(TestCase):
+    def test_fill_and_claim(self):
+        from django.core.management import call_command
+        random.seed(9)
+        out = io.StringIO()
+        call_command('fill_question_pool', size=3, low_water=2, stdout=out)
+        self.assertEqual(PooledQuestion.objects.filter(kind='pattern').count(), 3)
+        self.assertEqual(PooledQuestion.objects.filter(kind='parameter').count(), 3)
+        # above the low-water mark, so nothing to do
+        PooledQuestion.claim('pattern')
+        call_command('fill_question_pool', size=3, low_water=2, stdout=out)
+        self.assertEqual(PooledQuestion.objects.filter(kind='pattern').count(), 2)
+
+        pooled_patterns = set(PooledQuestion.objects.filter(kind='pattern').values_list('pattern_id', flat=True))
+        pooled_parameters = set(PooledQuestion.objects.filter(kind='parameter').values_list('parameters_id', flat=True))
+        c = Client()
+        login_as(c, 'test')
+        c.get('/pattern-question')
+        c.post('/new-pattern-question')
+        c.get('/parameter-question')
+        for question in PatternQuestion.objects.filter(for_user='test'):
+            self.assertIn(question.pattern_id, pooled_patterns)
+        parameter_question = ParameterQuestion.last_for_user('test')
+        self.assertIn(parameter_question.parameters_id, pooled_parameters)
+        self.assertEqual(sorted(parameter_question.missing_parts + parameter_question.given_parts), sorted(all_cache_question_parameters))
+        self.assertEqual(PooledQuestion.objects.filter(kind='pattern').count(), 0)
+        self.assertEqual(PooledQuestion.objects.filter(kind='parameter').count(), 2)
+        # with the pool empty, questions are generated on demand
+        c.post('/new-pattern-question')
+        self.assertEqual(PatternQuestion.last_for_user('test').index, 2)
+        self.assertEqual(PooledQuestion.claim('pattern'), None)
+
 class PatternEvaluateTest(TestCase):
     def test_evaluate_simple(self):
         pattern = CachePattern()
@@ -189,6 +792,300 @@ class PatternSubmitTest(TestCase):
 
 
 
+class UserProgressTest(TestCase):
+    def _timeline(self, user):
+        return list(ScoreChange.objects.filter(for_user=user).order_by('change_time', 'pk').values_list(
+            'change_time', 'parameter_scores_raw', 'pattern_score', 'pattern_max_score'
+        ))
+
+    def _assert_progress_current(self, user):
+        stored = UserProgress.objects.get(for_user=user)
+        stored_timeline = self._timeline(user)
+        rebuilt = UserProgress.rebuild(user)
+        for field in UserProgress._meta.fields:
+            self.assertEqual(getattr(stored, field.name), getattr(rebuilt, field.name), field.name)
+        self.assertEqual(stored_timeline, self._timeline(user))
+        return rebuilt
+
+    def test_incremental(self):
+        random.seed(11)
+        c = Client()
+        login_as(c, 'test')
+        response = c.get('/')
+        self.assertEqual(response.context['parameter_complete'], 0)
+        self.assertEqual(response.context['pattern_in_progress'], False)
+        for i, kind in enumerate(['wrong', 'save', 'right', 'right', 'wrong', 'right', 'right']):
+            c.post('/new-parameter-question')
+            question = ParameterQuestion.last_for_user('test')
+            self._assert_progress_current('test')
+            post = {}
+            for part in question.missing_parts:
+                value = question.find_cache_property(part)
+                post[part] = str(value + 1 if kind == 'wrong' and part == question.missing_parts[0] else value)
+            if kind == 'save':
+                post['is_save'] = '1'
+            c.post('/submit-parameter-answer/{}'.format(question.question_id), post)
+            progress = self._assert_progress_current('test')
+        self.assertEqual(progress.parameter_complete, 6)
+        self.assertEqual(progress.parameter_perfect_count, 3)
+        self.assertTrue(progress.parameter_perfect)
+
+        c.get('/pattern-question')
+        progress = self._assert_progress_current('test')
+        self.assertTrue(progress.pattern_in_progress)
+        for is_save in [True, False]:
+            question = PatternQuestion.last_for_user('test')
+            post = {'is_save': '1'} if is_save else {}
+            for i, result in enumerate(question.pattern.access_results):
+                post['access_hit_{}'.format(i)] = 'hit' if result.hit.value else 'miss-noevict'
+                for which in ['tag', 'index', 'offset']:
+                    post['access_{}_{}'.format(which, i)] = hex(getattr(result, which).value)
+            c.post('/submit-pattern-answer/{}'.format(question.question_id), post)
+            progress = self._assert_progress_current('test')
+        self.assertFalse(progress.pattern_in_progress)
+        self.assertEqual(progress.pattern_complete, 1)
+        self.assertEqual(progress.pattern_max_score - progress.pattern_score,
+            sum(1 for result in question.pattern.access_results[question.give_first:] if result.evicted.value != None))
+        response = c.get('/')
+        self.assertEqual(response.context['parameter_score1'], response.context['parameter_score1_max'])
+        self.assertEqual(response.context['pattern_score'], progress.pattern_score)
+
+        # the detail pages need the summary too
+        UserProgress.objects.all().delete()
+        response = c.get('/pattern-question/{}'.format(question.question_id))
+        self.assertEqual(response.context['have_old'], False)
+        self.assertEqual(response.context['show_old'], False)
+        self._assert_progress_current('test')
+
+    def test_forget_is_atomic(self):
+        from unittest import mock
+        random.seed(18)
+        c = Client()
+        login_as(c, 'test')
+        session = c.session
+        session['cachelab_is_staff'] = 1
+        session.save()
+        c.get('/pattern-question')
+        with mock.patch.object(ScoreChange, 'rebuild', side_effect=RuntimeError('rebuild failed')):
+            with self.assertRaises(RuntimeError):
+                c.post('/forget-questions')
+        self.assertEqual(PatternQuestion.objects.filter(for_user='test').count(), 1)
+        self.assertEqual(UserProgress.objects.get(for_user='test').last_pattern_index, 0)
+        c.post('/forget-questions')
+        self.assertEqual(PatternQuestion.objects.filter(for_user='test').count(), 0)
+        self._assert_progress_current('test')
+        self._assert_progress_current('test+hidden')
+
+    def test_question_added_directly(self):
+        random.seed(17)
+        c = Client()
+        login_as(c, 'test')
+        c.get('/')
+        self.assertEqual(UserProgress.objects.get(for_user='test').last_pattern_index, None)
+        # not through PatternQuestion._create, so the summary is not updated
+        pattern = CachePattern.generate_random(random_parameters_for_pattern())
+        for index in [0, 1]:
+            question = PatternQuestion(pattern=pattern, for_user='test', index=index)
+            question.save()
+            response = c.get('/pattern-question/{}'.format(question.question_id))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['show_old'], False)
+            self.assertEqual(response.context['have_old'], index > 0)
+            self.assertEqual(UserProgress.objects.get(for_user='test').last_pattern_index, index)
+
+class PatternHistoryTest(TestCase):
+    def test_pages(self):
+        random.seed(13)
+        c = Client()
+        login_as(c, 'test')
+        for i in range(5):
+            c.post('/new-pattern-question')
+        question = PatternQuestion.objects.get(for_user='test', index=3)
+        c.post('/submit-pattern-answer/{}'.format(question.question_id), {'is_save': '1'})
+        with self.assertNumQueries(1):
+            page = PatternQuestion.history_for_user('test', limit=2)
+        self.assertEqual([q.index for q in page], [4, 3])
+        self.assertEqual(page[0].answer_submit_time, None)
+        self.assertTrue(page[1].answer_was_save)
+        self.assertEqual(page[1].answer_score, PatternAnswer.last_for_question_and_user(question, 'test').score)
+        page = PatternQuestion.history_for_user('test', before_index=page[-1].index, limit=2)
+        self.assertEqual([q.index for q in page], [2, 1])
+        self.assertEqual(PatternQuestion.history_for_user('other'), [])
+
+        response = c.get('/pattern-question-list')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([q.index for q in response.context['old_questions']], [4, 3, 2, 1, 0])
+        self.assertEqual(response.context['next_before'], None)
+        response = c.get('/pattern-question-list?before=2')
+        self.assertEqual([q.index for q in response.context['old_questions']], [1, 0])
+
+class ScoresCsvTest(TestCase):
+    def _answer_parameter_questions(self, c, user, kinds):
+        for kind in kinds:
+            c.post('/new-parameter-question')
+            question = ParameterQuestion.last_for_user(user)
+            post = {}
+            for part in question.missing_parts:
+                value = question.find_cache_property(part)
+                post[part] = str(value + 1 if kind == 'wrong' and part == question.missing_parts[0] else value)
+            c.post('/submit-parameter-answer/{}'.format(question.question_id), post)
+
+    def test_matches_per_user(self):
+        import csv
+        import datetime
+        from cachelab.views import _make_score_csv_line, make_score_csv
+        random.seed(14)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for user, kinds in [('a', ['wrong', 'right', 'wrong', 'right']), ('b', ['right', 'wrong']), ('c', [])]:
+            c = Client()
+            login_as(c, user)
+            self._answer_parameter_questions(c, user, kinds)
+            c.get('/pattern-question')
+            question = PatternQuestion.last_for_user(user)
+            post = {}
+            for i, result in enumerate(question.pattern.access_results):
+                post['access_hit_{}'.format(i)] = 'hit' if result.hit.value else 'miss-noevict'
+            c.post('/submit-pattern-answer/{}'.format(question.question_id), post)
+        # a's last two parameter answers are after the deadline, except with an extension
+        late = list(ParameterAnswer.objects.filter(for_user='a').order_by('-submit_time').values_list('pk', flat=True))[:2]
+        ParameterAnswer.objects.filter(pk__in=late).update(submit_time=now + datetime.timedelta(days=2))
+        UserProgress.rebuild('a')
+        due = now + datetime.timedelta(days=1)
+        for overrides in [{}, {'a': now + datetime.timedelta(days=3)}]:
+            out = io.StringIO()
+            with self.assertNumQueries(2):
+                make_score_csv(out, due, overrides)
+            rows = {row['user']: row for row in csv.DictReader(io.StringIO(out.getvalue()))}
+            self.assertEqual(sorted(rows), ['a', 'b', 'c'])
+            for user, row in rows.items():
+                expected = _make_score_csv_line(extract_best_for_user(user, overrides.get(user, due), NEEDED_PARAMETER_PERFECT))
+                for field, value in expected.items():
+                    self.assertEqual(row[field], str(value), (user, field))
+        self.assertEqual(rows['c']['parameter score 1'], '')
+
+        # dump_grades passes deadlines without a UTC offset as given
+        from django.utils import timezone
+        naive_due = timezone.make_naive(due, timezone.get_current_timezone())
+        naive_overrides = {'a': timezone.make_naive(overrides['a'], timezone.get_current_timezone())}
+        out = io.StringIO()
+        make_score_csv(out, naive_due, naive_overrides)
+        naive_rows = {row['user']: row for row in csv.DictReader(io.StringIO(out.getvalue()))}
+        self.assertEqual(naive_rows, rows)
+        from unittest import mock
+        from django.core.management import call_command
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('dump_grades', deadline=naive_due.isoformat(), exceptions='a=' + naive_overrides['a'].isoformat())
+        self.assertEqual({row['user']: row for row in csv.DictReader(io.StringIO(out.getvalue()))}, rows)
+
+        # the timelines give the same scores at every deadline
+        timelines = ScoreChange.load_timelines()
+        times = sorted(set(
+            list(ParameterAnswer.objects.values_list('submit_time', flat=True)) +
+            list(PatternAnswer.objects.values_list('submit_time', flat=True))
+        ))
+        for deadline in [now - datetime.timedelta(days=1)] + times:
+            best = extract_best_for_all_users(deadline, {}, NEEDED_PARAMETER_PERFECT, timelines)
+            for user in ['a', 'b', 'c']:
+                expected = extract_best_for_user(user, deadline, NEEDED_PARAMETER_PERFECT)
+                actual = best.get(user, {'parameters': [], 'pattern': None})
+                self.assertEqual(
+                    [(answer.score, answer.max_score) for answer in expected['parameters']],
+                    [tuple(score) for score in actual['parameters']],
+                )
+                expected_pattern = expected['pattern'] and (expected['pattern'].score, expected['pattern'].max_score)
+                self.assertEqual(expected_pattern, actual['pattern'] and tuple(actual['pattern']))
+
+        c = Client()
+        login_as(c, 'a')
+        session = c.session
+        session['cachelab_is_staff'] = 1
+        session.save()
+        response = c.get('/scores.csv', {'due': due.strftime('%Y-%m-%dT%H:%M%z')})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 4)
+
+class CompactionTest(TestCase):
+    def test_compact(self):
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        random.seed(15)
+        parameters_registry.clear()
+        self.addCleanup(parameters_registry.clear)
+        c = Client()
+        login_as(c, 'test')
+        c.get('/pattern-question')
+        question = PatternQuestion.last_for_user('test')
+        for i in range(3):
+            c.post('/submit-pattern-answer/{}'.format(question.question_id), {'is_save': '1'})
+        c.get('/parameter-question')
+        parameter_question = ParameterQuestion.last_for_user('test')
+        for i in range(2):
+            c.post('/submit-parameter-answer/{}'.format(parameter_question.question_id), {'is_save': '1'})
+        post = {part: str(parameter_question.find_cache_property(part)) for part in parameter_question.missing_parts}
+        c.post('/submit-parameter-answer/{}'.format(parameter_question.question_id), post)
+        c.post('/submit-parameter-answer/{}'.format(parameter_question.question_id), {'is_save': '1'})
+        complete = ParameterAnswer.objects.get(for_user='test', was_complete=True)
+        last_pattern_answer = PatternAnswer.last_for_question_and_user(question, 'test')
+        last_parameter_answer = ParameterAnswer.last_for_question_and_user(parameter_question, 'test')
+        progress = UserProgress.objects.get(for_user='test')
+
+        orphan_parameters = CacheParameters.get(num_ways=5, num_sets=2, block_size=2, address_bits=32)
+        orphan_pattern = CachePattern.generate_random(random_parameters_for_pattern())
+        pooled = PooledQuestion.generate(PooledQuestion.KIND_PATTERN)
+
+        (fd, archive) = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, archive)
+        call_command('compact_answers', archive=archive, batch_size=1, stdout=io.StringIO())
+        self.assertEqual(list(PatternAnswer.objects.all()), [last_pattern_answer])
+        self.assertEqual(set(ParameterAnswer.objects.all()), set([complete, last_parameter_answer]))
+        self.assertFalse(CachePattern.objects.filter(pk=orphan_pattern.pk).exists())
+        self.assertFalse(CacheParameters.objects.filter(pk=orphan_parameters.pk).exists())
+        self.assertTrue(CachePattern.objects.filter(pk=pooled.pattern_id).exists())
+        self.assertTrue(CachePattern.objects.filter(pk=question.pattern_id).exists())
+        self.assertTrue(CacheParameters.objects.filter(pk=parameter_question.parameters_id).exists())
+        with open(archive) as fh:
+            archived = [json.loads(line)['model'] for line in fh]
+        self.assertEqual(archived.count('cachelab.patternanswer'), 2)
+        self.assertEqual(archived.count('cachelab.parameteranswer'), 2)
+        self.assertIn('cachelab.cachepattern', archived)
+        self.assertIn('cachelab.cacheparameters', archived)
+
+        # nothing the progress summary is rebuilt from was deleted
+        rebuilt = UserProgress.rebuild('test')
+        for field in UserProgress._meta.fields:
+            self.assertEqual(getattr(progress, field.name), getattr(rebuilt, field.name), field.name)
+        response = c.get('/pattern-question')
+        self.assertEqual(response.status_code, 200)
+
+class UserContextTest(TestCase):
+    def _queries_for_table(self, queries, table):
+        return [query['sql'] for query in queries if 'FROM "{}"'.format(table) in query['sql']]
+
+    def test_loaded_once(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        random.seed(12)
+        c = Client()
+        login_as(c, 'test')
+        c.get('/pattern-question')
+        with CaptureQueriesContext(connection) as queries:
+            response = c.get('/pattern-question')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self._queries_for_table(queries, 'cachelab_patternquestion')), 1)
+        self.assertEqual(len(self._queries_for_table(queries, 'cachelab_userprogress')), 1)
+        c.get('/parameter-question')
+        with CaptureQueriesContext(connection) as queries:
+            response = c.get('/parameter-question')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self._queries_for_table(queries, 'cachelab_parameterquestion')), 1)
+        self.assertEqual(len(self._queries_for_table(queries, 'cachelab_userprogress')), 1)
+
 class ParameterSubmitTest(TestCase):
     def test_evaluate_simple(self):
         param_target = CacheParameters.get(
@@ -0,0 +1,86 @@
+# Score timelines: for each user, the scores that would be graded (the best
+# complete parameter answers and the best complete pattern answer) after
+# each answer that changed them. The scores for any deadline are then those
+# of the last change at or before it, found by binary search, instead of
+# being recomputed from all of the user's answers.
+#
+# The functions here do not use the models, so the ScoreChange migration
+# can use them to fill in timelines for existing answers.
+
+import bisect
+import collections
+import heapq
+
+GradedScore = collections.namedtuple('GradedScore', ['score', 'max_score'])
+
+KIND_PARAMETER = 'parameter'
+KIND_PATTERN = 'pattern'
+
+def add_parameter_answer(parameter_best, entry, num_parameter):
+    """
+    Return parameter_best, a list of [score_ratio, submit timestamp, score,
+    max_score] for the best num_parameter complete parameter answers, with
+    the entry for another complete answer added (in the order of
+    ParameterAnswer.best_K_for_user).
+    """
+    best = list(parameter_best) + [list(entry)]
+    best.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return best[:num_parameter]
+
+def is_better_pattern(score, max_score, best_score, best_max_score):
+    """Whether a complete pattern answer beats the best one so far (best_score None if there is none)."""
+    return best_score == None or max_score - score < best_max_score - best_score
+
+def merge_answers(parameter_answers, pattern_answers):
+    """
+    Merge complete answers, each sorted by submit time, into (submit_time,
+    kind, score_ratio, score, max_score) tuples in submit time order.
+    parameter_answers are (submit_time, score_ratio, score, max_score) and
+    pattern_answers (submit_time, score, max_score).
+    """
+    return heapq.merge(
+        ((time, KIND_PARAMETER, ratio, score, max_score) for time, ratio, score, max_score in parameter_answers),
+        ((time, KIND_PATTERN, None, score, max_score) for time, score, max_score in pattern_answers),
+        key=lambda answer: answer[0],
+    )
+
+def sweep(answers, num_parameter):
+    """
+    Yield (change_time, parameter_scores, pattern_score) for each of
+    merge_answers()'s answers that changes the graded scores, where
+    parameter_scores is a list of GradedScores, best first, and
+    pattern_score a GradedScore or None.
+    """
+    parameter_best = []
+    pattern_score = None
+    for (submit_time, kind, score_ratio, score, max_score) in answers:
+        if kind == KIND_PARAMETER:
+            old_scores = [item[2:] for item in parameter_best]
+            parameter_best = add_parameter_answer(
+                parameter_best, [score_ratio, submit_time.timestamp(), score, max_score], num_parameter
+            )
+            if [item[2:] for item in parameter_best] == old_scores:
+                continue
+        else:
+            if pattern_score != None and not is_better_pattern(score, max_score, *pattern_score):
+                continue
+            pattern_score = GradedScore(score, max_score)
+        yield (submit_time, [GradedScore(*item[2:]) for item in parameter_best], pattern_score)
+
+class ScoreTimeline():
+    """A user's score changes in time order, for looking up the graded scores at a deadline."""
+    def __init__(self):
+        self._times = []
+        self._scores = []
+
+    def append(self, change_time, parameter_scores, pattern_score):
+        """Add a change, which must not be before the last one."""
+        self._times.append(change_time)
+        self._scores.append((parameter_scores, pattern_score))
+
+    def at(self, deadline):
+        """Return (parameter_scores, pattern_score) for answers submitted at or before deadline."""
+        i = bisect.bisect_right(self._times, deadline)
+        if i == 0:
+            return ([], None)
+        return self._scores[i - 1]
@@ -0,0 +1,103 @@
+# Readers for memory access traces produced by other tools.
+#
+# The readers work line by line and yield CacheAccess objects, so traces of any
+# size can be replayed in constant memory, either one access at a time through
+# CacheState.apply_access or in chunks through batch.BatchSimulator.
+
+import array
+import gzip
+import itertools
+import logging
+import sys
+
+from .simulation import CacheAccess
+
+logger = logging.getLogger('cachelab')
+
+def open_trace(path):
+    """Open a trace file for reading as text; '-' is stdin and names ending in .gz are decompressed."""
+    if path == '-':
+        # closing this leaves stdin open
+        return open(sys.stdin.fileno(), 'r', closefd=False)
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    else:
+        return open(path, 'r')
+
+def read_lackey(lines, include_instructions=False):
+    """
+    Parse the output of valgrind --tool=lackey --trace-mem=yes.
+
+    Lines look like 'I  04016b00,3', ' L 04222cac,8', ' S 7ff000398,8' or
+    ' M 0421c7f0,4'. A modify (M) is a load followed by a store to the
+    same address. Instruction fetches (I) are skipped unless
+    include_instructions is set; other lines (such as valgrind's '==pid=='
+    messages) are ignored.
+    """
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 2 or len(parts[0]) != 1:
+            continue
+        operation = parts[0]
+        address, _, size = parts[1].partition(',')
+        try:
+            address = int(address, 16)
+            size = int(size) if size != '' else 1
+        except ValueError:
+            logger.debug('skipping malformed lackey line %r', line)
+            continue
+        if operation == 'L':
+            yield CacheAccess(address, size=size, type='R')
+        elif operation == 'S':
+            yield CacheAccess(address, size=size, type='W')
+        elif operation == 'M':
+            yield CacheAccess(address, size=size, type='R')
+            yield CacheAccess(address, size=size, type='W')
+        elif operation == 'I' and include_instructions:
+            yield CacheAccess(address, size=size, type='R')
+
+DIN_READ = 0
+DIN_WRITE = 1
+DIN_INSTRUCTION = 2
+
+def read_din(lines, include_instructions=True):
+    """
+    Parse a Dinero 'din' trace.
+
+    Each line is 'label address' with a hexadecimal address, where label is 0
+    for a data read, 1 for a data write and 2 for an instruction fetch. Other
+    labels (escapes and cache flushes) and any extra fields are ignored.
+    """
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        try:
+            label = int(parts[0])
+            address = int(parts[1], 16)
+        except ValueError:
+            logger.debug('skipping malformed din line %r', line)
+            continue
+        if label == DIN_READ:
+            yield CacheAccess(address, type='R')
+        elif label == DIN_WRITE:
+            yield CacheAccess(address, type='W')
+        elif label == DIN_INSTRUCTION and include_instructions:
+            yield CacheAccess(address, type='R')
+
+TRACE_READERS = {
+    'lackey': read_lackey,
+    'din': read_din,
+}
+
+def read_trace(lines, format):
+    return TRACE_READERS[format](lines)
+
+def address_chunks(accesses, chunk_size=1 << 16):
+    """Group the addresses of a stream of accesses into array('Q') chunks of at most chunk_size."""
+    accesses = iter(accesses)
+    while True:
+        chunk = array.array('Q', (access.address for access in itertools.islice(accesses, chunk_size)))
+        if len(chunk) == 0:
+            return
+        yield chunk
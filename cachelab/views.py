@@ -8,18 +8,20 @@ from django import template
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import permission_required, login_required
 
 
-from .models import PatternAnswer, PatternQuestion, CacheAccessResult, CachePattern, CacheParameters, ParameterQuestion, ParameterAnswer, ResultItem, all_cache_question_parameters, random_parameters_for_pattern, extract_best_for_user
+from .models import PatternAnswer, PatternQuestion, CacheAccessResult, CachePattern, CacheParameters, ParameterQuestion, ParameterAnswer, PooledQuestion, ResultItem, ScoreChange, UserProgress, NEEDED_PARAMETER_PERFECT, all_cache_question_parameters, extract_best_for_all_users, parameters_registry
+from .pattern_cache import pattern_cache, use_cached_pattern
 
 logger = logging.getLogger('cachelabweb')
 
-NEEDED_PARAMETER_PERFECT = 3
+PATTERN_HISTORY_PAGE_SIZE = 50
 
 def request_is_staff(request):
     return (
@@ -29,115 +31,143 @@ def request_is_staff(request):
 
 def staff_required(wrapped_function):
     def real_function(request, *args, **named_args):
-        if not request_is_staff(request):
+        if not user_context(request).is_staff:
             return HttpResponse('This feature is for staff only.', status_code=403)
         else:
             return wrapped_function(request, *args, **named_args)
     return login_required(real_function)
 
-def pattern_perfect(request):
-    user = request.user.get_username()
-    best_pattern_answer = PatternAnswer.best_complete_for_user(request.user.get_username())
-    if best_pattern_answer != None:
-        return best_pattern_answer.score == best_pattern_answer.max_score
-    else:
-        return False
-
-def parameter_perfect(request):
-    user = request.user.get_username()
-    parameter_perfect_count = 0
-    best_parameter_answers = ParameterAnswer.best_K_for_user(user, NEEDED_PARAMETER_PERFECT)
-    for answer in best_parameter_answers:
-        if answer.score == answer.max_score:
-            parameter_perfect_count += 1
-    return parameter_perfect_count >= NEEDED_PARAMETER_PERFECT
+class UserContext():
+    """
+    What the views need to know about the logged in user, each part loaded
+    when first used and then shared by the views and helpers handling the
+    same request (see user_context()).
+    """
+    def __init__(self, request):
+        self.user = request.user.get_username()
+        self.is_staff = request_is_staff(request)
+        self._progress = None
+        self._last_questions = {}
+
+    @property
+    def progress(self):
+        if self._progress == None:
+            self._progress = UserProgress.for_user_or_rebuild(self.user)
+        return self._progress
+
+    def progress_for_pattern_question(self, question):
+        """
+        The progress summary, rebuilt first if it does not know about
+        question yet (one added without PatternQuestion._create, e.g. from
+        the admin), so it cannot drift from the questions.
+        """
+        last_index = self.progress.last_pattern_index
+        if last_index == None or last_index < question.index:
+            with transaction.atomic():
+                self._progress = UserProgress.rebuild(self.user)
+        return self._progress
+
+    @property
+    def pattern_perfect(self):
+        return self.progress.pattern_perfect
+
+    @property
+    def parameter_perfect(self):
+        return self.progress.parameter_perfect
+
+    def _last_question(self, model):
+        if model not in self._last_questions:
+            self._last_questions[model] = model.last_for_user(self.user)
+        return self._last_questions[model]
+
+    @property
+    def last_pattern_question(self):
+        return self._last_question(PatternQuestion)
+
+    @property
+    def last_parameter_question(self):
+        return self._last_question(ParameterQuestion)
+
+    def question(self, model, question_id):
+        """Return the PatternQuestion or ParameterQuestion (model) with question_id, reusing the last question if it is that one."""
+        last_question = self._last_questions.get(model)
+        if last_question != None and str(last_question.question_id) == str(question_id):
+            return last_question
+        return get_object_or_404(model, question_id=question_id)
+
+    def added_question(self, question):
+        self._last_questions[type(question)] = question
+        self._progress = None
+
+    def added_answer(self):
+        self._progress = None
+
+def user_context(request):
+    context = getattr(request, 'cachelab_user', None)
+    if context == None:
+        context = request.cachelab_user = UserContext(request)
+    return context
 
 def _fill_context(request, context):
+    user = user_context(request)
     context.update({
-        'user': request.user.get_username(),
-        'staff': request_is_staff(request),
+        'user': user.user,
+        'staff': user.is_staff,
         'course_website': settings.COURSE_WEBSITE,
-        'debug_enable': request_is_staff(request) and request.GET.get('debug', 'false') == 'true',
+        'debug_enable': user.is_staff and request.GET.get('debug', 'false') == 'true',
     })
     return context
 
 @login_required
 def index_page(request):
-    user = request.user.get_username()
-    last_parameter_question = ParameterQuestion.last_for_user(user)
-    last_parameter_answer = ParameterAnswer.last_for_question_and_user(last_parameter_question, user)
-    if last_parameter_answer != None:
-        last_parameter_in_progress = not last_parameter_answer.was_complete
-    else:
-        last_parameter_in_progress = False
-    num_parameter_answer = ParameterAnswer.num_complete_for_user(user)
-    best_parameter_answers = ParameterAnswer.best_K_for_user(user, NEEDED_PARAMETER_PERFECT)
-    parameter_perfect_count = 0
-    for answer in best_parameter_answers:
-        if answer.score == answer.max_score:
-            parameter_perfect_count += 1
-    last_pattern_question = PatternQuestion.last_for_user(user)
-    last_pattern_answer = PatternAnswer.last_for_question_and_user(last_pattern_question, user)
-    if last_pattern_answer != None and last_pattern_answer.question == last_pattern_question:
-        last_pattern_in_progress = not last_pattern_answer.was_complete
-    elif last_pattern_question != None:
-        last_pattern_in_progress = True
-    else:
-        last_pattern_in_progress = False
-    num_pattern_answer = PatternAnswer.num_complete_for_user(user)
-    if num_pattern_answer > 0:
-        best_pattern_answer = PatternAnswer.best_complete_for_user(user)
-        pattern_score = best_pattern_answer.score
-        pattern_max_score = best_pattern_answer.max_score
-    else:
-        pattern_score = None
-        pattern_max_score = None
+    progress = user_context(request).progress
     context = _fill_context(request, {
-        'parameter_in_progress': last_parameter_in_progress,
-        'parameter_complete': num_parameter_answer,
-        'parameter_perfect_count':  parameter_perfect_count,
-        'parameter_perfect': parameter_perfect_count >= NEEDED_PARAMETER_PERFECT,
-
-        'pattern_complete': num_pattern_answer,
-        'pattern_in_progress': last_pattern_in_progress,
-        'pattern_score': pattern_score,
-        'pattern_max_score': pattern_max_score,
-        'pattern_perfect': pattern_score != None and pattern_score == pattern_max_score,
+        'parameter_in_progress': progress.parameter_in_progress,
+        'parameter_complete': progress.parameter_complete,
+        'parameter_perfect_count':  progress.parameter_perfect_count,
+        'parameter_perfect': progress.parameter_perfect,
+
+        'pattern_complete': progress.pattern_complete,
+        'pattern_in_progress': progress.pattern_in_progress,
+        'pattern_score': progress.pattern_score,
+        'pattern_max_score': progress.pattern_max_score,
+        'pattern_perfect': progress.pattern_perfect,
     })
-    for i, answer in enumerate(best_parameter_answers):
-        context['parameter_score{}'.format(i+1)] = answer.score
-        context['parameter_score{}_max'.format(i+1)] = answer.max_score
+    for i, (score, max_score) in enumerate(progress.parameter_scores):
+        context['parameter_score{}'.format(i+1)] = score
+        context['parameter_score{}_max'.format(i+1)] = max_score
     return HttpResponse(render(request, 'exercises/user_index.html', context))
 
 @login_required
 def list_pattern_questions(request):
-    user = request.user.get_username()
-    all_questions = PatternQuestion.objects.filter(for_user__exact=user).order_by('-index')
-    context = _fill_context(request, {})
-    lst = []
-    for question in all_questions:
-        lst.append((
-            question,
-            PatternAnswer.last_for_question_and_user(question, user)
-        ))
-    context['old_questions'] = lst
+    try:
+        before_index = int(request.GET['before'])
+    except (KeyError, ValueError):
+        before_index = None
+    # one extra to tell whether there is another page
+    questions = PatternQuestion.history_for_user(user_context(request).user, before_index, PATTERN_HISTORY_PAGE_SIZE + 1)
+    context = _fill_context(request, {
+        'old_questions': questions[:PATTERN_HISTORY_PAGE_SIZE],
+        'is_first_page': before_index == None,
+        'next_before': None,
+    })
+    if len(questions) > PATTERN_HISTORY_PAGE_SIZE:
+        context['next_before'] = questions[PATTERN_HISTORY_PAGE_SIZE - 1].index
     return HttpResponse(render(request, 'exercises/pattern_question_list.html', context))
 
 @login_required
 def last_pattern_question(request):
-    question = PatternQuestion.last_for_user(request.user.get_username())
+    user = user_context(request)
+    question = user.last_pattern_question
     if not question:
-        PatternQuestion.generate_random(
-            parameters=random_parameters_for_pattern(), for_user=request.user.get_username()
-        )
-        question = PatternQuestion.last_for_user(request.user.get_username())
+        question = PatternQuestion.new_for_user(user.user)
+        user.added_question(question)
     return pattern_question_detail(request, question.question_id)
 
 @login_required
 @require_http_methods(["POST"])
 def new_pattern_question(request):
-    parameters = random_parameters_for_pattern()
-    PatternQuestion.generate_random(parameters=parameters, for_user=request.user.get_username())
+    PatternQuestion.new_for_user(user_context(request).user)
     return redirect('last-pattern-question')
 
 # FIXME: @permission_required('quiz.delete_patternquestion')
@@ -145,22 +175,26 @@ def test_control(request):
     return HttpResponse(render(request, 'exercises/test_control.html', {}))
 
 def pattern_question_detail(request, question_id):
-    question = PatternQuestion.objects.get(question_id=question_id)
-    if question.for_user != request.user.get_username():
+    user = user_context(request)
+    question = user.question(PatternQuestion, question_id)
+    if question.for_user != user.user:
         raise PermissionDenied()
-    latest_question = PatternQuestion.last_for_user(request.user.get_username())
-    show_old = latest_question.question_id != question.question_id
-    have_old = latest_question.index > 0
-    answer = PatternAnswer.last_for_question_and_user(question, request.user.get_username())
+    use_cached_pattern(question)
+    last_index = user.progress_for_pattern_question(question).last_pattern_index
+    show_old = last_index != question.index
+    have_old = last_index != None and last_index > 0
+    answer = PatternAnswer.last_for_question_and_user(question, user.user)
     empty_access = CacheAccessResult.empty()
     is_given = itertools.chain([True] * question.give_first, itertools.cycle([False]))
+    accesses = question.pattern.accesses
+    expected_results = question.pattern.access_results
     if answer:
-        accesses_with_default = zip(question.pattern.accesses, answer.access_results, question.pattern.access_results, is_given)
+        accesses_with_default = zip(accesses, answer.access_results, expected_results, is_given)
     else:
-        old_answers = [empty_access] * len(question.pattern.accesses)
+        old_answers = [empty_access] * len(accesses)
         for i in range(question.give_first):
-            old_answers[i] = question.pattern.access_results[i]
-        accesses_with_default = zip(question.pattern.accesses, old_answers, question.pattern.access_results, is_given)
+            old_answers[i] = expected_results[i]
+        accesses_with_default = zip(accesses, old_answers, expected_results, is_given)
     accesses_with_default = list(accesses_with_default)
     widths = int((max(question.tag_bits, question.offset_bits, question.index_bits) + 3) / 4) + 3
     address_width = int((question.address_bits + 3) / 4) + 3
@@ -176,8 +210,8 @@ def pattern_question_detail(request, question_id):
         'evicted_width': address_width,
         'ask_evict': question.ask_evict,
         'give_first': question.give_first,
-        'pattern_perfect': pattern_perfect(request),
-        'parameter_perfect': parameter_perfect(request),
+        'pattern_perfect': user.pattern_perfect,
+        'parameter_perfect': user.parameter_perfect,
         'show_old': show_old,
         'have_old': have_old,
     })
@@ -194,10 +228,12 @@ def value_from_hex(x):
         return None
 
 def pattern_answer(request, question_id):
-    question = get_object_or_404(PatternQuestion, question_id=question_id)
-    if question.for_user != request.user.get_username():
+    user = user_context(request)
+    question = user.question(PatternQuestion, question_id)
+    if question.for_user != user.user:
         raise PermissionDenied()
-    last_answer = PatternAnswer.last_for_question_and_user(question, request.user.get_username())
+    use_cached_pattern(question)
+    last_answer = PatternAnswer.last_for_question_and_user(question, user.user)
     if last_answer and last_answer.was_complete:  # FIXME: threshold?
         return HttpResponse("You already submitted an answer to this question.")
     answer = PatternAnswer()
@@ -208,9 +244,10 @@ def pattern_answer(request, question_id):
     if question.ask_evict:
         parts.append('evicted')
     logger.debug('POST request is %s', request.POST)
+    expected_results = question.pattern.access_results
     for i in range(question.give_first):
-        submitted_results.append(question.pattern.access_results[i])
-    for i in range(question.give_first, len(question.pattern.access_results)):
+        submitted_results.append(expected_results[i])
+    for i in range(question.give_first, len(expected_results)):
         cur_access = CacheAccessResult()
         hit_key = 'access_hit_{}'.format(i)
         if hit_key in request.POST:
@@ -242,15 +279,16 @@ def pattern_answer(request, question_id):
         logger.debug('adding access %s', cur_access)
         submitted_results.append(cur_access)
     answer.access_results = submitted_results
-    answer.for_user = request.user.get_username()
+    answer.for_user = user.user
     answer.was_complete = is_complete
     if request.POST.get('is_save'):
         answer.was_save = True
         answer.was_complete = False
     answer.save()
+    user.added_answer()
     if answer.was_save:
         return redirect('user-index')
-    elif PatternQuestion.last_for_user(request.user.get_username()) == question:
+    elif user.last_pattern_question == question:
         return redirect('last-pattern-question')
     else:
         return redirect('pattern-question', question.question_id)
@@ -284,11 +322,11 @@ def format_value_with_postfix(value):
 
 @login_required
 def parameter_question_detail(request, question_id):
-    question = get_object_or_404(ParameterQuestion, question_id=question_id)
-    user = request.user.get_username()
-    if question.for_user != user:
+    user = user_context(request)
+    question = user.question(ParameterQuestion, question_id)
+    if question.for_user != user.user:
         raise PermissionDenied()
-    last_answer = ParameterAnswer.last_for_question_and_user(question, request.user.get_username())
+    last_answer = ParameterAnswer.last_for_question_and_user(question, user.user)
     params = []
     if last_answer:
         mark_invalid = not last_answer.was_complete and not last_answer.was_save
@@ -322,11 +360,7 @@ def parameter_question_detail(request, question_id):
             'correct_value': format_value_with_postfix(question.find_cache_property(item)),
         }
         params.append(current)
-    best_parameter_answers = ParameterAnswer.best_K_for_user(user, 3)
-    parameter_perfect_count = 0
-    for answer in best_parameter_answers:
-        if answer.score == answer.max_score:
-            parameter_perfect_count += 1
+    parameter_perfect_count = user.progress.parameter_perfect_count
     context = _fill_context(request, {
         'show_correct': show_correct,
         'mark_invalid': mark_invalid,
@@ -339,7 +373,7 @@ def parameter_question_detail(request, question_id):
         'needed_perfect': NEEDED_PARAMETER_PERFECT,
         'remaining_perfect': NEEDED_PARAMETER_PERFECT - parameter_perfect_count,
 
-        'pattern_perfect': pattern_perfect(request),
+        'pattern_perfect': user.pattern_perfect,
     })
     return HttpResponse(render(request, 'exercises/parameter_question.html', context))
 
@@ -347,12 +381,13 @@ def parameter_question_detail(request, question_id):
 @login_required
 @require_http_methods(["POST"])
 def parameter_answer(request, question_id):
-    question = get_object_or_404(ParameterQuestion, question_id=question_id)
-    if question.for_user != request.user.get_username():
+    user = user_context(request)
+    question = user.question(ParameterQuestion, question_id)
+    if question.for_user != user.user:
         raise PermissionDenied()
     answer = ParameterAnswer()
     answer.question = question
-    answer.for_user = request.user.get_username()
+    answer.for_user = user.user
     answer.set_answer_from_post(request.POST)
     if request.POST.get('is_save', '') != '':
         answer.was_complete = False
@@ -360,6 +395,7 @@ def parameter_answer(request, question_id):
     else:
         answer.was_save = False
     answer.save()
+    user.added_answer()
     if answer.was_save:
         logger.info('was save')
         return redirect('user-index')
@@ -370,14 +406,16 @@ def parameter_answer(request, question_id):
 @login_required
 @require_http_methods(["POST"])
 def new_parameter_question(request):
-    question = ParameterQuestion.generate_new(request.user.get_username())
+    question = ParameterQuestion.new_for_user(user_context(request).user)
     return redirect('last-parameter-question')
 
 @login_required
 def last_parameter_question(request):
-    question = ParameterQuestion.last_for_user(request.user.get_username())
+    user = user_context(request)
+    question = user.last_parameter_question
     if not question:
-        question = ParameterQuestion.generate_new(request.user.get_username())
+        question = ParameterQuestion.new_for_user(user.user)
+        user.added_question(question)
     return parameter_question_detail(request, question.question_id)
 
 @require_http_methods(["POST"])
@@ -388,8 +426,13 @@ def clear_all_questions(request):
         PatternQuestion.objects.all().delete()
         ParameterAnswer.objects.all().delete()
         ParameterQuestion.objects.all().delete()
+        PooledQuestion.objects.all().delete()
+        UserProgress.objects.all().delete()
+        ScoreChange.objects.all().delete()
         CachePattern.objects.all().delete()
         CacheParameters.objects.all().delete()
+        pattern_cache.invalidate()
+        parameters_registry.clear()
         return HttpResponse("Cleared all questions.")
     else:
         return HttpResponse("Refusing to clear all questions.")
@@ -397,23 +440,29 @@ def clear_all_questions(request):
 @staff_required
 @require_http_methods(["POST"])
 def forget_questions(request):
-    user = request.user.get_username()
+    user = user_context(request).user
     hidden_user = user + '+hidden'
-    PatternAnswer.objects.filter(for_user__exact=user).update(for_user=hidden_user)
-    PatternQuestion.objects.filter(for_user__exact=user).update(for_user=hidden_user)
-    ParameterAnswer.objects.filter(for_user__exact=user).update(for_user=hidden_user)
-    ParameterQuestion.objects.filter(for_user__exact=user).update(for_user=hidden_user)
+    with transaction.atomic():
+        PatternAnswer.objects.filter(for_user__exact=user).update(for_user=hidden_user)
+        PatternQuestion.objects.filter(for_user__exact=user).update(for_user=hidden_user)
+        ParameterAnswer.objects.filter(for_user__exact=user).update(for_user=hidden_user)
+        ParameterQuestion.objects.filter(for_user__exact=user).update(for_user=hidden_user)
+        UserProgress.rebuild(user)
+        UserProgress.rebuild(hidden_user)
     return HttpResponse('questions forgotten')
 
 @staff_required
 @require_http_methods(["POST"])
 def unforget_questions(request):
-    user = request.user.get_username()
+    user = user_context(request).user
     hidden_user = user + '+hidden'
-    PatternAnswer.objects.filter(for_user__exact=hidden_user).update(for_user=user)
-    PatternQuestion.objects.filter(for_user__exact=hidden_user).update(for_user=user)
-    ParameterAnswer.objects.filter(for_user__exact=hidden_user).update(for_user=user)
-    ParameterQuestion.objects.filter(for_user__exact=hidden_user).update(for_user=user)
+    with transaction.atomic():
+        PatternAnswer.objects.filter(for_user__exact=hidden_user).update(for_user=user)
+        PatternQuestion.objects.filter(for_user__exact=hidden_user).update(for_user=user)
+        ParameterAnswer.objects.filter(for_user__exact=hidden_user).update(for_user=user)
+        ParameterQuestion.objects.filter(for_user__exact=hidden_user).update(for_user=user)
+        UserProgress.rebuild(user)
+        UserProgress.rebuild(hidden_user)
     return HttpResponse('questions unforgotten')
 
 def _make_score_csv_line(answers):
@@ -451,7 +500,13 @@ def _make_score_csv_line(answers):
         result['parameter max score {}'.format(i+1)] = parameter_max_score
     return result
 
-def make_score_csv(out_fh, due_datetime, override_due_datetime):
+class _Echo():
+    """A file for csv.writer that returns each line instead of storing it."""
+    def write(self, value):
+        return value
+
+def score_csv_lines(due_datetime, override_due_datetime):
+    """Yield the lines of the scores CSV, one for each user."""
     fields = ['user']
     for i in range(NEEDED_PARAMETER_PERFECT):
         fields.append('parameter score {}'.format(i+1))
@@ -460,17 +515,21 @@ def make_score_csv(out_fh, due_datetime, override_due_datetime):
     fields.append('pattern max score')
     fields.append('overall score')
     fields.append('overall max score')
-    writer = csv.DictWriter(out_fh, fields)
-    writer.writeheader()
-    for user in map(lambda x: x.get_username(), User.objects.all()):
-        cur_due = override_due_datetime.get(user, due_datetime)
-        answers = extract_best_for_user(user, cur_due, NEEDED_PARAMETER_PERFECT)
-        for_csv = _make_score_csv_line(answers)
+    writer = csv.DictWriter(_Echo(), fields)
+    yield writer.writeheader()
+    best = extract_best_for_all_users(due_datetime, override_due_datetime, NEEDED_PARAMETER_PERFECT)
+    no_answers = {'parameters': [], 'pattern': None}
+    users = User.objects.order_by(User.USERNAME_FIELD).values_list(User.USERNAME_FIELD, flat=True)
+    for user in users.iterator():
+        for_csv = _make_score_csv_line(best.get(user, no_answers))
         for_csv['user'] = user
-        writer.writerow(for_csv)
+        yield writer.writerow(for_csv)
+
+def make_score_csv(out_fh, due_datetime, override_due_datetime):
+    for line in score_csv_lines(due_datetime, override_due_datetime):
+        out_fh.write(line)
 
 @staff_required
 def get_scores_csv(request):
     due_datetime = datetime.datetime.strptime(request.GET.get('due'), '%Y-%m-%dT%H:%M%z')
-    response = HttpResponse(content_type='text/csv')
-    make_score_csv(response, due_datetime, {})
+    return StreamingHttpResponse(score_csv_lines(due_datetime, {}), content_type='text/csv')